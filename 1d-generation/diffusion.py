@@ -92,8 +92,21 @@ def get_ddpm_constants(
     dc['sqrt_alphas_bar']           = sqrt_alphas_bar
     dc['sqrt_one_minus_alphas_bar'] = sqrt_one_minus_alphas_bar
     dc['posterior_variance']        = posterior_variance
+    dc['tensors']                   = {} # device copies, see get_dc_tensor()
     
     return dc
+
+def get_dc_tensor(dc,name,device):
+    """
+    Get a diffusion constant as a tensor on device, copied only once per device
+    :param dc: dictionary of diffusion constants
+    :param name: key of a [T] array in dc
+    """
+    tensors = dc.setdefault('tensors',{})
+    key = (name,th.device(device))
+    if key not in tensors:
+        tensors[key] = th.from_numpy(dc[name]).to(device)
+    return tensors[key]
     
 def timestep_embedding(timesteps, dim, max_period=10000):
     """
@@ -115,25 +128,40 @@ def timestep_embedding(timesteps, dim, max_period=10000):
         embedding = th.cat([embedding, th.zeros_like(embedding[:, :1])], dim=-1)
     return embedding
 
+def circulant_noise(spectrum,noise):
+    """
+    Correlate white noise with a circulant embedding in O(L log L)
+    :param spectrum: [L] sqrt rfft spectrum of the 2L-2 embedding (see util.get_circulant_spectrum)
+    :param noise: [B x C x L] white noise, padded with L-2 fresh normals per row
+    :return: [B x C x L] correlated noise
+    """
+    L = noise.shape[-1]
+    n_embed = 2*L-2
+    pad = th.randn(*noise.shape[:-1],n_embed-L,device=noise.device,dtype=noise.dtype)
+    noise_full = th.cat([noise,pad],dim=-1) # [B x C x 2L-2]
+    out = th.fft.irfft(spectrum.to(noise)*th.fft.rfft(noise_full,dim=-1),n=n_embed,dim=-1)
+    return out[...,:L]
+
 def forward_sample(x0_batch,t_batch,dc,M=None):
     """
     Forward diffusion sampling
     :param x0_batch: [B x C x ...]
     :param t_batch: [B]
     :param dc: dictionary of diffusion constants
-    :param M: a matrix of [L x L] for [B x C x L] data
+    :param M: a matrix of [L x L] for [B x C x L] data, or an [L] circulant
+        spectrum (util.get_hbm_M(...,sampler='fft')) sampled with FFTs
     :return: xt_batch of [B x C x ...] and noise of [B x C x ...]
     """
     # Gather diffusion constants with matching dimension
     out_shape = (t_batch.shape[0],) + ((1,)*(len(x0_batch.shape)-1))
     device = t_batch.device
     sqrt_alphas_bar_t = th.gather(
-        input = th.from_numpy(dc['sqrt_alphas_bar']).to(device), # [T]
+        input = get_dc_tensor(dc,'sqrt_alphas_bar',device), # [T]
         dim   = -1,
         index = t_batch
     ).reshape(out_shape) # [B x 1 x 1 x 1] if (rank==4) and [B x 1 x 1] if (rank==3)
     sqrt_one_minus_alphas_bar = th.gather(
-        input = th.from_numpy(dc['sqrt_one_minus_alphas_bar']).to(device), # [T]
+        input = get_dc_tensor(dc,'sqrt_one_minus_alphas_bar',device), # [T]
         dim   = -1,
         index = t_batch
     ).reshape(out_shape) # [B x 1 x 1 x 1] if (rank==4) and [B x 1 x 1] if (rank==3)
@@ -150,17 +178,25 @@ def forward_sample(x0_batch,t_batch,dc,M=None):
         
         if isinstance(M, list): # if M is a list,
             M_use = random.choice(M)
-            if len(M_use.shape) == 3:
+            if len(M_use.shape) == 1:
+                M_exp = None # circulant spectrum
+            elif len(M_use.shape) == 3:
                 M_exp = M_use[None] # [D x L x L] => [1 x D x L x L]
             else:
                 M_exp = M_use[None,None,:,:].expand(B,C,L,L) # [L x L] => [B x C x L x L]                
         else:
             M_use = M # [L x L]
-            M_exp = M_use[None,None,:,:].expand(B,C,L,L) # [L x L] => [B x C x L x L]                
+            if len(M_use.shape) == 1:
+                M_exp = None # circulant spectrum
+            else:
+                M_exp = M_use[None,None,:,:].expand(B,C,L,L) # [L x L] => [B x C x L x L]                
             
-        noise_exp = noise[:,:,:,None] # [B x C x L x 1]
-        noise_exp = M_exp @ noise_exp # [B x C x L x 1]
-        noise = noise_exp.squeeze(dim=3) # [B x C x L]
+        if M_exp is None:
+            noise = circulant_noise(M_use,noise) # [B x C x L]
+        else:
+            noise_exp = noise[:,:,:,None] # [B x C x L x 1]
+            noise_exp = M_exp @ noise_exp # [B x C x L x 1]
+            noise = noise_exp.squeeze(dim=3) # [B x C x L]
 
     # Jump diffusion
     xt_batch = sqrt_alphas_bar_t*x0_batch + \
@@ -476,17 +512,17 @@ def eval_ddpm_1d(
         with th.no_grad():
             eps_t,_ = model(x_t, step, hyp_len)
         betas_t = th.gather(
-            input = th.from_numpy(dc['betas']).to(device), # [T]
+            input = get_dc_tensor(dc,'betas',device), # [T]
             dim   = -1,
             index = step
         ).reshape((-1,1,1)) # [n_sample x 1 x 1]
         sqrt_one_minus_alphas_bar_t = th.gather(
-            input = th.from_numpy(dc['sqrt_one_minus_alphas_bar']).to(device), # [T]
+            input = get_dc_tensor(dc,'sqrt_one_minus_alphas_bar',device), # [T]
             dim   = -1,
             index = step
         ).reshape((-1,1,1)) # [n_sample x 1 x 1]
         sqrt_recip_alphas_t = th.gather(
-            input = th.from_numpy(dc['sqrt_recip_alphas']).to(device), # [T]
+            input = get_dc_tensor(dc,'sqrt_recip_alphas',device), # [T]
             dim   = -1,
             index = step
         ).reshape((-1,1,1)) # [n_sample x 1 x 1]
@@ -496,7 +532,7 @@ def eval_ddpm_1d(
             ) # [n_sample x C x L]
         # Compute posterior variance
         posterior_variance_t = th.gather(
-            input = th.from_numpy(dc['posterior_variance']).to(device), # [T]
+            input = get_dc_tensor(dc,'posterior_variance',device), # [T]
             dim   = -1,
             index = step
         ).reshape((-1,1,1)) # [n_sample x 1 x 1]
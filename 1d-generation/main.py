@@ -140,7 +140,7 @@ def main(args):
     )
     for hyp_len in cls_value:
         hyp_len = hyp_len.detach().cpu().numpy()
-        M = get_hbm_M(times,hyp_gain=0.1,hyp_len=hyp_len,device=device) # [L x L]
+        M = get_hbm_M(times,hyp_gain=0.1,hyp_len=hyp_len,device=device,sampler=args.sampler) # [L x L] or [L] spectrum
         M_list.append(M) # length 11
     # M = None
     print ("Hilbert Brownian motion ready.")    
@@ -229,7 +229,7 @@ def main(args):
                     
                     M_eval = None
                     if args.corr:
-                        M_eval = get_hbm_M(times,hyp_gain=0.1,hyp_len=hyp_len,device=device)
+                        M_eval = get_hbm_M(times,hyp_gain=0.1,hyp_len=hyp_len,device=device,sampler=args.sampler)
                     x_t_list = eval_ddpm_1d(
                         model = model,
                         dc = dc,
@@ -303,7 +303,7 @@ def main(args):
             M_eval=None
             
             if args.corr:
-                M_eval = get_hbm_M(times,hyp_gain=0.1,hyp_len=hyp_len,device=device)
+                M_eval = get_hbm_M(times,hyp_gain=0.1,hyp_len=hyp_len,device=device,sampler=args.sampler)
 
             x_t_list = eval_ddpm_1d(
                         model = model,
@@ -367,6 +367,7 @@ if __name__ == "__main__":
     parser.add_argument("--pb_end", type=float, default=1e-2)
     parser.add_argument("--inb", action='store_true')
     parser.add_argument("--corr", action='store_true')
+    parser.add_argument("--sampler", type=str, default='dense', choices=['dense','fft'])
     parser.add_argument("--output_pth", type=str, default='./')
     parser.add_argument("--ckpt", type=str, default='./')
     args = parser.parse_args()
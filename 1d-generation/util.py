@@ -91,15 +91,38 @@ def plot_ddpm_1d_result(
         plt.show()
         plt.savefig(os.path.join(output, f'generated_{len_param}.png'))
     
-def get_hbm_M(times,hyp_gain=1.0,hyp_len=0.1,device='cpu'):
+def get_circulant_spectrum(K,tol=1e-5):
+    """
+    Square-root spectrum of the circulant embedding of a symmetric Toeplitz K
+    :param K: [L x L] ndarray
+    :return: [L] ndarray (rfft of the 2L-2 embedding), or None if K is not
+             Toeplitz or the embedding is not PSD
+    """
+    L = K.shape[0]
+    c = K[0]
+    lag = np.abs(np.arange(L)[:,None]-np.arange(L)[None,:])
+    if L < 3 or np.abs(K-c[lag]).max() > tol*np.abs(c[0]):
+        return None
+    eigvals = np.fft.rfft(np.concatenate([c,c[1:-1][::-1]])).real
+    if eigvals.min() < -tol*eigvals.max():
+        return None
+    return np.sqrt(np.clip(eigvals,0,None))
+
+def get_hbm_M(times,hyp_gain=1.0,hyp_len=0.1,device='cpu',sampler='dense'):
     """ 
     Get a matrix M for Hilbert Brownian motion
     :param times: [L x 1] ndarray
-    :return: [L x L] torch tensor
+    :param sampler: 'dense' or 'fft'. With 'fft' the circulant spectrum is
+                    returned instead when the embedding is valid
+    :return: [L x L] torch tensor, or an [L] spectrum for the fft sampler
     """
     L = times.shape[0]
     K = kernel_se(times,times,hyp={'gain':hyp_gain,'len':hyp_len}) # [L x L]
     K = K + 1e-8*np.eye(L,L)
+    if sampler == 'fft':
+        spectrum = get_circulant_spectrum(K)
+        if spectrum is not None:
+            return th.from_numpy(spectrum).to(th.float32).to(device) # [L]
     U,V = np.linalg.eigh(K,UPLO='L')
     M = V @ np.diag(np.sqrt(U))
     M = th.from_numpy(M).to(th.float32).to(device) # [L x L]
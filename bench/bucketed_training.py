@@ -0,0 +1,168 @@
+"""
+Benchmark length-bucketed training batches (--length_bucket_width) against
+batches padded to 196 frames.
+
+Runs full training steps (GP-correlated noise, training_losses, backward,
+AdamW) of an MDM with --padding_mask on random motions whose lengths follow
+`--lengths_file` (e.g. np.save of the HumanML3D train item_lengths()) or a
+uniform 40-196 draw. Both loaders go through the real collate: one shuffles
+items padded to 196 frames, the other uses LengthBucketBatchSampler with
+unpadded items. It reports training samples / sec for each, the fraction of
+padded frames, and the largest per-sample loss difference between the two
+layouts for the same batch, timesteps and noise (0 up to float error means
+the shorter padding does not change what is learned). cond_mode is no_cond so
+that no CLIP download is needed; text encoding costs the same in both modes.
+
+    python -m bench.bucketed_training --batch_size 64 --steps 20 --device cpu
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from data_loaders.humanml.data.dataset import LengthBucketBatchSampler
+from data_loaders.tensors import collate
+from diffusion.gp_kernel import KernelFactorCache, KernelOperator, LENGTH_SCALES, get_corr_channels
+from model.mdm import MDM
+from utils.model_util import create_gaussian_diffusion
+
+
+class RandomMotions(torch.utils.data.Dataset):
+    def __init__(self, lengths, pad_to=None):
+        self.lengths = lengths
+        self.pad_to = pad_to
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, item):
+        length = int(self.lengths[item])
+        motion = torch.randn(263, 1, 196, generator=torch.Generator().manual_seed(item))
+        motion[..., length:] = 0
+        return {'inp': motion[..., :self.pad_to or length], 'lengths': length}
+
+
+def build_model(args, device):
+    model = MDM(modeltype='', njoints=263, nfeats=1, num_actions=1, translation=True, pose_rep='rot6d',
+                glob=True, glob_rot=True, latent_dim=args.latent_dim, ff_size=1024, num_layers=args.layers,
+                num_heads=4, dropout=0.1, activation='gelu', data_rep='hml_vec', cond_mode='no_cond',
+                cond_mask_prob=0.1, action_emb='tensor', arch=args.arch, emb_trans_dec=False,
+                clip_version='ViT-B/32', dataset='humanml', padding_mask=True)
+    return model.to(device)
+
+
+class Trainer:
+    def __init__(self, args, model, diffusion, device):
+        self.model = model
+        self.diffusion = diffusion
+        self.device = device
+        self.opt = torch.optim.AdamW(model.parameters(), lr=1e-4)
+        kernel_cache = KernelFactorCache()
+        self.K_param = kernel_cache.stack(LENGTH_SCALES, 196, 20, device=device)
+        self.template = kernel_cache.template(196, 20, device=device)
+        self.channels = get_corr_channels(args.corr_mode, 263)
+        self.K_crops = {}
+
+    def kernels(self, B, L):
+        cls_idx = torch.randint(len(LENGTH_SCALES), (B, len(self.channels)), device=self.device)
+        K_params = KernelOperator.from_classes(self.K_param, self.template, cls_idx, self.channels, 263,
+                                               crops=self.K_crops)
+        return K_params.crop(L)
+
+    def losses(self, motion, cond, t, K_params=None, noise=None):
+        return self.diffusion.training_losses(self.model, motion, t, K_params=K_params,
+                                              model_kwargs=cond, noise=noise)['loss']
+
+    def step(self, motion, cond):
+        motion = motion.to(self.device)
+        cond['y'] = {key: val.to(self.device) if torch.is_tensor(val) else val for key, val in cond['y'].items()}
+        B, _, _, L = motion.shape
+        t = torch.randint(self.diffusion.num_timesteps, (B,), device=self.device)
+        loss = self.losses(motion, cond, t, self.kernels(B, L)).mean()
+        self.opt.zero_grad()
+        loss.backward()
+        self.opt.step()
+
+
+def samples_per_sec(trainer, loader, steps, device):
+    batches = iter(loader)
+    trainer.step(*next(batches))  # warm-up
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    n_samples, start = 0, time.perf_counter()
+    for _ in range(steps):
+        motion, cond = next(batches)
+        trainer.step(motion, cond)
+        n_samples += motion.shape[0]
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return n_samples / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', default=64, type=int)
+    parser.add_argument('--steps', default=20, type=int)
+    parser.add_argument('--bucket_width', default=20, type=int)
+    parser.add_argument('--layers', default=8, type=int)
+    parser.add_argument('--latent_dim', default=512, type=int)
+    parser.add_argument('--arch', default='trans_enc', choices=['trans_enc', 'trans_enc_sdpa'], type=str)
+    parser.add_argument('--corr_mode', default='R_trs', type=str)
+    parser.add_argument('--lengths_file', default='', type=str, help='.npy of per-item motion lengths.')
+    parser.add_argument('--device', default='cpu', type=str)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    np.random.seed(0)
+    if args.lengths_file:
+        lengths = np.sort(np.load(args.lengths_file))
+    else:
+        lengths = np.sort(np.random.randint(40, 197, 4 * args.batch_size * (args.steps + 1)))
+    lengths = lengths - lengths % 4  # the dataset crops to multiples of unit_length
+
+    model = build_model(args, device)
+    diffusion = create_gaussian_diffusion(argparse.Namespace(
+        diffusion_steps=1000, noise_schedule='cosine', sigma_small=True, lambda_vel=0, lambda_rcxyz=0,
+        lambda_fc=0, sampler='ddpm', sampling_steps=0, ddim_eta=0.0))
+    trainer = Trainer(args, model, diffusion, device)
+
+    padded = DataLoader(RandomMotions(lengths, pad_to=196), batch_size=args.batch_size, shuffle=True,
+                        drop_last=True, collate_fn=collate)
+    bucketed = DataLoader(RandomMotions(lengths),
+                          batch_sampler=LengthBucketBatchSampler(lengths, args.batch_size, args.bucket_width),
+                          collate_fn=collate)
+
+    # same batch, timesteps and noise in both layouts, without dropout
+    model.eval()
+    rows = next(iter(bucketed.batch_sampler))
+    short_motion, short_cond = collate([bucketed.dataset[i] for i in rows])
+    long_motion, long_cond = collate([padded.dataset[i] for i in rows])
+    L = short_motion.shape[-1]
+    t = torch.randint(diffusion.num_timesteps, (len(rows),))
+    noise = torch.randn_like(long_motion)
+    noise[..., L:] = 0
+    with torch.no_grad():
+        long_loss = trainer.losses(long_motion.to(device), long_cond, t.to(device), noise=noise.to(device))
+        short_loss = trainer.losses(short_motion.to(device), short_cond, t.to(device),
+                                    noise=noise[..., :L].contiguous().to(device))
+    model.train()
+
+    padded_sps = samples_per_sec(trainer, padded, args.steps, device)
+    bucketed_sps = samples_per_sec(trainer, bucketed, args.steps, device)
+    frames = [lengths[b].max() for b in LengthBucketBatchSampler(lengths, args.batch_size, args.bucket_width)]
+
+    print(f'device={device} batch={args.batch_size} layers={args.layers} latent_dim={args.latent_dim} '
+          f'arch={args.arch} mean length={lengths.mean():.0f}')
+    print(f'padded to 196        : {padded_sps:7.1f} samples / sec, '
+          f'{1 - lengths.mean() / 196:.0%} padded frames')
+    print(f'bucket_width={args.bucket_width:<3d}     : {bucketed_sps:7.1f} samples / sec '
+          f'({bucketed_sps / padded_sps:.2f}x), {1 - lengths.mean() / np.mean(frames):.0%} padded frames')
+    print(f'max |per-sample loss, padded - bucketed| = {(long_loss - short_loss).abs().max():.2e}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Benchmark the captured denoising step against the eager p_sample loop.
+
+Builds an MDM with random weights (no checkpoint or CLIP weights needed
+beyond what MDM loads) wrapped for classifier-free guidance, and reports the
+wall-clock time per denoising step for the eager loop and for
+CompiledSampleLoop ('compile' everywhere, 'cuda_graph' on GPU). The first
+call of each compiled mode includes compilation / capture, so it is timed
+separately.
+
+    python -m bench.compiled_step --batch_size 1 --steps 50 --device cpu
+"""
+
+import argparse
+import time
+
+import torch
+
+from diffusion import gaussian_diffusion as gd
+from diffusion.compiled_sampler import CompiledSampleLoop
+from diffusion.respace import SpacedDiffusion, space_timesteps
+from model.cfg_sampler import ClassifierFreeSampleModel
+from model.mdm import MDM
+
+
+def build(args, device):
+    model = MDM(modeltype='', njoints=263, nfeats=1, num_actions=1, translation=True, pose_rep='rot6d',
+                glob=True, glob_rot=True, latent_dim=args.latent_dim, ff_size=1024, num_layers=args.layers,
+                num_heads=4, dropout=0.1, activation='gelu', data_rep='hml_vec', cond_mode='text',
+                cond_mask_prob=0.1, action_emb='tensor', arch='trans_enc', emb_trans_dec=False,
+                clip_version='ViT-B/32', dataset='humanml')
+    model = ClassifierFreeSampleModel(model).to(device)
+    model.eval()
+    diffusion = SpacedDiffusion(
+        use_timesteps=space_timesteps(args.steps, [args.steps]),
+        betas=gd.get_named_beta_schedule('cosine', args.steps),
+        model_mean_type=gd.ModelMeanType.START_X,
+        model_var_type=gd.ModelVarType.FIXED_SMALL,
+        loss_type=gd.LossType.MSE,
+    )
+    return model, diffusion
+
+
+def run(sample_fn, model, shape, model_kwargs, device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    sample = sample_fn(model, shape, None, None, clip_denoised=False, model_kwargs=model_kwargs)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return sample, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', default=1, type=int)
+    parser.add_argument('--steps', default=50, type=int, help='Diffusion steps.')
+    parser.add_argument('--layers', default=8, type=int)
+    parser.add_argument('--latent_dim', default=512, type=int)
+    parser.add_argument('--repeats', default=3, type=int)
+    parser.add_argument('--device', default='cpu', type=str)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    model, diffusion = build(args, device)
+    shape = (args.batch_size, 263, 1, 196)
+    model_kwargs = {'y': {
+        'text': ['a person walks forward and turns around'] * args.batch_size,
+        'mask': torch.ones(args.batch_size, 1, 1, 196, dtype=torch.bool, device=device),
+        'lengths': torch.full((args.batch_size,), 196, device=device),
+        'scale': torch.full((args.batch_size,), 2.5, device=device),
+    }}
+
+    modes = ['compile'] + (['cuda_graph'] if device.type == 'cuda' else [])
+    samplers = {'eager': diffusion.p_sample_loop}
+    samplers.update({mode: CompiledSampleLoop(diffusion, mode=mode) for mode in modes})
+
+    noise = torch.randn(*shape, device=device)
+    print(f'device={device} batch={args.batch_size} steps={args.steps} layers={args.layers}')
+    eager_ms = None
+    for name, sample_fn in samplers.items():
+        torch.manual_seed(0)
+        sample, first = run(lambda *a, **k: sample_fn(*a, noise=noise.clone(), **k), model, shape, model_kwargs, device)
+        times = [run(sample_fn, model, shape, model_kwargs, device)[1] for _ in range(args.repeats)]
+        ms = min(times) / args.steps * 1e3
+        eager_ms = eager_ms or ms
+        print(f'{name:10s}: {ms:7.2f} ms / step ({eager_ms / ms:.2f}x), first call {first:.1f} s')
+
+
+if __name__ == '__main__':
+    main()
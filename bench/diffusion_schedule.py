@@ -0,0 +1,85 @@
+"""
+Benchmark the per-step cost of reading the diffusion schedule.
+
+Compares indexing the device-resident schedule buffers against the numpy
+path (a host-to-device copy per lookup) for the extractions one p_sample()
+step makes, and reports a full p_sample() step with a zero-cost model for
+scale.
+
+    python -m bench.diffusion_schedule --batch_size 64 --device cpu
+"""
+
+import argparse
+import time
+
+import torch
+
+from diffusion import gaussian_diffusion as gd
+from diffusion.respace import SpacedDiffusion, space_timesteps
+
+# what p_mean_variance() + q_posterior_mean_variance() read per step (FIXED_SMALL, START_X)
+STEP_ARRAYS = ['posterior_variance', 'posterior_log_variance_clipped', 'posterior_mean_coef1',
+               'posterior_mean_coef2', 'posterior_variance', 'posterior_log_variance_clipped']
+
+
+class ZeroModel(torch.nn.Module):
+    def forward(self, x, t, len_param, **kwargs):
+        return torch.zeros_like(x)
+
+
+def timeit(fn, device, iters):
+    fn()  # warm-up
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', default=64, type=int)
+    parser.add_argument('--steps', default=1000, type=int, help='Diffusion steps.')
+    parser.add_argument('--iters', default=2000, type=int)
+    parser.add_argument('--device', default='cpu', type=str)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    diffusion = SpacedDiffusion(
+        use_timesteps=space_timesteps(args.steps, [args.steps]),
+        betas=gd.get_named_beta_schedule('cosine', args.steps),
+        model_mean_type=gd.ModelMeanType.START_X,
+        model_var_type=gd.ModelVarType.FIXED_SMALL,
+        loss_type=gd.LossType.MSE,
+    )
+    shape = (args.batch_size, 263, 1, 196)
+    t = torch.full((args.batch_size,), args.steps // 2, device=device, dtype=torch.long)
+
+    def numpy_path():
+        for name in STEP_ARRAYS:
+            gd._extract_into_tensor(getattr(diffusion, name), t, shape)
+
+    def buffer_path():
+        for name in STEP_ARRAYS:
+            diffusion._extract(name, t, shape)
+
+    x = torch.randn(*shape, device=device)
+    model = ZeroModel()
+
+    def p_sample():
+        diffusion.p_sample(model, x, t, None, None, clip_denoised=False, model_kwargs={'y': {}})
+
+    numpy_us = timeit(numpy_path, device, args.iters)
+    buffer_us = timeit(buffer_path, device, args.iters)
+    step_us = timeit(p_sample, device, max(args.iters // 10, 1))
+    print(f'device={device} batch={args.batch_size} ({len(STEP_ARRAYS)} schedule lookups per step)')
+    print(f'numpy schedule  : {numpy_us:8.1f} us / step')
+    print(f'device buffers  : {buffer_us:8.1f} us / step  ({numpy_us / buffer_us:.1f}x)')
+    print(f'p_sample, zero model (buffers): {step_us:8.1f} us / step')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Benchmark the dense and FFT (circulant embedding) correlated-noise samplers.
+
+Reports throughput of KernelOperator.apply() in both modes for a HumanML3D
+sized batch, and the relative error of each sampler's empirical covariance
+against K = factor @ factor.T.
+
+    python -m bench.gp_noise --batch_size 64 --corr_mode all
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from diffusion.gp_kernel import KernelOperator, circulant_spectra, get_corr_channels
+from train.pre_calK import k_se
+
+
+LENS_ARRAY = [0.033, 0.14044444, 0.24788889, 0.35533333, 0.46277778, 0.67766667, 1.]
+
+
+def build_factors(num_frames, fps, gain=0.1):
+    t_data = np.linspace(start=0.0, stop=(num_frames / fps), num=num_frames).reshape((-1, 1))
+    factors = []
+    for hyp_len in LENS_ARRAY + [0.0001]:  # the last one is the template
+        K = k_se(x1=t_data, x2=t_data, gain=gain, hyp_len=hyp_len) + 1e-6 * np.eye(num_frames)
+        U, V = np.linalg.eigh(K, UPLO='L')
+        factors.append(V @ np.diag(np.sqrt(U)))
+    return torch.Tensor(np.stack(factors))
+
+
+def time_apply(op, shape, device, iters):
+    noise = torch.randn(*shape, device=device)
+    op.apply(noise)  # warm-up, builds the grouping
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        op.apply(torch.randn(*shape, device=device))
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters
+
+
+def covariance_error(op, factor, num_frames, n_draws, device):
+    noise = torch.randn(n_draws, 1, 1, num_frames, device=device)
+    x = op.apply(noise).reshape(n_draws, num_frames)
+    cov = x.T @ x / n_draws
+    K = factor.to(device) @ factor.to(device).T
+    return ((cov - K).abs().max() / K.abs().max()).item()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", default=64, type=int)
+    parser.add_argument("--num_channels", default=263, type=int)
+    parser.add_argument("--num_frames", default=196, type=int)
+    parser.add_argument("--fps", default=20, type=float)
+    parser.add_argument("--corr_mode", default='all', type=str)
+    parser.add_argument("--iters", default=50, type=int)
+    parser.add_argument("--n_draws", default=100_000, type=int)
+    parser.add_argument("--device", default='cpu', type=str)
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    factors = build_factors(args.num_frames, args.fps).to(device)
+    K_param, template = factors[:-1], factors[-1]
+    spectra = circulant_spectra(factors)
+    print('circulant embedding valid per factor:', [s is not None for s in spectra])
+
+    channels = get_corr_channels(args.corr_mode, args.num_channels)
+    cls_idx = torch.randint(0, len(K_param), (args.batch_size, len(channels)), device=device)
+    dense_op = KernelOperator.from_classes(K_param, template, cls_idx, channels, args.num_channels)
+    fft_op = KernelOperator.from_classes(K_param, template, cls_idx, channels, args.num_channels,
+                                         spectra=spectra)
+
+    shape = (args.batch_size, args.num_channels, 1, args.num_frames)
+    t_dense = time_apply(dense_op, shape, device, args.iters)
+    t_fft = time_apply(fft_op, shape, device, args.iters)
+    n_rows = args.batch_size * args.num_channels
+    print(f'dense: {t_dense * 1e3:.2f} ms/batch ({n_rows / t_dense:.0f} rows/s)')
+    print(f'fft:   {t_fft * 1e3:.2f} ms/batch ({n_rows / t_fft:.0f} rows/s)')
+    print(f'speedup: {t_dense / t_fft:.2f}x')
+
+    print('relative max covariance error (dense / fft):')
+    for c, hyp_len in enumerate(LENS_ARRAY):
+        idx = torch.full((1, 1), c, device=device)
+        err_dense = covariance_error(KernelOperator(K_param, idx), K_param[c], args.num_frames, args.n_draws, device)
+        err_fft = covariance_error(KernelOperator(K_param, idx, spectra[:-1]), K_param[c], args.num_frames,
+                                   args.n_draws, device)
+        print(f'  len {hyp_len:.3f}: {err_dense:.4f} / {err_fft:.4f}')
+
+
+if __name__ == "__main__":
+    main()
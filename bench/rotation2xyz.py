@@ -0,0 +1,97 @@
+"""
+Benchmark Rotation2xyz against its previous implementation.
+
+Converts a batch of random rot6d motions with a random padding mask. The
+motions use the HumanAct12 / UESTC layout, [bs, 25, 6, nframes] including
+the translation row. It reports the time per call of:
+- the previous masked gather / scatter code;
+- the current masked (dense=False) path;
+- the dense path;
+- the mask=None path the training losses take, before and now.
+It also reports the largest difference between the previous code and the
+dense path. Needs the SMPL files under ./body_models/smpl.
+
+    python -m bench.rotation2xyz --batch_size 64 --num_frames 60 --device cpu
+"""
+
+import argparse
+import time
+
+import torch
+
+import utils.rotation_conversions as geometry
+from model.rotation2xyz import Rotation2xyz, JOINTSTYPE_ROOT
+
+
+def masked_rot2xyz(rot2xyz, x, mask, jointstype='smpl', beta=0):
+    # the previous implementation (rot6d, glob, translation, vertstrans)
+    x_translations = x[:, -1, :3]
+    x_rotations = x[:, :-1].permute(0, 3, 1, 2)
+    nsamples, time, njoints, feats = x_rotations.shape
+    rotations = geometry.rotation_6d_to_matrix(x_rotations[mask])
+    global_orient = rotations[:, 0]
+    rotations = rotations[:, 1:]
+    betas = torch.zeros([rotations.shape[0], rot2xyz.smpl_model.num_betas],
+                        dtype=rotations.dtype, device=rotations.device)
+    betas[:, 1] = beta
+    joints = rot2xyz.smpl_model(body_pose=rotations, global_orient=global_orient, betas=betas)[jointstype]
+    x_xyz = torch.empty(nsamples, time, joints.shape[1], 3, device=x.device, dtype=x.dtype)
+    x_xyz[~mask] = 0
+    x_xyz[mask] = joints
+    x_xyz = x_xyz.permute(0, 2, 3, 1).contiguous()
+    x_xyz = x_xyz - x_xyz[:, [JOINTSTYPE_ROOT[jointstype]], :, :]
+    x_translations = x_translations - x_translations[:, :, [0]]
+    return x_xyz + x_translations[:, None, :, :]
+
+
+def timeit(fn, device, iters):
+    fn()  # warm-up
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', default=64, type=int)
+    parser.add_argument('--num_frames', default=60, type=int)
+    parser.add_argument('--iters', default=10, type=int)
+    parser.add_argument('--device', default='cpu', type=str)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    rot2xyz = Rotation2xyz(device=device)
+    x = torch.randn(args.batch_size, 25, 6, args.num_frames, device=device)
+    lengths = torch.randint(args.num_frames // 2, args.num_frames + 1, (args.batch_size,), device=device)
+    mask = torch.arange(args.num_frames, device=device)[None] < lengths[:, None]
+    kwargs = dict(pose_rep='rot6d', translation=True, glob=True, jointstype='smpl', vertstrans=True)
+
+    with torch.no_grad():
+        masked = masked_rot2xyz(rot2xyz, x, mask)
+        dense = rot2xyz(x, mask, dense=True, **kwargs)
+        previous_ms = timeit(lambda: masked_rot2xyz(rot2xyz, x, mask), device, args.iters)
+        masked_ms = timeit(lambda: rot2xyz(x, mask, dense=False, **kwargs), device, args.iters)
+        dense_ms = timeit(lambda: rot2xyz(x, mask, dense=True, **kwargs), device, args.iters)
+        unmasked_ms = timeit(lambda: rot2xyz(x, None, **kwargs), device, args.iters)
+        # mask=None used to build an all-True mask and gather / scatter every frame
+        full = torch.ones_like(mask)
+        previous_full_ms = timeit(lambda: masked_rot2xyz(rot2xyz, x, full), device, args.iters)
+
+    print(f'device={device} batch={args.batch_size} frames={args.num_frames} '
+          f'valid frames={mask.float().mean():.0%}')
+    print(f'previous                : {previous_ms:8.2f} ms / call')
+    print(f'dense=False             : {masked_ms:8.2f} ms / call ({previous_ms / masked_ms:.2f}x)')
+    print(f'dense=True              : {dense_ms:8.2f} ms / call ({previous_ms / dense_ms:.2f}x)')
+    print(f'mask=None, previous     : {previous_full_ms:8.2f} ms / call')
+    print(f'mask=None (dense)       : {unmasked_ms:8.2f} ms / call ({previous_full_ms / unmasked_ms:.2f}x)')
+    print(f'max |masked - dense| = {(masked - dense).abs().max():.2e}')
+
+
+if __name__ == '__main__':
+    main()
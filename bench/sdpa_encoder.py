@@ -0,0 +1,99 @@
+"""
+Benchmark the SDPA encoder (arch='trans_enc_sdpa') against the stock
+trans_enc encoder.
+
+Builds a trans_enc MDM with random weights, loads the same weights into a
+trans_enc_sdpa MDM and reports the wall-clock time of one guided denoising
+step (one p_sample() call through the classifier-free wrapper) for each, and
+the largest difference between their outputs.
+
+    python -m bench.sdpa_encoder --batch_size 64 --device cpu
+"""
+
+import argparse
+import time
+
+import torch
+
+from diffusion import gaussian_diffusion as gd
+from diffusion.respace import SpacedDiffusion, space_timesteps
+from model.cfg_sampler import ClassifierFreeSampleModel
+from model.mdm import MDM
+
+
+def build(args, arch, device):
+    model = MDM(modeltype='', njoints=263, nfeats=1, num_actions=1, translation=True, pose_rep='rot6d',
+                glob=True, glob_rot=True, latent_dim=args.latent_dim, ff_size=1024, num_layers=args.layers,
+                num_heads=4, dropout=0.1, activation='gelu', data_rep='hml_vec', cond_mode='text',
+                cond_mask_prob=0.1, action_emb='tensor', arch=arch, emb_trans_dec=False,
+                clip_version='ViT-B/32', dataset='humanml', padding_mask=args.padding_mask)
+    model.eval()
+    return model
+
+
+def timeit(fn, device, iters):
+    fn()  # warm-up
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', default=64, type=int)
+    parser.add_argument('--layers', default=8, type=int)
+    parser.add_argument('--latent_dim', default=512, type=int)
+    parser.add_argument('--iters', default=5, type=int)
+    parser.add_argument('--padding_mask', action='store_true', help='Time with the key padding mask on.')
+    parser.add_argument('--device', default='cpu', type=str)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    stock = build(args, 'trans_enc', device)
+    sdpa = build(args, 'trans_enc_sdpa', device)
+    sdpa.load_state_dict(stock.state_dict())
+    models = {'trans_enc': stock, 'trans_enc_sdpa': sdpa}
+
+    diffusion = SpacedDiffusion(
+        use_timesteps=space_timesteps(1000, [1000]),
+        betas=gd.get_named_beta_schedule('cosine', 1000),
+        model_mean_type=gd.ModelMeanType.START_X,
+        model_var_type=gd.ModelVarType.FIXED_SMALL,
+        loss_type=gd.LossType.MSE,
+    )
+    bs = args.batch_size
+    lengths = torch.randint(40, 197, (bs,), device=device)
+    model_kwargs = {'y': {
+        'enc_text': torch.randn(bs, 512, device=device),
+        'mask': (torch.arange(196, device=device)[None] < lengths[:, None])[:, None, None],
+        'lengths': lengths,
+        'scale': torch.full((bs,), 2.5, device=device),
+    }}
+    x = torch.randn(bs, 263, 1, 196, device=device)
+    t = torch.full((bs,), 500, device=device, dtype=torch.long)
+
+    print(f'device={device} batch={bs} layers={args.layers} latent_dim={args.latent_dim} '
+          f'padding_mask={args.padding_mask}')
+    outputs, stock_ms = {}, None
+    with torch.no_grad():
+        for name, model in models.items():
+            model = ClassifierFreeSampleModel(model).to(device)
+            outputs[name] = model(x, t, None, model_kwargs['y'])
+
+            def step():
+                diffusion.p_sample(model, x, t, None, None, clip_denoised=False, model_kwargs=model_kwargs)
+
+            ms = timeit(step, device, args.iters)
+            stock_ms = stock_ms or ms
+            print(f'{name:15s}: {ms:8.1f} ms / step ({stock_ms / ms:.2f}x)')
+    print(f'max |trans_enc - trans_enc_sdpa| = {(outputs["trans_enc"] - outputs["trans_enc_sdpa"]).abs().max():.2e}')
+
+
+if __name__ == '__main__':
+    main()
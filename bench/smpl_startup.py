@@ -0,0 +1,56 @@
+"""
+Measure the startup time saved by loading SMPL lazily in Rotation2xyz.
+
+Times building an MDM and moving it to the device, which is what
+generate_GP.py / train_GPmotion.py do at startup. It also times the SMPL
+load and transfer they used to pay for eagerly, by forcing
+rot2xyz.smpl_model. Needs the SMPL files under ./body_models/smpl (see
+prepare/download_smpl_files.sh).
+
+    python -m bench.smpl_startup --device cpu
+"""
+
+import argparse
+import time
+
+import torch
+
+from model.mdm import MDM
+
+
+def timed(fn, device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    out = fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return out, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--layers', default=8, type=int)
+    parser.add_argument('--latent_dim', default=512, type=int)
+    parser.add_argument('--device', default='cpu', type=str)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+
+    def build():
+        model = MDM(modeltype='', njoints=263, nfeats=1, num_actions=1, translation=True, pose_rep='rot6d',
+                    glob=True, glob_rot=True, latent_dim=args.latent_dim, ff_size=1024, num_layers=args.layers,
+                    num_heads=4, dropout=0.1, activation='gelu', data_rep='hml_vec', cond_mode='no_cond',
+                    cond_mask_prob=0.1, action_emb='tensor', arch='trans_enc', emb_trans_dec=False,
+                    clip_version='ViT-B/32', dataset='humanml')
+        return model.to(device)
+
+    model, startup = timed(build, device)
+    _, smpl = timed(lambda: model.rot2xyz.smpl_model.to(device), device)
+    print(f'device={device} layers={args.layers} latent_dim={args.latent_dim} (hml_vec, no CLIP)')
+    print(f'MDM init + .to(device), SMPL lazy : {startup:6.2f} s')
+    print(f'SMPL load + .to(device)           : {smpl:6.2f} s (previously paid at startup)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Benchmark per-item GloVe / POS featurization.
+
+Times, per caption of a dataset split:
+- the per-token loop the datasets used, with the previous
+  WordVectorizer.__getitem__ (dict lookup, VIP scan, fresh one-hot);
+- featurize(), which encodes the tokens and gathers;
+- lookup() on ids encoded once, which is what the datasets do now.
+Needs ./glove (prepare/download_glove.sh) and the dataset.
+
+    python -m bench.word_vectorizer --dataset humanml --split test
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from data_loaders.get_data import get_dataset
+from data_loaders.humanml.utils.word_vectorizer import POS_enumerator, VIP_dict
+
+
+def previous_getitem(w_vectorizer, item):
+    word, pos = item.split('/')
+    if word in w_vectorizer.word2id:
+        word_vec = w_vectorizer.vectors[w_vectorizer.word2id[word]]
+        pos = next((key for key, values in VIP_dict.items() if word in values), pos)
+    else:
+        word_vec = w_vectorizer.vectors[w_vectorizer.word2id['unk']]
+        pos = 'OTHER'
+    pos_vec = np.zeros(len(POS_enumerator))
+    pos_vec[POS_enumerator.get(pos, POS_enumerator['OTHER'])] = 1
+    return word_vec, pos_vec
+
+
+def per_token(w_vectorizer, tokens):
+    pos_one_hots = []
+    word_embeddings = []
+    for token in tokens:
+        word_emb, pos_oh = previous_getitem(w_vectorizer, token)
+        pos_one_hots.append(pos_oh[None, :])
+        word_embeddings.append(word_emb[None, :])
+    return np.concatenate(word_embeddings, axis=0), np.concatenate(pos_one_hots, axis=0)
+
+
+def timeit(fn, inputs):
+    start = time.perf_counter()
+    for x in inputs:
+        fn(x)
+    return (time.perf_counter() - start) / len(inputs) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', default='humanml', choices=['humanml', 'kit'], type=str)
+    parser.add_argument('--split', default='test', type=str)
+    args = parser.parse_args()
+
+    dataset = get_dataset(args.dataset, None, split=args.split, hml_mode='eval').t2m_dataset
+    w_vectorizer = dataset.w_vectorizer
+    captions = [dataset._caption_ids(text_dict['tokens'])
+                for data in dataset.data_dict.values() for text_dict in data['text']]
+    tokens = [caption[3].split('_') for caption in captions]
+    ids = [caption[:2] for caption in captions]
+
+    for padded, (word_ids, pos_ids) in zip(tokens, ids):
+        reference = per_token(w_vectorizer, padded)
+        assert all(np.array_equal(a, b) for a, b in zip(reference, w_vectorizer.lookup(word_ids, pos_ids)))
+
+    loop_us = timeit(lambda t: per_token(w_vectorizer, t), tokens)
+    featurize_us = timeit(w_vectorizer.featurize, tokens)
+    lookup_us = timeit(lambda i: w_vectorizer.lookup(*i), ids)
+    print(f'{len(tokens)} captions of {args.dataset} {args.split}, {len(tokens[0])} tokens each')
+    print(f'per-token loop : {loop_us:7.1f} us / caption')
+    print(f'featurize()    : {featurize_us:7.1f} us / caption ({loop_us / featurize_us:.1f}x)')
+    print(f'lookup(ids)    : {lookup_us:7.1f} us / caption ({loop_us / lookup_us:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
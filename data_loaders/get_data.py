@@ -40,9 +40,16 @@ def get_dataset(name, num_frames, split='train', hml_mode='train'):
     return dataset
 
 
-def get_dataset_loader(name, batch_size, num_frames, split='train', hml_mode='train'):
+def get_dataset_loader(name, batch_size, num_frames, split='train', hml_mode='train', bucket_width=0):
     dataset = get_dataset(name, num_frames, split, hml_mode)
     collate = get_collate_fn(name, hml_mode)
+    if bucket_width > 0:
+        # batches of similar lengths, padded to the batch max by the collate instead of to 196 frames
+        assert name in ["humanml", "kit"] and hml_mode == 'train', 'length buckets need a humanml / kit train loader'
+        from data_loaders.humanml.data.dataset import LengthBucketBatchSampler
+        dataset.t2m_dataset.pad_to_max = False
+        batch_sampler = LengthBucketBatchSampler(dataset.t2m_dataset.item_lengths(), batch_size, bucket_width)
+        return DataLoader(dataset, batch_sampler=batch_sampler, num_workers=2, collate_fn=collate)
     loader = DataLoader(
         dataset, batch_size=batch_size, shuffle=True,
         num_workers=2, drop_last=True, collate_fn=collate
@@ -11,6 +11,8 @@ from tqdm import tqdm
 from torch.utils.data._utils.collate import default_collate
 from data_loaders.humanml.utils.word_vectorizer import WordVectorizer
 from data_loaders.humanml.utils.get_opt import get_opt
+from data_loaders.humanml.data.packed import (CLIPS_FILE, MOTIONS_FILE, TEXT_ONLY_FILE, PackedClips, is_current,
+                                              packed_split_dir, source_digest)
 
 # import spacy
 
@@ -153,14 +155,7 @@ class Text2MotionDataset(data.Dataset):
             tokens = tokens[:self.opt.max_text_len]
             tokens = ['sos/OTHER'] + tokens + ['eos/OTHER']
             sent_len = len(tokens)
-        pos_one_hots = []
-        word_embeddings = []
-        for token in tokens:
-            word_emb, pos_oh = self.w_vectorizer[token]
-            pos_one_hots.append(pos_oh[None, :])
-            word_embeddings.append(word_emb[None, :])
-        pos_one_hots = np.concatenate(pos_one_hots, axis=0)
-        word_embeddings = np.concatenate(word_embeddings, axis=0)
+        word_embeddings, pos_one_hots = self.w_vectorizer.featurize(tokens)
 
         len_gap = (m_length - self.max_length) // self.opt.unit_length
 
@@ -205,12 +200,37 @@ class Text2MotionDataset(data.Dataset):
 
 '''For use of training text motion matching model, and evaluations'''
 class Text2MotionDatasetV2(data.Dataset):
-    def __init__(self, opt, mean, std, split_file, w_vectorizer):
+    def __init__(self, opt, mean, std, split_file, w_vectorizer, packed_dir=None):
         self.opt = opt
         self.w_vectorizer = w_vectorizer
         self.max_length = 20
         self.pointer = 0
         self.max_motion_length = opt.max_motion_length
+        if packed_dir:
+            # see data_loaders/humanml/scripts/pack_dataset.py
+            data_dict = PackedClips(pjoin(packed_dir, CLIPS_FILE), pjoin(packed_dir, MOTIONS_FILE))
+            name_list, length_list = data_dict.names, data_dict.lengths
+        else:
+            data_dict, name_list, length_list = self._read_split(split_file)
+
+        self.mean = mean
+        self.std = std
+        self.length_arr = np.array(length_list)
+        self.data_dict = data_dict
+        self.name_list = name_list
+        # when set, __getitem__ also returns (clip key, crop offset, crop length), see load_length_idx
+        self.return_crop_key = False
+        self.length_idx = None
+        # when set, __getitem__ returns word / POS ids in place of embeddings / one-hots,
+        # for an EvaluatorMDMWrapper to featurize on its device
+        self.return_token_ids = False
+        self._captions = {}
+        # when unset, motions are returned unpadded and the collate pads them to the batch max
+        self.pad_to_max = True
+        self.reset_max_len(self.max_length)
+
+    def _read_split(self, split_file):
+        opt = self.opt
         min_motion_len = 40 if self.opt.dataset_name =='t2m' else 24
 
         data_dict = {}
@@ -255,7 +275,9 @@ class Text2MotionDatasetV2(data.Dataset):
                                     new_name = random.choice('ABCDEFGHIJKLMNOPQRSTUVW') + '_' + name
                                 data_dict[new_name] = {'motion': n_motion,
                                                        'length': len(n_motion),
-                                                       'text':[text_dict]}
+                                                       'text':[text_dict],
+                                                       # new_name is random, this key is stable across runs
+                                                       'key': '%s#%d#%d' % (name, int(f_tag*20), int(to_tag*20))}
                                 new_name_list.append(new_name)
                                 length_list.append(len(n_motion))
                             except:
@@ -266,20 +288,28 @@ class Text2MotionDatasetV2(data.Dataset):
                 if flag:
                     data_dict[name] = {'motion': motion,
                                        'length': len(motion),
-                                       'text': text_data}
+                                       'text': text_data,
+                                       'key': name}
                     new_name_list.append(name)
                     length_list.append(len(motion))
             except:
                 pass
 
         name_list, length_list = zip(*sorted(zip(new_name_list, length_list), key=lambda x: x[1]))
-
-        self.mean = mean
-        self.std = std
-        self.length_arr = np.array(length_list)
-        self.data_dict = data_dict
-        self.name_list = name_list
-        self.reset_max_len(self.max_length)
+        return data_dict, name_list, length_list
+
+    def load_length_idx(self, path):
+        """
+        Attach the per-channel length-scale class ids written by
+        data_loaders/humanml/scripts/annotate_length.py to every clip.
+        """
+        annotations = np.load(path)
+        row_of = {key: row for row, key in enumerate(annotations['keys'])}
+        ids = annotations['ids']
+        missing = [data['key'] for data in self.data_dict.values() if data['key'] not in row_of]
+        if missing:
+            raise KeyError('%d clips (e.g. %s) are not annotated in %s' % (len(missing), missing[0], path))
+        self.length_idx = {name: ids[row_of[data['key']]] for name, data in self.data_dict.items()}
 
     def reset_max_len(self, length):
         assert length <= self.max_motion_length
@@ -293,32 +323,46 @@ class Text2MotionDatasetV2(data.Dataset):
     def __len__(self):
         return len(self.data_dict) - self.pointer
 
+    def item_lengths(self):
+        """
+        Uncropped motion length of every item, in item order (ascending).
+        """
+        return self.length_arr[self.pointer:]
+
+    def _caption_ids(self, tokens):
+        """
+        Word ids, POS ids, sentence length and '_' joined tokens of a caption
+        wrapped in sos / eos and padded with unk (or cropped) to max_text_len.
+        Computed once per caption, then reused.
+        """
+        key = tuple(tokens)
+        if key not in self._captions:
+            if len(tokens) < self.opt.max_text_len:
+                # pad with "unk"
+                tokens = ['sos/OTHER'] + tokens + ['eos/OTHER']
+                sent_len = len(tokens)
+                tokens = tokens + ['unk/OTHER'] * (self.opt.max_text_len + 2 - sent_len)
+            else:
+                # crop
+                tokens = tokens[:self.opt.max_text_len]
+                tokens = ['sos/OTHER'] + tokens + ['eos/OTHER']
+                sent_len = len(tokens)
+            self._captions[key] = (*self.w_vectorizer.encode(tokens), sent_len, '_'.join(tokens))
+        return self._captions[key]
+
     def __getitem__(self, item):
         idx = self.pointer + item
-        data = self.data_dict[self.name_list[idx]]
+        name = self.name_list[idx]
+        data = self.data_dict[name]
         motion, m_length, text_list = data['motion'], data['length'], data['text']
         # Randomly select a caption
         text_data = random.choice(text_list)
-        caption, tokens = text_data['caption'], text_data['tokens']
-
-        if len(tokens) < self.opt.max_text_len:
-            # pad with "unk"
-            tokens = ['sos/OTHER'] + tokens + ['eos/OTHER']
-            sent_len = len(tokens)
-            tokens = tokens + ['unk/OTHER'] * (self.opt.max_text_len + 2 - sent_len)
+        caption = text_data['caption']
+        word_ids, pos_ids, sent_len, tokens = self._caption_ids(text_data['tokens'])
+        if self.return_token_ids:
+            word_embeddings, pos_one_hots = word_ids, pos_ids
         else:
-            # crop
-            tokens = tokens[:self.opt.max_text_len]
-            tokens = ['sos/OTHER'] + tokens + ['eos/OTHER']
-            sent_len = len(tokens)
-        pos_one_hots = []
-        word_embeddings = []
-        for token in tokens:
-            word_emb, pos_oh = self.w_vectorizer[token]
-            pos_one_hots.append(pos_oh[None, :])
-            word_embeddings.append(word_emb[None, :])
-        pos_one_hots = np.concatenate(pos_one_hots, axis=0)
-        word_embeddings = np.concatenate(word_embeddings, axis=0)
+            word_embeddings, pos_one_hots = self.w_vectorizer.lookup(word_ids, pos_ids)
 
         # Crop the motions in to times of 4, and introduce small variations
         if self.opt.unit_length < 10:
@@ -335,13 +379,59 @@ class Text2MotionDatasetV2(data.Dataset):
 
         "Z Normalization"
         motion = (motion - self.mean) / self.std
-        if m_length < self.max_motion_length:
+        if self.pad_to_max and m_length < self.max_motion_length:
             motion = np.concatenate([motion,
                                      np.zeros((self.max_motion_length - m_length, motion.shape[1]))
                                      ], axis=0)
         # print(word_embeddings.shape, motion.shape)
         # print(tokens)
-        return word_embeddings, pos_one_hots, caption, sent_len, motion, m_length, '_'.join(tokens)
+        extra = {}
+        if self.return_crop_key:
+            # data['key'], unlike a sub-clip's random name, is the same in every run
+            extra['crop_key'] = (data['key'], idx, m_length)
+        if self.length_idx is not None:
+            extra['length_idx'] = self.length_idx[name]
+        if extra:
+            return word_embeddings, pos_one_hots, caption, sent_len, motion, m_length, tokens, extra
+        return word_embeddings, pos_one_hots, caption, sent_len, motion, m_length, tokens
+
+
+class LengthBucketBatchSampler(data.Sampler):
+    """
+    Batches of items with similar lengths, for loaders whose collate pads to
+    the batch max instead of max_motion_length.
+
+    Items are split into buckets of `bucket_width` frames and shuffled within
+    their bucket every epoch. The buckets are then laid end to end and chunked
+    into batches, so at most one batch per bucket boundary mixes two buckets,
+    and the order of the batches is shuffled.
+
+    :param lengths: per-item motion lengths.
+    :param batch_size: items per batch.
+    :param bucket_width: bucket size in frames.
+    :param drop_last: drop the last incomplete batch.
+    """
+
+    def __init__(self, lengths, batch_size, bucket_width, drop_last=True):
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        lengths = np.asarray(lengths)
+        bucket = lengths // bucket_width
+        self.buckets = [np.flatnonzero(bucket == b) for b in np.unique(bucket)]
+
+    def __iter__(self):
+        order = np.concatenate([np.random.permutation(items) for items in self.buckets])
+        batches = [order[i:i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+        if self.drop_last and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        for b in np.random.permutation(len(batches)):
+            yield batches[b].tolist()
+
+    def __len__(self):
+        num_items = sum(len(items) for items in self.buckets)
+        if self.drop_last:
+            return num_items // self.batch_size
+        return (num_items + self.batch_size - 1) // self.batch_size
 
 
 '''For use of training baseline'''
@@ -452,14 +542,7 @@ class Text2MotionDatasetBaseline(data.Dataset):
             tokens = tokens[:self.opt.max_text_len]
             tokens = ['sos/OTHER'] + tokens + ['eos/OTHER']
             sent_len = len(tokens)
-        pos_one_hots = []
-        word_embeddings = []
-        for token in tokens:
-            word_emb, pos_oh = self.w_vectorizer[token]
-            pos_one_hots.append(pos_oh[None, :])
-            word_embeddings.append(word_emb[None, :])
-        pos_one_hots = np.concatenate(pos_one_hots, axis=0)
-        word_embeddings = np.concatenate(word_embeddings, axis=0)
+        word_embeddings, pos_one_hots = self.w_vectorizer.featurize(tokens)
 
         len_gap = (m_length - self.max_length) // self.opt.unit_length
 
@@ -626,19 +709,12 @@ class RawTextDataset(data.Dataset):
             tokens = tokens[:self.opt.max_text_len]
             tokens = ['sos/OTHER'] + tokens + ['eos/OTHER']
             sent_len = len(tokens)
-        pos_one_hots = []
-        word_embeddings = []
-        for token in tokens:
-            word_emb, pos_oh = self.w_vectorizer[token]
-            pos_one_hots.append(pos_oh[None, :])
-            word_embeddings.append(word_emb[None, :])
-        pos_one_hots = np.concatenate(pos_one_hots, axis=0)
-        word_embeddings = np.concatenate(word_embeddings, axis=0)
+        word_embeddings, pos_one_hots = self.w_vectorizer.featurize(tokens)
 
         return word_embeddings, pos_one_hots, caption, sent_len
 
 class TextOnlyDataset(data.Dataset):
-    def __init__(self, opt, mean, std, split_file):
+    def __init__(self, opt, mean, std, split_file, packed_dir=None):
         self.mean = mean
         self.std = std
         self.opt = opt
@@ -647,7 +723,19 @@ class TextOnlyDataset(data.Dataset):
         self.pointer = 0
         self.fixed_length = 120
 
+        if packed_dir:
+            # see data_loaders/humanml/scripts/pack_dataset.py
+            data_dict = PackedClips(pjoin(packed_dir, TEXT_ONLY_FILE))
+            name_list, length_list = data_dict.names, []
+        else:
+            data_dict, name_list, length_list = self._read_split(split_file)
 
+        self.length_arr = np.array(length_list)
+        self.data_dict = data_dict
+        self.name_list = name_list
+
+    def _read_split(self, split_file):
+        opt = self.opt
         data_dict = {}
         id_list = []
         with cs.open(split_file, 'r') as f:
@@ -695,9 +783,7 @@ class TextOnlyDataset(data.Dataset):
             except:
                 pass
 
-        self.length_arr = np.array(length_list)
-        self.data_dict = data_dict
-        self.name_list = new_name_list
+        return data_dict, new_name_list, length_list
 
     def inv_transform(self, data):
         return data * self.std + self.mean
@@ -718,7 +804,7 @@ class TextOnlyDataset(data.Dataset):
 
 # A wrapper class for t2m original dataset for MDM purposes
 class HumanML3D(data.Dataset):
-    def __init__(self, mode, datapath='./dataset/humanml_opt.txt', split="train", **kwargs):
+    def __init__(self, mode, datapath='./dataset/humanml_opt.txt', split="train", use_packed=True, **kwargs):
         self.mode = mode
         
         self.dataset_name = 't2m'
@@ -756,11 +842,21 @@ class HumanML3D(data.Dataset):
             self.std_for_eval = np.load(pjoin(opt.meta_dir, f'{opt.dataset_name}_std.npy'))
 
         self.split_file = pjoin(opt.data_root, f'{split}.txt')
+        # built by data_loaders/humanml/scripts/pack_dataset.py
+        packed_dir = packed_split_dir(opt.data_root, split)
+        if not (use_packed and os.path.isdir(packed_dir)):
+            packed_dir = None
+        elif not is_current(pjoin(packed_dir, TEXT_ONLY_FILE if mode == 'text_only' else CLIPS_FILE),
+                            source_digest(self.split_file, opt.motion_dir, opt.text_dir)):
+            print(f'[{packed_dir}] was packed from other sources, reading the per-clip files instead. '
+                  f'Rerun data_loaders/humanml/scripts/pack_dataset.py to update it.')
+            packed_dir = None
         if mode == 'text_only':
-            self.t2m_dataset = TextOnlyDataset(self.opt, self.mean, self.std, self.split_file)
+            self.t2m_dataset = TextOnlyDataset(self.opt, self.mean, self.std, self.split_file, packed_dir)
         else:
             self.w_vectorizer = WordVectorizer(pjoin(abs_base_path, 'glove'), 'our_vab')
-            self.t2m_dataset = Text2MotionDatasetV2(self.opt, self.mean, self.std, self.split_file, self.w_vectorizer)
+            self.t2m_dataset = Text2MotionDatasetV2(self.opt, self.mean, self.std, self.split_file, self.w_vectorizer,
+                                                    packed_dir)
             self.num_actions = 1 # dummy placeholder
 
         assert len(self.t2m_dataset) > 1, 'You loaded an empty dataset, ' \
@@ -0,0 +1,193 @@
+"""
+Packed, memory-mapped copies of the HumanML3D / KIT splits.
+
+data_loaders/humanml/scripts/pack_dataset.py writes, for every split, a
+directory <data_root>/packed/<split>/ holding:
+- motions.npy: a float32 [total_frames x D] array with every source clip once;
+- clips.npz: the Text2MotionDatasetV2 entries (name, key, frame offset and
+  length into motions.npy), in the dataset's sorted order, and their captions;
+- text_only.npz: the TextOnlyDataset entries and their captions.
+
+Captions are stored as one flat utf-8 table (caption, space joined tokens)
+with per-entry row offsets. Both index files also hold the source_digest() of
+the split file and the motion and text directories they were packed from.
+HumanML3D opens the archive instead of reading one .npy and one .txt per clip
+when the directory exists and its digest still matches the sources.
+"""
+
+import hashlib
+import json
+import os
+from collections.abc import Mapping
+from os.path import join as pjoin
+
+import numpy as np
+
+CLIPS_FILE = 'clips.npz'
+MOTIONS_FILE = 'motions.npy'
+TEXT_ONLY_FILE = 'text_only.npz'
+
+
+def packed_split_dir(data_root, split):
+    return pjoin(data_root, 'packed', split)
+
+
+def source_digest(split_file, motion_dir, text_dir):
+    """
+    :return: a sha1 hex digest of the split file contents and of the (name,
+             size, mtime) listing of the motion and text directories.
+    """
+    sha = hashlib.sha1()
+    with open(split_file, 'rb') as f:
+        sha.update(f.read())
+    for directory in (motion_dir, text_dir):
+        listing = []
+        for entry in os.scandir(directory):
+            stat = entry.stat()
+            listing.append((entry.name, stat.st_size, stat.st_mtime_ns))
+        sha.update(json.dumps(sorted(listing)).encode())
+    return sha.hexdigest()
+
+
+def is_current(index_path, digest):
+    """
+    :return: whether the index file exists and was packed from sources with `digest`.
+    """
+    if not os.path.isfile(index_path):
+        return False
+    with np.load(index_path) as index:
+        return 'source_digest' in index.files and str(index['source_digest']) == digest
+
+
+def pack_strings(strings):
+    """
+    :return: the utf-8 bytes of all strings as one uint8 array and [N + 1] offsets into it.
+    """
+    encoded = [string.encode('utf-8') for string in strings]
+    offsets = np.concatenate([[0], np.cumsum([len(b) for b in encoded])]).astype(np.int64)
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def unpack_string(buffer, offsets, i):
+    return buffer[offsets[i]:offsets[i + 1]].tobytes().decode('utf-8')
+
+
+def text_table(text_lists):
+    """
+    Flatten per-entry lists of {'caption', 'tokens'} dicts.
+
+    :return: a dict of arrays: text_offsets [N + 1] into the caption rows, and
+             the captions and space joined tokens packed by pack_strings().
+    """
+    counts = [len(text_list) for text_list in text_lists]
+    texts = [text_dict for text_list in text_lists for text_dict in text_list]
+    captions, caption_offsets = pack_strings([text_dict['caption'] for text_dict in texts])
+    tokens, token_offsets = pack_strings([' '.join(text_dict['tokens']) for text_dict in texts])
+    return {
+        'text_offsets': np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+        'captions': captions, 'caption_offsets': caption_offsets,
+        'tokens': tokens, 'token_offsets': token_offsets,
+    }
+
+
+def save_clips(path, names, keys, data_dict, motions_path, digest):
+    """
+    Pack the entries of a Text2MotionDatasetV2 (in `names` order).
+
+    Sub-clips (keys 'name#start#end') point into their source clip, so every
+    source motion is stored once. Source clips are reloaded from `motions_path`
+    (the dataset's motion_dir).
+
+    :param digest: the source_digest() of the split, checked when it is reopened.
+    """
+    sources, offsets, total = {}, [], 0
+    for key in keys:
+        source, *interval = key.split('#')
+        start = int(interval[0]) if interval else 0
+        if source not in sources:
+            motion = np.load(pjoin(motions_path, source + '.npy'), mmap_mode='r')
+            sources[source] = total
+            total += len(motion)
+        offsets.append(sources[source] + start)
+    os.makedirs(path, exist_ok=True)
+    # filled source by source so the split never has to fit in memory
+    packed = np.lib.format.open_memmap(pjoin(path, MOTIONS_FILE), mode='w+', dtype=np.float32,
+                                       shape=(total, motion.shape[1]))
+    for source, offset in sources.items():
+        motion = np.load(pjoin(motions_path, source + '.npy'))
+        packed[offset:offset + len(motion)] = motion
+    packed.flush()
+    del packed
+    np.savez(pjoin(path, CLIPS_FILE),
+             names=np.array(names, dtype=str),
+             keys=np.array(keys, dtype=str),
+             offsets=np.array(offsets, dtype=np.int64),
+             lengths=np.array([data_dict[name]['length'] for name in names], dtype=np.int64),
+             source_digest=np.array(digest),
+             **text_table([data_dict[name]['text'] for name in names]))
+
+
+def save_text_only(path, names, data_dict, digest):
+    os.makedirs(path, exist_ok=True)
+    np.savez(pjoin(path, TEXT_ONLY_FILE), names=np.array(names, dtype=str), source_digest=np.array(digest),
+             **text_table([data_dict[name]['text'] for name in names]))
+
+
+class PackedClips(Mapping):
+    """
+    A read-only, data_dict-like view of a packed split: name -> {'motion',
+    'length', 'text', 'key'} (or just {'text'} without motions).
+
+    Entries are built on access. Motions are slices of a memory map, which is
+    reopened after unpickling so that DataLoader workers share its pages
+    instead of receiving a copy.
+
+    :param index_path: clips.npz or text_only.npz.
+    :param motions_path: motions.npy, or None for a text only split.
+    """
+
+    def __init__(self, index_path, motions_path=None):
+        index = np.load(index_path)
+        self.names = index['names'].tolist()
+        self.text_offsets = index['text_offsets']
+        self.captions, self.caption_offsets = index['captions'], index['caption_offsets']
+        self.tokens, self.token_offsets = index['tokens'], index['token_offsets']
+        self.motions_path = motions_path
+        if motions_path is not None:
+            self.keys = index['keys']
+            self.offsets = index['offsets']
+            self.lengths = index['lengths']
+        self._rows = {name: row for row, name in enumerate(self.names)}
+        self._motions = None
+
+    @property
+    def motions(self):
+        if self._motions is None:
+            self._motions = np.load(self.motions_path, mmap_mode='r')
+        return self._motions
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_motions'] = None
+        return state
+
+    def text(self, row):
+        return [{'caption': unpack_string(self.captions, self.caption_offsets, i),
+                 'tokens': unpack_string(self.tokens, self.token_offsets, i).split(' ')}
+                for i in range(self.text_offsets[row], self.text_offsets[row + 1])]
+
+    def __getitem__(self, name):
+        row = self._rows[name]
+        if self.motions_path is None:
+            return {'text': self.text(row)}
+        offset, length = self.offsets[row], int(self.lengths[row])
+        return {'motion': self.motions[offset:offset + length],
+                'length': length,
+                'text': self.text(row),
+                'key': str(self.keys[row])}
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
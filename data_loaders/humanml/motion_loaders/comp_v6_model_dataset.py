@@ -10,6 +10,10 @@ import pickle as pkl
 import data_loaders.humanml.utils.paramUtil as paramUtil
 from data_loaders.humanml.utils.plot_script import plot_3d_motion
 from lpm.model import LengthPredctionUnet
+from lpm.length_index import load_length_module, predict_length_idx
+from diffusion.gp_kernel import KernelOperator
+from diffusion.kernel_store import load_kernel_bag
+from utils.fixseed import fixseed
 
 def build_models(opt):
     if opt.text_enc_mod == 'bigru':
@@ -122,6 +126,9 @@ class CompV6GeneratedDataset(Dataset):
         self.mm_generated_motion = mm_generated_motions
         self.opt = opt
         self.w_vectorizer = w_vectorizer
+        # tokens are fixed per sample, encode them once
+        for data in self.generated_motion:
+            data['word_ids'], data['pos_ids'] = w_vectorizer.encode(data['tokens'])
 
 
     def __len__(self):
@@ -133,14 +140,7 @@ class CompV6GeneratedDataset(Dataset):
         motion, m_length, caption, tokens = data['motion'], data['length'], data['caption'], data['tokens']
         sent_len = data['cap_len']
 
-        pos_one_hots = []
-        word_embeddings = []
-        for token in tokens:
-            word_emb, pos_oh = self.w_vectorizer[token]
-            pos_one_hots.append(pos_oh[None, :])
-            word_embeddings.append(word_emb[None, :])
-        pos_one_hots = np.concatenate(pos_one_hots, axis=0)
-        word_embeddings = np.concatenate(word_embeddings, axis=0)
+        word_embeddings, pos_one_hots = self.w_vectorizer.lookup(data['word_ids'], data['pos_ids'])
 
         if m_length < self.opt.max_motion_length:
             motion = np.concatenate([motion,
@@ -151,22 +151,26 @@ class CompV6GeneratedDataset(Dataset):
 class CompMDMGeneratedDataset(Dataset):
 
     def __init__(self, model, diffusion, dataloader, mm_num_samples, mm_num_repeats, 
-                 max_motion_length, num_samples_limit, scale=1., len_param=None):
+                 max_motion_length, num_samples_limit, scale=1., len_param=None, sample_fn=None,
+                 cache=None, replication=0, rank=0, world_size=1):
         self.dataloader = dataloader
         self.dataset = dataloader.dataset
         assert mm_num_samples < len(dataloader.dataset)
-        use_ddim = False  # FIXME - hardcoded
         clip_denoised = False  # FIXME - hardcoded
         self.max_motion_length = max_motion_length
-        sample_fn = (
-            diffusion.p_sample_loop if not use_ddim else diffusion.ddim_sample_loop
-        )
+        if sample_fn is None:
+            sample_fn = diffusion.p_sample_loop  # see utils.model_util.get_sample_fn
 
         real_num_batches = len(dataloader)
         if num_samples_limit is not None:
             real_num_batches = num_samples_limit // dataloader.batch_size + 1
         print('real_num_batches', real_num_batches)
 
+        assert world_size == 1 or cache is not None, 'sharded generation hands its batches over through a cache'
+        if cache is not None:
+            # replications (and below, batches) are seeded apart so that cached ones can be skipped
+            fixseed(cache.seed(replication))
+
         generated_motion = []
         mm_generated_motions = []
         if mm_num_samples > 0:
@@ -178,37 +182,13 @@ class CompMDMGeneratedDataset(Dataset):
 
         model.eval()
 
-        with open('./HumanML3D_K_param_data196_fps20_dim263_len10.pkl', 'rb') as f : 
-            param_lenK = pkl.load(f)    
-            num_len = len(param_lenK['K_param'])
-            K_param = torch.Tensor(param_lenK['K_param']).to(dist_util.dev())
-            K_template = param_lenK['template']
-            K_template = torch.Tensor(K_template).repeat(dataloader.batch_size,1,1,1)
+        param_lenK = load_kernel_bag('./HumanML3D_K_param_data196_fps20_dim263_len10.pkl')
+        num_len = len(param_lenK['K_param'])
+        K_param = param_lenK['K_param'].to(dist_util.dev())
+        K_zeros = torch.zeros_like(K_param[0])
     
-        length_module = LengthPredctionUnet(
-            name                 = 'unet',
-            dims                 = 1,
-            n_in_channels        = 1,
-            n_base_channels      = 128,
-            n_emb_dim            = 128,
-            n_cond_dim           = 1,
-            n_time_dim           = 0,
-            n_enc_blocks         = 7, # number of encoder blocks
-            n_groups             = 16, # group norm paramter
-            n_heads              = 4, # number of heads in QKV attention
-            actv                 = nn.SiLU(),
-            kernel_size          = 3, # kernel size (3)
-            padding              = 1, # padding size (1)
-            use_attention        = False,
-            skip_connection      = True, # additional skip connection
-            chnnel_multiples     = [1,2,2,2,4,4,8],
-            updown_rates         = [1,1,2,1,2,1,2],
-            use_scale_shift_norm = True,
-            device               = dist_util.dev(),
-        ) # input:[B x C x L] => output:[B x C x L]
-        length_module.load_state_dict(torch.load('./final_lpm.pt')['model_state_dict'])
-        length_module.to(dist_util.dev())
-        length_module.eval()
+        # only needed when the loader carries no offline length-scale annotations
+        length_module = None
         
         cls_value = torch.Tensor(
             [0.033     , 0.14044444, 
@@ -219,101 +199,114 @@ class CompMDMGeneratedDataset(Dataset):
         
         with torch.no_grad():
             for i, (motion, model_kwargs) in tqdm(enumerate(dataloader), total=len(dataloader)):
-                B, D, _, L = motion.shape
-                input_motion = motion[:, 1:3, :, :].to(dist_util.dev())
-                B_, D_, _, L_ = input_motion.shape
-                input_motion = input_motion.reshape(B_ * D_, 1, L_)
-                true_length = model_kwargs['y']['lengths'].repeat_interleave(D_).to(dist_util.dev(), dtype=torch.float)
-                
-                with torch.no_grad():
-                    output = length_module(input_motion, c=true_length)
-                _, pred_idx = torch.max(output.data, 1)
-                len_param = cls_value[pred_idx]
-                len_param = len_param.reshape(B_, D_)
-                pred_idx = pred_idx.reshape(B_, D_)
-                
-                eval_K_params = torch.zeros((dataloader.batch_size,263,196,196)).to(dist_util.dev())
-                eval_K_params[:,1:3] = K_param[pred_idx]
-                
-                eval_len_param = torch.ones([B, D]).to(dist_util.dev()) * 0.033
-                eval_len_param[:,1:3] = len_param
-            
-                if num_samples_limit is not None and len(generated_motion) >= num_samples_limit:
+                # every batch adds batch_size samples
+                if num_samples_limit is not None and i * dataloader.batch_size >= num_samples_limit:
                     break
+                if i % world_size != rank:
+                    continue  # sampled by another worker (see sharded_generation.py)
 
-                tokens = [t.split('_') for t in model_kwargs['y']['tokens']]
-
-                # add CFG scale to batch
-                if scale != 1.:
-                    model_kwargs['y']['scale'] = torch.ones(motion.shape[0],
-                                                            device=dist_util.dev()) * scale
-
-                mm_num_now = len(mm_generated_motions) // dataloader.batch_size
                 is_mm = i in mm_idxs
-                repeat_times = mm_num_repeats if is_mm else 1
-                mm_motions = []
-
-                for t in range(repeat_times):
-
-                    sample = sample_fn(
-                        model,
-                        motion.shape,
-                        eval_K_params,
-                        eval_len_param,
-                        clip_denoised=clip_denoised,
-                        model_kwargs=model_kwargs,
-                        skip_timesteps=0,  # 0 is the default value - i.e. don't skip any step
-                        init_image=None,
-                        progress=False,
-                        dump_steps=None,
-                        noise=None,
-                        const_noise=False,
-                        # when experimenting guidance_scale we want to nutrileze the effect of noise on generation
-                    )
-
-                    # n_joints = 22 if sample.shape[1] == 263 else 21
-                    # sample = dataloader.dataset.t2m_dataset.inv_transform(sample.cpu().permute(0, 2, 3, 1)).float()
-                    # sample = recover_from_ric(sample, n_joints)
-                    # sample = sample.view(-1, *sample.shape[2:]).permute(0, 2, 3, 1)
-
-                    # rot2xyz_pose_rep = 'xyz' if  model.data_rep in ['xyz', 'hml_vec'] else model.data_rep
-                    # rot2xyz_mask = None if rot2xyz_pose_rep == 'xyz' else model_kwargs['y']['mask'].reshape(1, 196).bool()
-                    # sample = model.rot2xyz(x=sample, mask=rot2xyz_mask, pose_rep=rot2xyz_pose_rep, glob=True, translation=True,
-                    #                     jointstype='smpl', vertstrans=True, betas=None, beta=0, glob_rot=None,
-                    #                     get_rotations_back=False)
-                    # skeleton = paramUtil.t2m_kinematic_chain
-                    # import ipdb;ipdb.set_trace()
-                    # plot_3d_motion('result.gif', skeleton, sample[0].cpu().numpy().transpose(2, 0, 1), dataset='humanml', title='sample', fps=20)
-
-                    if t == 0:
-                        sub_dicts = [{
-                            'motion': sample[bs_i].squeeze().permute(1, 0).cpu().numpy(),
-                            'length': model_kwargs['y']['lengths'][bs_i].cpu().numpy(),
-                            'caption': model_kwargs['y']['text'][bs_i],
-                            'tokens': tokens[bs_i],
-                            # Fixed cap_len calculation, changed from len(tokens[bs_i])
-                            # Lead to improved R-precision and Multimodal Dist.
-                            # issue: https://github.com/GuyTevet/motion-diffusion-model/issues/182
-                            'cap_len': tokens[bs_i].index('eos/OTHER') + 1, 
-                            } for bs_i in range(dataloader.batch_size)]
-                        generated_motion += sub_dicts
-
+                shard = cache.load(replication, i) if cache is not None else None
+                if shard is None:
+                    if cache is not None:
+                        fixseed(cache.seed(replication, i))
+                    B, D, _, L = motion.shape
+                    if 'length_idx' in model_kwargs['y']:
+                        pred_idx = model_kwargs['y']['length_idx'][:, 1:3].to(dist_util.dev()).long()
+                    else:
+                        if length_module is None:
+                            length_module = load_length_module(dist_util.dev(), './final_lpm.pt')
+                        pred_idx = predict_length_idx(length_module, motion.to(dist_util.dev()),
+                                                      model_kwargs['y']['lengths'], [1, 2])
+                    len_param = cls_value[pred_idx]
+
+                    eval_K_params = KernelOperator.from_classes(K_param, K_zeros, pred_idx, [1, 2], D)
+
+                    eval_len_param = torch.ones([B, D]).to(dist_util.dev()) * 0.033
+                    eval_len_param[:,1:3] = len_param
+
+                    # add CFG scale to batch
+                    if scale != 1.:
+                        model_kwargs['y']['scale'] = torch.ones(motion.shape[0],
+                                                                device=dist_util.dev()) * scale
+
+                    repeat_times = mm_num_repeats if is_mm else 1
+                    mm_motions = []
+
+                    for t in range(repeat_times):
+
+                        sample = sample_fn(
+                            model,
+                            motion.shape,
+                            eval_K_params,
+                            eval_len_param,
+                            clip_denoised=clip_denoised,
+                            model_kwargs=model_kwargs,
+                            skip_timesteps=0,  # 0 is the default value - i.e. don't skip any step
+                            init_image=None,
+                            progress=False,
+                            dump_steps=None,
+                            noise=None,
+                            const_noise=False,
+                            # when experimenting guidance_scale we want to nutrileze the effect of noise on generation
+                        )
+
+                        # n_joints = 22 if sample.shape[1] == 263 else 21
+                        # sample = dataloader.dataset.t2m_dataset.inv_transform(sample.cpu().permute(0, 2, 3, 1)).float()
+                        # sample = recover_from_ric(sample, n_joints)
+                        # sample = sample.view(-1, *sample.shape[2:]).permute(0, 2, 3, 1)
+
+                        # rot2xyz_pose_rep = 'xyz' if  model.data_rep in ['xyz', 'hml_vec'] else model.data_rep
+                        # rot2xyz_mask = None if rot2xyz_pose_rep == 'xyz' else model_kwargs['y']['mask'].reshape(1, 196).bool()
+                        # sample = model.rot2xyz(x=sample, mask=rot2xyz_mask, pose_rep=rot2xyz_pose_rep, glob=True, translation=True,
+                        #                     jointstype='smpl', vertstrans=True, betas=None, beta=0, glob_rot=None,
+                        #                     get_rotations_back=False)
+                        # skeleton = paramUtil.t2m_kinematic_chain
+                        # import ipdb;ipdb.set_trace()
+                        # plot_3d_motion('result.gif', skeleton, sample[0].cpu().numpy().transpose(2, 0, 1), dataset='humanml', title='sample', fps=20)
+
+                        mm_motions.append(sample.squeeze(2).permute(0, 2, 1).cpu().numpy())  # [B, L, D]
+
+                    shard = {
+                        'motion': mm_motions[0],
+                        'length': model_kwargs['y']['lengths'].cpu().numpy(),
+                        'caption': list(model_kwargs['y']['text']),
+                        'tokens': list(model_kwargs['y']['tokens']),
+                    }
                     if is_mm:
-                        mm_motions += [{'motion': sample[bs_i].squeeze().permute(1, 0).cpu().numpy(),
-                                        'length': model_kwargs['y']['lengths'][bs_i].cpu().numpy(),
-                                        } for bs_i in range(dataloader.batch_size)]
+                        shard['mm_motion'] = np.stack(mm_motions)
+                    if cache is not None:
+                        cache.save(replication, i, shard)
+
+                tokens = [t.split('_') for t in shard['tokens']]
+                generated_motion += [{
+                    'motion': shard['motion'][bs_i],
+                    'length': shard['length'][bs_i],
+                    'caption': shard['caption'][bs_i],
+                    'tokens': tokens[bs_i],
+                    # Fixed cap_len calculation, changed from len(tokens[bs_i])
+                    # Lead to improved R-precision and Multimodal Dist.
+                    # issue: https://github.com/GuyTevet/motion-diffusion-model/issues/182
+                    'cap_len': tokens[bs_i].index('eos/OTHER') + 1,
+                    } for bs_i in range(dataloader.batch_size)]
+
                 if is_mm:
                     mm_generated_motions += [{
-                                    'caption': model_kwargs['y']['text'][bs_i],
+                                    'caption': shard['caption'][bs_i],
                                     'tokens': tokens[bs_i],
                                     'cap_len': len(tokens[bs_i]),
-                                    'mm_motions': mm_motions[bs_i::dataloader.batch_size],  # collect all 10 repeats from the (32*10) generated motions
+                                    'mm_motions': [{'motion': mm_motion[bs_i], 'length': shard['length'][bs_i]}
+                                                   for mm_motion in shard['mm_motion']],  # all repeats of this sample
                                     } for bs_i in range(dataloader.batch_size)]
 
 
         self.generated_motion = generated_motion
         self.mm_generated_motion = mm_generated_motions
         self.w_vectorizer = dataloader.dataset.w_vectorizer
+        self.return_token_ids = self.dataset.t2m_dataset.return_token_ids
+        # tokens are fixed per sample, encode them once
+        for data in self.generated_motion:
+            data['word_ids'], data['pos_ids'] = self.w_vectorizer.encode(data['tokens'])
 
 
     def __len__(self):
@@ -332,13 +325,9 @@ class CompMDMGeneratedDataset(Dataset):
             motion = renormed_motion
             # This step is needed because T2M evaluators expect their norm convention
 
-        pos_one_hots = []
-        word_embeddings = []
-        for token in tokens:
-            word_emb, pos_oh = self.w_vectorizer[token]
-            pos_one_hots.append(pos_oh[None, :])
-            word_embeddings.append(word_emb[None, :])
-        pos_one_hots = np.concatenate(pos_one_hots, axis=0)
-        word_embeddings = np.concatenate(word_embeddings, axis=0)
+        if self.return_token_ids:
+            word_embeddings, pos_one_hots = data['word_ids'], data['pos_ids']
+        else:
+            word_embeddings, pos_one_hots = self.w_vectorizer.lookup(data['word_ids'], data['pos_ids'])
 
         return word_embeddings, pos_one_hots, caption, sent_len, motion, m_length, '_'.join(tokens)
\ No newline at end of file
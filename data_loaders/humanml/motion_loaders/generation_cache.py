@@ -0,0 +1,119 @@
+"""
+Resumable on-disk cache of the motions CompMDMGeneratedDataset generates.
+
+A cache root holds one directory per generation config (model checkpoint,
+guidance scale, seed, sampler, ...), <root>/<config key>/, with:
+- rep<r>/batch<i>.npz: the samples of batch i of replication r (motions,
+  lengths, captions, tokens and, for multimodality batches, all repeats);
+- manifest.json: the config and the completed shards (plus, while
+  sharded_generation.py runs, one manifest.rank<k>.json per worker).
+
+Each shard is written, then recorded in the manifest, as soon as its batch
+is sampled. A crashed or re-run evaluation only samples the batches that are
+missing, and the stored samples can be evaluated again with another
+evaluator. Every replication and batch draws from its own seed (seed()) so a
+batch does not depend on which of the earlier ones came from the cache.
+"""
+
+import copy
+import glob
+import hashlib
+import json
+import os
+from os.path import join as pjoin
+
+import numpy as np
+
+MANIFEST_FILE = 'manifest.json'
+
+
+def config_key(config):
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+
+
+class GenerationCache:
+    """
+    :param root: cache root directory.
+    :param config: json serializable generation settings; `seed` is required,
+                   together they select the cache directory.
+    """
+
+    def __init__(self, root, **config):
+        self.config = config
+        self.path = pjoin(root, config_key(config))
+        self.manifest_file = MANIFEST_FILE
+        self.reload()
+
+    def reload(self):
+        """
+        Read the completed shards from all manifests, including those of workers.
+        """
+        self.shards = {}
+        for manifest_path in sorted(glob.glob(pjoin(self.path, 'manifest*.json'))):
+            with open(manifest_path) as f:
+                self.shards.update(json.load(f)['shards'])
+
+    def for_worker(self, rank):
+        """
+        :return: a copy that records its shards in its own manifest, so that
+                 workers never write the same file.
+        """
+        cache = copy.copy(self)
+        cache.shards = dict(self.shards)
+        cache.manifest_file = f'manifest.rank{rank}.json'
+        return cache
+
+    def consolidate(self):
+        """
+        Fold the worker manifests into manifest.json.
+        """
+        worker_manifests = glob.glob(pjoin(self.path, 'manifest.rank*.json'))
+        self.reload()
+        if worker_manifests:
+            self._write_manifest()
+            for manifest_path in worker_manifests:
+                os.remove(manifest_path)
+
+    def seed(self, replication, batch=None):
+        entropy = [self.config['seed'], replication] + ([] if batch is None else [batch])
+        return int(np.random.SeedSequence(entropy).generate_state(1)[0])
+
+    @staticmethod
+    def shard_name(replication, batch):
+        return f'rep{replication:02d}/batch{batch:04d}.npz'
+
+    def load(self, replication, batch):
+        """
+        :return: the dict save() stored for the batch, or None if it was not generated yet.
+        """
+        name = self.shard_name(replication, batch)
+        if name not in self.shards:
+            return None
+        data = np.load(pjoin(self.path, name))
+        shard = {'motion': data['motion'], 'length': data['length'],
+                 'caption': data['caption'].tolist(), 'tokens': data['tokens'].tolist()}
+        if 'mm_motion' in data:
+            shard['mm_motion'] = data['mm_motion']
+        return shard
+
+    def save(self, replication, batch, shard):
+        """
+        :param shard: 'motion' [B x L x D], 'length' [B], 'caption' and
+                      'tokens' ('_' joined) lists of B strings and optionally
+                      'mm_motion' [repeats x B x L x D].
+        """
+        name = self.shard_name(replication, batch)
+        path = pjoin(self.path, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        arrays = dict(shard, caption=np.array(shard['caption'], dtype=str),
+                      tokens=np.array(shard['tokens'], dtype=str))
+        np.savez(path + '.tmp.npz', **arrays)
+        os.replace(path + '.tmp.npz', path)
+        self.shards[name] = {'replication': replication, 'batch': batch, 'samples': len(shard['length'])}
+        self._write_manifest()
+
+    def _write_manifest(self):
+        manifest_path = pjoin(self.path, self.manifest_file)
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump({'config': self.config, 'shards': self.shards}, f, indent=1, sort_keys=True)
+        os.replace(manifest_path + '.tmp', manifest_path)
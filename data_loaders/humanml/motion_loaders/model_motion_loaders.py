@@ -1,6 +1,7 @@
 from torch.utils.data import DataLoader, Dataset
 from data_loaders.humanml.utils.get_opt import get_opt
 from data_loaders.humanml.motion_loaders.comp_v6_model_dataset import CompMDMGeneratedDataset
+from data_loaders.humanml.motion_loaders.sharded_generation import generate_sharded
 from data_loaders.humanml.utils.word_vectorizer import WordVectorizer
 import numpy as np
 from torch.utils.data._utils.collate import default_collate
@@ -74,15 +75,21 @@ def get_motion_loader(opt_path, batch_size, ground_truth_dataset, mm_num_samples
 # our loader
 def get_mdm_loader(model, diffusion, batch_size, ground_truth_loader, 
                    mm_num_samples, mm_num_repeats, max_motion_length, 
-                   num_samples_limit, scale):
+                   num_samples_limit, scale, sample_fn=None, cache=None, replication=0, world_size=1):
     opt = {
         'name': 'test',  # FIXME
     }
     print('Generating %s ...' % opt['name'])
     # dataset = CompMDMGeneratedDataset(opt, ground_truth_dataset, ground_truth_dataset.w_vectorizer, mm_num_samples, mm_num_repeats)
+    if world_size > 1:
+        # the workers fill the cache, the dataset below is then read from it
+        generate_sharded(world_size, cache, model, diffusion, ground_truth_loader,
+                         mm_num_samples, mm_num_repeats, max_motion_length,
+                         num_samples_limit, scale, sample_fn=sample_fn, replication=replication)
     dataset = CompMDMGeneratedDataset(model, diffusion, ground_truth_loader, 
                                       mm_num_samples, mm_num_repeats, max_motion_length, 
-                                      num_samples_limit, scale)
+                                      num_samples_limit, scale, sample_fn=sample_fn,
+                                      cache=cache, replication=replication)
 
     mm_dataset = MMGeneratedDataset(opt, dataset, ground_truth_loader.dataset.w_vectorizer)
 
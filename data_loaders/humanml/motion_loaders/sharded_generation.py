@@ -0,0 +1,65 @@
+"""
+Multi-process generation of the eval motions.
+
+generate_sharded() splits the batches CompMDMGeneratedDataset samples across
+`world_size` spawned processes. Worker k samples batches k, k + N, k + 2N, ...
+on its own GPU (on CPU, with its share of the threads) and writes them to
+the GenerationCache under its own manifest. The parent then builds the
+dataset from the cache in batch order. Every batch is seeded from (seed,
+replication, batch) (see GenerationCache.seed()), so the samples are the same
+as those of a single-process run with the same seed.
+
+Workers receive the model, diffusion, loader and sample_fn by pickling, so
+sample_fn must be picklable (the samplers of utils.model_util.get_sample_fn
+are, except --compiled_step). A packed dataset (pack_dataset.py) pickles
+without its motions, otherwise every worker gets a copy of them.
+"""
+
+import torch
+import torch.multiprocessing as mp
+
+from data_loaders.humanml.motion_loaders.comp_v6_model_dataset import CompMDMGeneratedDataset
+from utils import dist_util
+
+
+def worker_devices(world_size):
+    """
+    :return: the device index of every worker: GPUs round-robin, or -1 (CPU)
+             when the evaluation does not run on a GPU.
+    """
+    if dist_util.dev().type == 'cuda':
+        return [rank % torch.cuda.device_count() for rank in range(world_size)]
+    return [-1] * world_size
+
+
+def _generate_shard(rank, world_size, device, num_threads, cache, dataset_args, dataset_kwargs):
+    dist_util.setup_dist(device)
+    torch.set_num_threads(num_threads)
+    model = dataset_args[0].to(dist_util.dev())
+    CompMDMGeneratedDataset(model, *dataset_args[1:], cache=cache.for_worker(rank),
+                            rank=rank, world_size=world_size, **dataset_kwargs)
+
+
+def generate_sharded(world_size, cache, model, diffusion, dataloader, mm_num_samples, mm_num_repeats,
+                     max_motion_length, num_samples_limit, scale, sample_fn=None, replication=0):
+    """
+    Sample the batches of one replication in `world_size` processes into
+    `cache` (arguments as in CompMDMGeneratedDataset). Returns once all
+    workers have finished and their shards are in cache's manifest.
+    """
+    dataset_args = (model, diffusion, dataloader, mm_num_samples, mm_num_repeats,
+                    max_motion_length, num_samples_limit, scale)
+    dataset_kwargs = {'sample_fn': sample_fn, 'replication': replication}
+    num_threads = max(1, torch.get_num_threads() // world_size)
+    ctx = mp.get_context('spawn')  # workers may initialize CUDA
+    workers = [ctx.Process(target=_generate_shard,
+                           args=(rank, world_size, device, num_threads, cache, dataset_args, dataset_kwargs))
+               for rank, device in enumerate(worker_devices(world_size))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    cache.consolidate()
+    failed = [rank for rank, worker in enumerate(workers) if worker.exitcode != 0]
+    if failed:
+        raise RuntimeError(f'Generation workers {failed} failed, the batches they finished are kept in [{cache.path}]')
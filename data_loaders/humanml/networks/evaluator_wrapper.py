@@ -92,6 +92,13 @@ class EvaluatorModelWrapper(object):
         return motion_embedding
 
 # our version
+def evaluator_checkpoint_path(opt):
+    ckpt_dir = opt['dataset_name']
+    if opt['dataset_name'] == 'humanml':
+        ckpt_dir = 't2m'
+    return pjoin(opt['checkpoints_dir'], ckpt_dir, 'text_mot_match', 'model', 'finest.tar')
+
+
 def build_evaluators(opt):
     movement_enc = MovementConvEncoder(opt['dim_pose']-4, opt['dim_movement_enc_hidden'], opt['dim_movement_latent'])
     text_enc = TextEncoderBiGRUCo(word_size=opt['dim_word'],
@@ -105,22 +112,32 @@ def build_evaluators(opt):
                                       output_size=opt['dim_coemb_hidden'],
                                       device=opt['device'])
 
-    ckpt_dir = opt['dataset_name']
-    if opt['dataset_name'] == 'humanml':
-        ckpt_dir = 't2m'
-
-    checkpoint = torch.load(pjoin(opt['checkpoints_dir'], ckpt_dir, 'text_mot_match', 'model', 'finest.tar'),
-                            map_location=opt['device'])
+    checkpoint = torch.load(evaluator_checkpoint_path(opt), map_location=opt['device'])
     movement_enc.load_state_dict(checkpoint['movement_encoder'])
     text_enc.load_state_dict(checkpoint['text_encoder'])
     motion_enc.load_state_dict(checkpoint['motion_encoder'])
     print('Loading Evaluation Model Wrapper (Epoch %d) Completed!!' % (checkpoint['epoch']))
     return text_enc, motion_enc, movement_enc
 
+
+class TokenFeatures(nn.Module):
+    """
+    GloVe lookup and POS one-hot of [B x T] word / POS id batches (see
+    WordVectorizer.encode()) from buffers on the evaluator's device.
+    """
+    def __init__(self, vectors, num_pos):
+        super(TokenFeatures, self).__init__()
+        self.register_buffer('vectors', torch.as_tensor(vectors, dtype=torch.float))
+        self.register_buffer('pos_ohot', torch.eye(num_pos))
+
+    def forward(self, word_ids, pos_ids):
+        return self.vectors[word_ids], self.pos_ohot[pos_ids]
+
+
 # our wrapper
 class EvaluatorMDMWrapper(object):
 
-    def __init__(self, dataset_name, device):
+    def __init__(self, dataset_name, device, w_vectorizer=None):
         opt = {
             'dataset_name': dataset_name,
             'device': device,
@@ -139,6 +156,7 @@ class EvaluatorMDMWrapper(object):
         }
 
         self.text_encoder, self.motion_encoder, self.movement_encoder = build_evaluators(opt)
+        self.checkpoint_path = evaluator_checkpoint_path(opt)
         self.opt = opt
         self.device = opt['device']
 
@@ -150,11 +168,25 @@ class EvaluatorMDMWrapper(object):
         self.motion_encoder.eval()
         self.movement_encoder.eval()
 
+        # accepts token ids (datasets with return_token_ids set) instead of word embeddings and POS one-hots
+        self.token_features = None
+        if w_vectorizer is not None:
+            self.token_features = TokenFeatures(w_vectorizer.vectors, len(POS_enumerator)).to(opt['device'])
+
     # Please note that the results does not following the order of inputs
     def get_co_embeddings(self, word_embs, pos_ohot, cap_lens, motions, m_lens):
+        """
+        word_embs / pos_ohot are either [B x T x 300] word embeddings and
+        [B x T x n_pos] POS one-hots, or (integer tensors) [B x T] word and POS
+        ids that are featurized on the device, which needs w_vectorizer.
+        """
         with torch.no_grad():
-            word_embs = word_embs.detach().to(self.device).float()
-            pos_ohot = pos_ohot.detach().to(self.device).float()
+            if word_embs.is_floating_point():
+                word_embs = word_embs.detach().to(self.device).float()
+                pos_ohot = pos_ohot.detach().to(self.device).float()
+            else:
+                assert self.token_features is not None, 'token ids need an EvaluatorMDMWrapper with a w_vectorizer'
+                word_embs, pos_ohot = self.token_features(word_embs.to(self.device), pos_ohot.to(self.device))
             motions = motions.detach().to(self.device).float()
 
             align_idx = np.argsort(m_lens.data.tolist())[::-1].copy()
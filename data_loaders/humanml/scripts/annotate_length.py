@@ -0,0 +1,78 @@
+"""
+Offline length-scale annotation for HumanML3D.
+
+Runs the frozen length prediction model over every clip of
+Text2MotionDatasetV2, for all channels, and writes a uint8 [N x D] array of
+length-scale class ids to <data_root>/length_idx.npz. Training and eval pick
+it up with --len_idx_path instead of running the LPM at runtime.
+
+Usage:
+    python -m data_loaders.humanml.scripts.annotate_length --dataset humanml
+"""
+
+import os
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from data_loaders.get_data import get_dataset
+from lpm.length_index import LPM_PATH, load_length_module, predict_length_idx
+
+
+def annotate(dataset, length_module, device, batch_size=16):
+    """
+    :param dataset: a Text2MotionDatasetV2.
+    :return: (keys, ids) with ids a [len(keys) x D] uint8 array.
+    """
+    max_length = dataset.max_motion_length
+    unit_length = dataset.opt.unit_length
+    entries = list(dataset.data_dict.values())
+    keys, ids = [], []
+    for start in tqdm(range(0, len(entries), batch_size)):
+        batch, lengths = [], []
+        for data in entries[start:start + batch_size]:
+            # the same normalization, unit-length rounding and padding as __getitem__
+            m_length = min(data['length'], max_length) // unit_length * unit_length
+            motion = (data['motion'][:m_length] - dataset.mean) / dataset.std
+            motion = np.concatenate([motion, np.zeros((max_length - m_length, motion.shape[1]))], axis=0)
+            batch.append(motion.T[:, None])  # [D, 1, L]
+            lengths.append(m_length)
+            keys.append(data['key'])
+        motion = torch.tensor(np.stack(batch), dtype=torch.float, device=device)
+        channels = list(range(motion.shape[1]))
+        pred_idx = predict_length_idx(length_module, motion, torch.tensor(lengths), channels)
+        ids.append(pred_idx.cpu().numpy().astype(np.uint8))
+    return keys, np.concatenate(ids, axis=0)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--dataset", default='humanml', choices=['humanml', 'kit'], type=str)
+    parser.add_argument("--splits", default='train,val,test', type=str,
+                        help="Comma separated splits to annotate. All of them end up in one file.")
+    parser.add_argument("--lpm_path", default=LPM_PATH, type=str, help="Path to the length prediction model.")
+    parser.add_argument("--output", default='', type=str,
+                        help="Output .npz. If empty, writes length_idx.npz next to the motions.")
+    parser.add_argument("--batch_size", default=16, type=int, help="Clips per LPM pass (x D sequences).")
+    parser.add_argument("--device", default=0, type=int, help="Device id to use, -1 for cpu.")
+    args = parser.parse_args()
+
+    device = torch.device('cpu' if args.device < 0 or not torch.cuda.is_available() else f'cuda:{args.device}')
+    length_module = load_length_module(device, args.lpm_path)
+
+    annotations = {}
+    for split in args.splits.split(','):
+        dataset = get_dataset(args.dataset, None, split=split, hml_mode='train').t2m_dataset
+        keys, ids = annotate(dataset, length_module, device, args.batch_size)
+        annotations.update(zip(keys, ids))
+
+    output = args.output or os.path.join(dataset.opt.data_root, 'length_idx.npz')
+    keys = sorted(annotations)
+    np.savez(output, keys=np.array(keys), ids=np.stack([annotations[k] for k in keys]))
+    print(f'Wrote {len(keys)} annotated clips to [{os.path.abspath(output)}]')
+
+
+if __name__ == '__main__':
+    main()
@@ -429,6 +429,33 @@ def recover_from_ric(data, joints_num):
     positions = torch.cat([r_pos.unsqueeze(-2), positions], dim=-2)
 
     return positions
+
+
+class RICDecoder:
+    """
+    Decode normalized HumanML3D / KIT feature samples to joint positions
+    on the samples' own device: inv_transform + recover_from_ric + the
+    [B x J x 3 x L] layout rot2xyz(pose_rep='xyz') returns.
+
+    :param mean: the dataset feature mean (numpy or tensor).
+    :param std: the dataset feature std (numpy or tensor).
+    """
+
+    def __init__(self, mean, std):
+        self.mean = torch.as_tensor(mean, dtype=torch.float32)
+        self.std = torch.as_tensor(std, dtype=torch.float32)
+        self.joints_num = 22 if self.mean.shape[-1] == 263 else 21
+
+    def __call__(self, sample):
+        """
+        :param sample: a [B x D x 1 x L] tensor of model samples.
+        :return: a [B x J x 3 x L] tensor of joint positions.
+        """
+        if self.mean.device != sample.device:
+            self.mean, self.std = self.mean.to(sample.device), self.std.to(sample.device)
+        motion = sample.permute(0, 2, 3, 1).float() * self.std + self.mean  # [B x 1 x L x D]
+        joints = recover_from_ric(motion, self.joints_num)  # [B x 1 x L x J x 3]
+        return joints.view(-1, *joints.shape[2:]).permute(0, 2, 3, 1)
 '''
 For Text2Motion Dataset
 '''
@@ -0,0 +1,49 @@
+"""
+Pack the HumanML3D / KIT splits into memory-mapped archives.
+
+Reads every split once the slow way (one .npy and one .txt per clip) and
+writes <data_root>/packed/<split>/ (see data_loaders/humanml/data/packed.py).
+From then on HumanML3D opens the archive instead, so training, eval and
+sampling start without touching the per-clip files. When the split file,
+motions or texts change, HumanML3D falls back to the per-clip files until it
+is rerun.
+
+Usage:
+    python -m data_loaders.humanml.scripts.pack_dataset --dataset humanml
+"""
+
+import os
+import time
+from argparse import ArgumentParser
+
+from data_loaders.get_data import get_dataset_class
+from data_loaders.humanml.data.packed import packed_split_dir, save_clips, save_text_only, source_digest
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--dataset", default='humanml', choices=['humanml', 'kit'], type=str)
+    parser.add_argument("--splits", default='train,val,test', type=str, help="Comma separated splits to pack.")
+    args = parser.parse_args()
+
+    DATA = get_dataset_class(args.dataset)
+    for split in args.splits.split(','):
+        wrapper = DATA(mode='train', split=split, use_packed=False)
+        dataset = wrapper.t2m_dataset
+        output = packed_split_dir(dataset.opt.data_root, split)
+        digest = source_digest(wrapper.split_file, dataset.opt.motion_dir, dataset.opt.text_dir)
+        keys = [dataset.data_dict[name]['key'] for name in dataset.name_list]
+        save_clips(output, dataset.name_list, keys, dataset.data_dict, dataset.opt.motion_dir, digest)
+
+        text_only = DATA(mode='text_only', split=split, use_packed=False).t2m_dataset
+        save_text_only(output, text_only.name_list, text_only.data_dict, digest)
+        print(f'Packed {len(dataset.name_list)} clips and {len(text_only.name_list)} text only entries '
+              f'of [{split}] to [{os.path.abspath(output)}]')
+
+        start = time.time()
+        DATA(mode='train', split=split)
+        print(f'Reopening [{split}] from the archive took {time.time() - start:.2f} s')
+
+
+if __name__ == '__main__':
+    main()
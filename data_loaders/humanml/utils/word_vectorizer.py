@@ -44,37 +44,60 @@ VIP_dict = {
 
 
 class WordVectorizer(object):
+    """
+    GloVe embeddings and POS one-hots for 'word/POS' tokens.
+
+    The vocabulary is a contiguous [V x 300] matrix. encode() maps tokens to
+    (word id, POS id) arrays, memoized per token, and lookup() turns id
+    arrays into features with one gather each, so datasets can encode their
+    tokens once and featurize an item without a Python loop.
+    """
     def __init__(self, meta_root, prefix):
-        vectors = np.load(pjoin(meta_root, '%s_data.npy'%prefix))
+        self.vectors = np.load(pjoin(meta_root, '%s_data.npy'%prefix))
         words = pickle.load(open(pjoin(meta_root, '%s_words.pkl'%prefix), 'rb'))
         word2idx = pickle.load(open(pjoin(meta_root, '%s_idx.pkl'%prefix), 'rb'))
-        self.word2vec = {w: vectors[word2idx[w]] for w in words}
+        self.word2id = {w: word2idx[w] for w in words}
+        self.pos_ohot = np.eye(len(POS_enumerator))
+        # the first VIP category listing a word wins
+        self.vip_pos = {word: POS_enumerator[key]
+                        for key, values in reversed(list(VIP_dict.items())) for word in values}
+        self._token_codes = {}
 
     def _get_pos_ohot(self, pos):
-        pos_vec = np.zeros(len(POS_enumerator))
-        if pos in POS_enumerator:
-            pos_vec[POS_enumerator[pos]] = 1
-        else:
-            pos_vec[POS_enumerator['OTHER']] = 1
-        return pos_vec
+        return self.pos_ohot[POS_enumerator.get(pos, POS_enumerator['OTHER'])]
 
     def __len__(self):
-        return len(self.word2vec)
+        return len(self.word2id)
 
-    def __getitem__(self, item):
-        word, pos = item.split('/')
-        if word in self.word2vec:
-            word_vec = self.word2vec[word]
-            vip_pos = None
-            for key, values in VIP_dict.items():
-                if word in values:
-                    vip_pos = key
-                    break
-            if vip_pos is not None:
-                pos_vec = self._get_pos_ohot(vip_pos)
-            else:
-                pos_vec = self._get_pos_ohot(pos)
+    def _token_code(self, token):
+        # word id * len(POS_enumerator) + POS id, memoized per token
+        word, pos = token.split('/')
+        if word in self.word2id:
+            pos_id = self.vip_pos.get(word, POS_enumerator.get(pos, POS_enumerator['OTHER']))
+            code = self.word2id[word] * len(POS_enumerator) + pos_id
         else:
-            word_vec = self.word2vec['unk']
-            pos_vec = self._get_pos_ohot('OTHER')
-        return word_vec, pos_vec
\ No newline at end of file
+            code = self.word2id['unk'] * len(POS_enumerator) + POS_enumerator['OTHER']
+        self._token_codes[token] = code
+        return code
+
+    def encode(self, tokens):
+        """
+        :return: [len(tokens)] word id and POS id arrays.
+        """
+        codes = self._token_codes
+        codes = np.array([codes[t] if t in codes else self._token_code(t) for t in tokens], dtype=np.int64)
+        return codes // len(POS_enumerator), codes % len(POS_enumerator)
+
+    def lookup(self, word_ids, pos_ids):
+        """
+        :return: [len x 300] word embeddings and [len x len(POS_enumerator)] POS one-hots.
+        """
+        return self.vectors[word_ids], self.pos_ohot[pos_ids]
+
+    def featurize(self, tokens):
+        return self.lookup(*self.encode(tokens))
+
+    def __getitem__(self, item):
+        code = self._token_codes[item] if item in self._token_codes else self._token_code(item)
+        word_id, pos_id = divmod(code, len(POS_enumerator))
+        return self.vectors[word_id], self.pos_ohot[pos_id]
@@ -1,4 +1,5 @@
 import torch
+import numpy as np
 
 def lengths_to_mask(lengths, max_len):
     # max_len = max(lengths)
@@ -43,6 +44,14 @@ def collate(batch):
         textbatch = [b['tokens'] for b in notnone_batches]
         cond['y'].update({'tokens': textbatch})
 
+    if 'crop_key' in notnone_batches[0]:
+        cropkeybatch = [b['crop_key'] for b in notnone_batches]
+        cond['y'].update({'crop_key': cropkeybatch})
+
+    if 'length_idx' in notnone_batches[0]:
+        lenidxbatch = [b['length_idx'] for b in notnone_batches]
+        cond['y'].update({'length_idx': torch.as_tensor(np.stack(lenidxbatch))})
+
     if 'action' in notnone_batches[0]:
         actionbatch = [b['action'] for b in notnone_batches]
         cond['y'].update({'action': torch.as_tensor(actionbatch).unsqueeze(1)})
@@ -63,6 +72,10 @@ def t2m_collate(batch):
         'tokens': b[6],
         'lengths': b[5],
     } for b in batch]
+    if len(batch[0]) > 7:
+        # optional extras from Text2MotionDatasetV2 (crop_key, length_idx)
+        for adapted, b in zip(adapted_batch, batch):
+            adapted.update(b[7])
     return collate(adapted_batch)
 
 
@@ -0,0 +1,159 @@
+"""
+A p_sample_loop that captures one denoising step and replays it.
+
+Sampling runs the same ops on the same shapes for every timestep; only t
+changes. CompiledSampleLoop keeps x and t in static buffers and runs the
+whole step (model, posterior and noise injection) either through
+torch.compile (mode='compile', also on CPU) or as a CUDA graph recorded once
+per sampling call and replayed for every timestep (mode='cuda_graph').
+"""
+
+import torch as th
+
+from diffusion.gaussian_diffusion import correlate_noise, encode_text_once
+
+
+class CompiledSampleLoop:
+    """
+    Drop-in replacement for diffusion.p_sample_loop.
+
+    Only the plain DDPM loop is supported: no cond_fn, dump_steps,
+    const_noise or randomize_class. The step sees the tensor entries of
+    model_kwargs['y'] only, so text must be pre-encoded (it is, see
+    encode_text_once()).
+
+    :param diffusion: the (spaced) diffusion to sample from.
+    :param mode: 'compile' or 'cuda_graph'.
+    :param compile_mode: passed to torch.compile (e.g. 'reduce-overhead').
+    """
+
+    def __init__(self, diffusion, mode='compile', compile_mode=None):
+        assert mode in ['compile', 'cuda_graph']
+        self.diffusion = diffusion
+        self.mode = mode
+        self.compile_mode = compile_mode
+        self._compiled_step = None
+
+    def _step(self, model, x, t, len_param, clip_denoised, model_kwargs):
+        out = self.diffusion.p_mean_variance(
+            model,
+            x,
+            t,
+            len_param,
+            clip_denoised=clip_denoised,
+            model_kwargs=model_kwargs,
+        )
+        # white noise, as in p_sample(); only x_T is correlated
+        noise = th.randn_like(x)
+        nonzero_mask = (t != 0).to(x.dtype).view(-1, *([1] * (x.dim() - 1)))  # no noise when t == 0
+        sample = out["mean"] + nonzero_mask * th.exp(0.5 * out["log_variance"]) * noise
+        return sample, out["pred_xstart"]
+
+    def _get_compiled_step(self):
+        if self._compiled_step is None:
+            self._compiled_step = th.compile(self._step, mode=self.compile_mode, dynamic=False)
+        return self._compiled_step
+
+    def _capture(self, model, static_x, static_t, len_param, clip_denoised, model_kwargs, warmup=3):
+        # warm up on a side stream (cuDNN / cuBLAS workspaces, lazy buffers) before capturing
+        stream = th.cuda.Stream()
+        stream.wait_stream(th.cuda.current_stream())
+        with th.cuda.stream(stream):
+            for _ in range(warmup):
+                self._step(model, static_x, static_t, len_param, clip_denoised, model_kwargs)
+        th.cuda.current_stream().wait_stream(stream)
+        graph = th.cuda.CUDAGraph()
+        with th.cuda.graph(graph):
+            static_out = self._step(model, static_x, static_t, len_param, clip_denoised, model_kwargs)
+        return graph, static_out
+
+    def __call__(self, model, shape, K_params, len_param, **kwargs):
+        """
+        Same as diffusion.p_sample_loop().
+        """
+        sample = None
+        for sample, _ in self._run(model, shape, K_params, len_param, **kwargs):
+            pass
+        return sample.clone()
+
+    def progressive(self, model, shape, K_params, len_param, **kwargs):
+        """
+        Same as diffusion.p_sample_loop_progressive(). The yielded tensors are
+        copies, so they stay valid after the next step.
+        """
+        for sample, pred_xstart in self._run(model, shape, K_params, len_param, **kwargs):
+            yield {"sample": sample.clone(), "pred_xstart": pred_xstart.clone()}
+
+    def _run(
+        self,
+        model,
+        shape,
+        K_params,
+        len_param,
+        noise=None,
+        clip_denoised=True,
+        denoised_fn=None,
+        cond_fn=None,
+        model_kwargs=None,
+        device=None,
+        progress=False,
+        skip_timesteps=0,
+        init_image=None,
+        randomize_class=False,
+        cond_fn_with_grad=False,
+        dump_steps=None,
+        const_noise=False,
+    ):
+        # yields (sample, pred_xstart) views of the static outputs
+        if denoised_fn is not None or cond_fn is not None or cond_fn_with_grad or randomize_class:
+            raise NotImplementedError()
+        if dump_steps is not None or const_noise:
+            raise NotImplementedError()
+        diffusion = self.diffusion
+        if device is None:
+            device = next(model.parameters()).device
+        assert isinstance(shape, (tuple, list))
+        model_kwargs = encode_text_once(model, model_kwargs)
+        step_kwargs = {}
+        if model_kwargs is not None:
+            step_kwargs = dict(model_kwargs, y={k: v for k, v in model_kwargs['y'].items() if th.is_tensor(v)})
+
+        if noise is not None:
+            img = noise
+        else:
+            img = th.randn(*shape, device=device)
+            if K_params is not None:
+                img = correlate_noise(K_params, img)  # [B x D x 1 x L]
+
+        if skip_timesteps and init_image is None:
+            init_image = th.zeros_like(img)
+
+        indices = list(range(diffusion.num_timesteps - skip_timesteps))[::-1]
+
+        if init_image is not None:
+            my_t = th.ones([shape[0]], device=device, dtype=th.long) * indices[0]
+            img = diffusion.q_sample(init_image, my_t, noise=img)
+
+        static_x = img.clone()
+        static_t = th.full([shape[0]], indices[0], device=device, dtype=th.long)
+        with th.no_grad():
+            if self.mode == 'cuda_graph':
+                graph, static_out = self._capture(model, static_x, static_t, len_param, clip_denoised, step_kwargs)
+            else:
+                step = self._get_compiled_step()
+
+            if progress:
+                # Lazy import so that we don't depend on tqdm.
+                from tqdm.auto import tqdm
+
+                indices = tqdm(indices)
+
+            for i in indices:
+                static_t.fill_(i)
+                if self.mode == 'cuda_graph':
+                    graph.replay()
+                    sample, pred_xstart = static_out
+                else:
+                    sample, pred_xstart = step(model, static_x, static_t, len_param, clip_denoised, step_kwargs)
+                static_x.copy_(sample)
+                yield sample, pred_xstart
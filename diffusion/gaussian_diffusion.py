@@ -12,10 +12,10 @@ import math
 import numpy as np
 import torch
 import torch as th
-from copy import deepcopy
 from diffusion.nn import mean_flat, sum_flat
 from diffusion.losses import normal_kl, discretized_gaussian_log_likelihood
 from data_loaders.humanml.scripts import motion_process
+from diffusion.gp_kernel import KernelOperator, correlate_noise
 
 def get_named_beta_schedule(schedule_name, num_diffusion_timesteps, scale_betas=1.):
     """
@@ -100,6 +100,28 @@ class LossType(enum.Enum):
         return self == LossType.KL or self == LossType.RESCALED_KL
 
 
+# 1-D schedule arrays of GaussianDiffusion that get device buffers, see schedule_buffers()
+SCHEDULE_ARRAYS = [
+    'betas',
+    'alphas_cumprod',
+    'alphas_cumprod_prev',
+    'alphas_cumprod_next',
+    'sqrt_alphas_cumprod',
+    'sqrt_one_minus_alphas_cumprod',
+    'log_one_minus_alphas_cumprod',
+    'sqrt_recip_alphas_cumprod',
+    'sqrt_recipm1_alphas_cumprod',
+    'posterior_variance',
+    'posterior_log_variance_clipped',
+    'posterior_mean_coef1',
+    'posterior_mean_coef2',
+    'fixed_large_variance',
+    'fixed_large_log_variance',
+    'recip_posterior_mean_coef1',
+    'posterior_mean_coef2_over_coef1',
+]
+
+
 class GaussianDiffusion:
     """
     Utilities for training and sampling diffusion models.
@@ -194,8 +216,44 @@ class GaussianDiffusion:
             * np.sqrt(alphas)
             / (1.0 - self.alphas_cumprod)
         )
+        self.fixed_large_variance = np.append(self.posterior_variance[1], self.betas[1:])
+        self.fixed_large_log_variance = np.log(self.fixed_large_variance)
+        # for _predict_xstart_from_xprev()
+        self.recip_posterior_mean_coef1 = 1.0 / self.posterior_mean_coef1
+        self.posterior_mean_coef2_over_coef1 = self.posterior_mean_coef2 / self.posterior_mean_coef1
+
+        # torch copies of the arrays above, built once per (device, dtype)
+        self._schedule_buffers = {}
+
+    def l2_loss(self, a, b):
+        # a method rather than a lambda attribute so that the diffusion pickles (sharded eval generation)
+        return (a - b) ** 2  # th.nn.MSELoss(reduction='none')  # must be None for handling mask later on.
+
+    def schedule_buffers(self, device, dtype=th.float32):
+        """
+        Get the 1-D schedule arrays as tensors resident on `device`.
+
+        They are converted once per device and dtype, so the per-step helpers
+        index them directly instead of copying numpy arrays to the device on
+        every call.
 
-        self.l2_loss = lambda a, b: (a - b) ** 2  # th.nn.MSELoss(reduction='none')  # must be None for handling mask later on.
+        :return: a dict mapping array names (e.g. 'alphas_cumprod') to tensors.
+        """
+        key = (th.device(device), dtype)
+        if key not in self._schedule_buffers:
+            self._schedule_buffers[key] = {
+                name: th.from_numpy(getattr(self, name)).to(device=device, dtype=dtype)
+                for name in SCHEDULE_ARRAYS
+            }
+        return self._schedule_buffers[key]
+
+    def _extract(self, name, timesteps, broadcast_shape):
+        """
+        Like _extract_into_tensor(), for the schedule array `name`, read from
+        the device buffers.
+        """
+        res = self.schedule_buffers(timesteps.device)[name].index_select(0, timesteps)
+        return res.view(-1, *([1] * (len(broadcast_shape) - 1))).expand(broadcast_shape)
 
     def masked_l2(self, a, b, mask):
         # assuming a.shape == b.shape == bs, J, Jdim, seqlen
@@ -221,12 +279,10 @@ class GaussianDiffusion:
         :return: A tuple (mean, variance, log_variance), all of x_start's shape.
         """
         mean = (
-            _extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start
-        )
-        variance = _extract_into_tensor(1.0 - self.alphas_cumprod, t, x_start.shape)
-        log_variance = _extract_into_tensor(
-            self.log_one_minus_alphas_cumprod, t, x_start.shape
+            self._extract('sqrt_alphas_cumprod', t, x_start.shape) * x_start
         )
+        variance = 1.0 - self._extract('alphas_cumprod', t, x_start.shape)
+        log_variance = self._extract('log_one_minus_alphas_cumprod', t, x_start.shape)
         return mean, variance, log_variance
 
     def q_sample(self, x_start, t, K_params=None, noise=None):
@@ -244,8 +300,8 @@ class GaussianDiffusion:
             noise = th.randn_like(x_start)
         assert noise.shape == x_start.shape
         return (
-            _extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start
-            + _extract_into_tensor(self.sqrt_one_minus_alphas_cumprod, t, x_start.shape)
+            self._extract('sqrt_alphas_cumprod', t, x_start.shape) * x_start
+            + self._extract('sqrt_one_minus_alphas_cumprod', t, x_start.shape)
             * noise 
             # * th.rand(1).to(noise.device)*2
         )
@@ -259,13 +315,11 @@ class GaussianDiffusion:
         """
         assert x_start.shape == x_t.shape
         posterior_mean = (
-            _extract_into_tensor(self.posterior_mean_coef1, t, x_t.shape) * x_start
-            + _extract_into_tensor(self.posterior_mean_coef2, t, x_t.shape) * x_t
-        )
-        posterior_variance = _extract_into_tensor(self.posterior_variance, t, x_t.shape)
-        posterior_log_variance_clipped = _extract_into_tensor(
-            self.posterior_log_variance_clipped, t, x_t.shape
+            self._extract('posterior_mean_coef1', t, x_t.shape) * x_start
+            + self._extract('posterior_mean_coef2', t, x_t.shape) * x_t
         )
+        posterior_variance = self._extract('posterior_variance', t, x_t.shape)
+        posterior_log_variance_clipped = self._extract('posterior_log_variance_clipped', t, x_t.shape)
         assert (
             posterior_mean.shape[0]
             == posterior_variance.shape[0]
@@ -320,10 +374,8 @@ class GaussianDiffusion:
                 model_log_variance = model_var_values
                 model_variance = th.exp(model_log_variance)
             else:
-                min_log = _extract_into_tensor(
-                    self.posterior_log_variance_clipped, t, x.shape
-                )
-                max_log = _extract_into_tensor(np.log(self.betas), t, x.shape)
+                min_log = self._extract('posterior_log_variance_clipped', t, x.shape)
+                max_log = th.log(self._extract('betas', t, x.shape))
                 # The model_var_values is [-1, 1] for [min_var, max_var].
                 frac = (model_var_values + 1) / 2
                 model_log_variance = frac * max_log + (1 - frac) * min_log
@@ -333,12 +385,12 @@ class GaussianDiffusion:
                 # for fixedlarge, we set the initial (log-)variance like so
                 # to get a better decoder log likelihood.
                 ModelVarType.FIXED_LARGE: (
-                    np.append(self.posterior_variance[1], self.betas[1:]),
-                    np.log(np.append(self.posterior_variance[1], self.betas[1:])),
+                    'fixed_large_variance',
+                    'fixed_large_log_variance',
                 ),
                 ModelVarType.FIXED_SMALL: (
-                    self.posterior_variance,
-                    self.posterior_log_variance_clipped,
+                    'posterior_variance',
+                    'posterior_log_variance_clipped',
                 ),
             }[self.model_var_type]
             # print('model_variance', model_variance)
@@ -348,8 +400,8 @@ class GaussianDiffusion:
             # print('self.model_var_type', self.model_var_type)
 
 
-            model_variance = _extract_into_tensor(model_variance, t, x.shape)
-            model_log_variance = _extract_into_tensor(model_log_variance, t, x.shape)
+            model_variance = self._extract(model_variance, t, x.shape)
+            model_log_variance = self._extract(model_log_variance, t, x.shape)
 
         def process_xstart(x):
             if denoised_fn is not None:
@@ -390,25 +442,22 @@ class GaussianDiffusion:
     def _predict_xstart_from_eps(self, x_t, t, eps):
         assert x_t.shape == eps.shape
         return (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t
-            - _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape) * eps
+            self._extract('sqrt_recip_alphas_cumprod', t, x_t.shape) * x_t
+            - self._extract('sqrt_recipm1_alphas_cumprod', t, x_t.shape) * eps
         )
 
     def _predict_xstart_from_xprev(self, x_t, t, xprev):
         assert x_t.shape == xprev.shape
         return (  # (xprev - coef2*x_t) / coef1
-            _extract_into_tensor(1.0 / self.posterior_mean_coef1, t, x_t.shape) * xprev
-            - _extract_into_tensor(
-                self.posterior_mean_coef2 / self.posterior_mean_coef1, t, x_t.shape
-            )
-            * x_t
+            self._extract('recip_posterior_mean_coef1', t, x_t.shape) * xprev
+            - self._extract('posterior_mean_coef2_over_coef1', t, x_t.shape) * x_t
         )
 
     def _predict_eps_from_xstart(self, x_t, t, pred_xstart):
         return (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t
+            self._extract('sqrt_recip_alphas_cumprod', t, x_t.shape) * x_t
             - pred_xstart
-        ) / _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape)
+        ) / self._extract('sqrt_recipm1_alphas_cumprod', t, x_t.shape)
 
     def _scale_timesteps(self, t):
         if self.rescale_timesteps:
@@ -455,7 +504,7 @@ class GaussianDiffusion:
         Unlike condition_mean(), this instead uses the conditioning strategy
         from Song et al (2020).
         """
-        alpha_bar = _extract_into_tensor(self.alphas_cumprod, t, x.shape)
+        alpha_bar = self._extract('alphas_cumprod', t, x.shape)
 
         eps = self._predict_eps_from_xstart(x, t, p_mean_var["pred_xstart"])
         eps = eps - (1 - alpha_bar).sqrt() * cond_fn(
@@ -479,7 +528,7 @@ class GaussianDiffusion:
         Unlike condition_mean(), this instead uses the conditioning strategy
         from Song et al (2020).
         """
-        alpha_bar = _extract_into_tensor(self.alphas_cumprod, t, x.shape)
+        alpha_bar = self._extract('alphas_cumprod', t, x.shape)
 
         eps = self._predict_eps_from_xstart(x, t, p_mean_var["pred_xstart"])
         eps = eps - (1 - alpha_bar).sqrt() * cond_fn(
@@ -533,16 +582,6 @@ class GaussianDiffusion:
             model_kwargs=model_kwargs,
         )
         noise = th.randn_like(x)
-        noise_org = noise.clone().to(x.device)
-        
-        if K_params is not None : 
-            noise_expand = noise.squeeze(2).unsqueeze(-1)
-            K_chols = K_params
-            K_chols_torch_tile = th.tile(input=K_chols,dims=(x.shape[0],1,1,1)).to(x.device) if x.shape[0] != K_chols.shape[0] else K_chols.to(x.device) # [B x D x L x L]
-            corr_noise = K_chols_torch_tile @ noise_expand.to(x.device) # [B x D x L x 1]
-            corr_noise = corr_noise.squeeze(dim=3) # [B x D x L]
-            corr_noise = corr_noise.unsqueeze(2)
-            
         if const_noise:
             noise = noise[[0]].repeat(x.shape[0], 1, 1, 1)
 
@@ -601,16 +640,6 @@ class GaussianDiffusion:
                 model_kwargs=model_kwargs,
             )
             noise = th.randn_like(x)
-            noise_org = noise.clone().to(x.device)
-            
-            if K_params is not None : 
-                noise_expand = noise.squeeze(2).unsqueeze(-1)
-                K_chols = K_params
-                K_chols_torch_tile = th.tile(input=K_chols,dims=(x.shape[0],1,1,1)) if x.shape[0] != K_chols.shape[0] else K_chols # [B x D x L x L]
-                corr_noise = K_chols_torch_tile @ noise_expand.to(x.device) # [B x D x L x 1]
-                corr_noise = corr_noise.squeeze(dim=3) # [B x D x L]
-                corr_noise = corr_noise.unsqueeze(2)
-                
             nonzero_mask = (
                 (t != 0).float().view(-1, *([1] * (len(x.shape) - 1)))
             )  # no noise when t == 0
@@ -684,7 +713,7 @@ class GaussianDiffusion:
             const_noise=const_noise,
         )):
             if dump_steps is not None and i in dump_steps:
-                dump.append(deepcopy(sample["sample"]))
+                dump.append(sample["sample"])  # every step returns a fresh tensor, no copy needed
             final = sample
         if dump_steps is not None:
             return dump
@@ -720,18 +749,14 @@ class GaussianDiffusion:
         if device is None:
             device = next(model.parameters()).device
         assert isinstance(shape, (tuple, list))
+        model_kwargs = encode_text_once(model, model_kwargs)
         if noise is not None:
             img = noise
         else:
             img = th.randn(*shape, device=device)
             noise_org = img.clone().to(device)
             if K_params is not None : 
-                img_expand = img.squeeze(2).unsqueeze(-1)
-                K_chols = K_params
-                K_chols_torch_tile = th.tile(input=K_chols,dims=(shape[0],1,1,1)).to(device) if shape[0] != K_chols.shape[0] else K_chols.to(device) # [B x D x L x L]
-                img = K_chols_torch_tile @ img_expand.to(device) # [B x D x L x 1]
-                img = img.squeeze(dim=3) # [B x D x L]
-                img = img.unsqueeze(2)
+                img = correlate_noise(K_params, img)  # [B x D x 1 x L]
 
         if skip_timesteps and init_image is None:
             init_image = th.zeros_like(img)
@@ -771,12 +796,174 @@ class GaussianDiffusion:
                 yield out
                 img = out["sample"]
 
+    def length_sweep_sample_loop(
+        self,
+        model,
+        shape,
+        K_params,
+        len_param,
+        sample_fn=None,
+        model_kwargs=None,
+        **kwargs,
+    ):
+        """
+        Sample several length-scale configurations in a single batched run.
+
+        Every configuration gets its own copy of the batch: the rows are
+        packed config-major into a [num_lens * num_samples x ...] batch where
+        each row carries its config's kernel factors and len_param. The text
+        condition is encoded once for all of them.
+
+        :param shape: the shape of one configuration's samples, (N, C, H, W).
+        :param K_params: a KernelOperator with one row per configuration.
+        :param len_param: a [num_lens x D] tensor, one row per configuration.
+        :param sample_fn: the sample loop to run, e.g. ddim_sample_loop.
+                          Defaults to p_sample_loop.
+        :param kwargs: passed on to sample_fn.
+        :return: a [num_lens x N x C x H x W] tensor of samples.
+        """
+        if sample_fn is None:
+            sample_fn = self.p_sample_loop
+        num_lens, num_samples = len(K_params), shape[0]
+        assert len_param.shape[0] == num_lens
+        model_kwargs = encode_text_once(model, model_kwargs)
+        if model_kwargs is not None:
+            model_kwargs = dict(model_kwargs, y=tile_batch(model_kwargs['y'], num_samples, num_lens))
+        sample = sample_fn(
+            model,
+            (num_lens * num_samples, *shape[1:]),
+            K_params.repeat_interleave(num_samples),
+            len_param.repeat_interleave(num_samples, dim=0),
+            model_kwargs=model_kwargs,
+            **kwargs,
+        )
+        return sample.reshape(num_lens, num_samples, *sample.shape[1:])
+
+    def length_bucket_sample_loop(
+        self,
+        model,
+        shape,
+        K_params,
+        len_param,
+        bucket_edges,
+        sample_fn=None,
+        noise=None,
+        model_kwargs=None,
+        **kwargs,
+    ):
+        """
+        Sample a batch of variable-length motions bucket by bucket.
+
+        Each row goes to the smallest edge of `bucket_edges` that fits
+        model_kwargs['y']['lengths'] and every bucket is sampled as its own
+        batch of edge frames instead of the full shape[-1]. The padding mask
+        and the kernels are cropped to the bucket; the text condition is
+        encoded once for the whole batch.
+
+        :param K_params: a KernelOperator, or dense [N x D x L x L] (or
+                         [1 x D x L x L]) factors, which are converted to one.
+        :param bucket_edges: increasing frame counts. Rows longer than the last
+                             edge are sampled at the full length.
+        :param sample_fn: the sample loop to run, e.g. ddim_sample_loop.
+                          Defaults to p_sample_loop.
+        :param kwargs: passed on to sample_fn.
+        :return: an [N x C x H x W] tensor of samples, zero beyond each bucket's frames.
+        """
+        if sample_fn is None:
+            sample_fn = self.p_sample_loop
+        batch_size, max_frames = shape[0], shape[-1]
+        if isinstance(K_params, th.Tensor):
+            # dense factors are cropped through the operator, see KernelOperator.crop()
+            K_params = KernelOperator.from_dense(K_params)
+        if K_params is not None:
+            K_params = K_params.expand(batch_size)
+        model_kwargs = encode_text_once(model, model_kwargs)
+        y = model_kwargs['y']
+        lengths = y['lengths'].cpu().numpy()
+        edges = np.array(sorted(e for e in bucket_edges if e < max_frames) + [max_frames])
+        bucket = np.searchsorted(edges, np.minimum(lengths, max_frames))
+
+        sample = None
+        for b in np.unique(bucket):
+            num_frames = int(edges[b])
+            rows = np.flatnonzero(bucket == b)
+            rows_t = th.from_numpy(rows).to(y['lengths'].device)
+            bucket_y = select_batch(y, batch_size, rows_t, num_frames)
+            bucket_sample = sample_fn(
+                model,
+                (len(rows), *shape[1:-1], num_frames),
+                None if K_params is None else K_params.crop(num_frames)[rows_t],
+                None if len_param is None else len_param[rows_t.to(len_param.device)],
+                noise=None if noise is None else noise[rows_t.to(noise.device), ..., :num_frames],
+                model_kwargs=dict(model_kwargs, y=bucket_y),
+                **kwargs,
+            )
+            if sample is None:
+                sample = th.zeros(shape, device=bucket_sample.device, dtype=bucket_sample.dtype)
+            sample[rows_t.to(sample.device), ..., :num_frames] = bucket_sample
+        return sample
+
+    def decoded_sample_loop_progressive(
+        self,
+        model,
+        shape,
+        K_params,
+        len_param,
+        decode_fn,
+        stride=1,
+        decode_batch=1,
+        progressive_fn=None,
+        **kwargs,
+    ):
+        """
+        Stream decoded x_0 predictions while sampling, e.g. for previews.
+
+        Every `stride` timesteps (and always at t == 0) the step's pred_xstart
+        is decoded with decode_fn on the sampling device. Up to `decode_batch`
+        selected steps are decoded together in one call; nothing is copied
+        to the host.
+
+        :param decode_fn: maps a [N x C x H x W] batch to decoded samples,
+                          e.g. a RICDecoder for joint positions.
+        :param stride: decode every stride-th timestep.
+        :param decode_batch: number of selected steps decoded per call.
+        :param progressive_fn: the progressive loop to run, e.g.
+                               ddim_sample_loop_progressive. Defaults to
+                               p_sample_loop_progressive.
+        :param kwargs: passed on to progressive_fn.
+        :return: a generator over (t, decoded pred_xstart) pairs, t descending.
+        """
+        if progressive_fn is None:
+            progressive_fn = self.p_sample_loop_progressive
+        first_t = self.num_timesteps - 1 - kwargs.get('skip_timesteps', 0)
+        pending_t, pending = [], []
+
+        def flush():
+            with th.no_grad():
+                decoded = decode_fn(th.cat(pending, dim=0)).split(shape[0], dim=0)
+            steps = list(zip(pending_t, decoded))
+            pending_t.clear()
+            pending.clear()
+            return steps
+
+        for i, out in enumerate(progressive_fn(model, shape, K_params, len_param, **kwargs)):
+            t = first_t - i
+            if t % stride != 0:
+                continue
+            pending_t.append(t)
+            pending.append(out["pred_xstart"])
+            if len(pending) == decode_batch:
+                yield from flush()
+        if pending:
+            yield from flush()
+
     def ddim_sample(
         self,
         model,
         x,
         t,
         K_params,
+        len_param=None,
         clip_denoised=True,
         denoised_fn=None,
         cond_fn=None,
@@ -792,7 +979,7 @@ class GaussianDiffusion:
             model,
             x,
             t,
-            K_params,
+            len_param,
             clip_denoised=clip_denoised,
             denoised_fn=denoised_fn,
             model_kwargs=model_kwargs,
@@ -806,8 +993,8 @@ class GaussianDiffusion:
         # in case we used x_start or x_prev prediction.
         eps = self._predict_eps_from_xstart(x, t, out["pred_xstart"])
 
-        alpha_bar = _extract_into_tensor(self.alphas_cumprod, t, x.shape)
-        alpha_bar_prev = _extract_into_tensor(self.alphas_cumprod_prev, t, x.shape)
+        alpha_bar = self._extract('alphas_cumprod', t, x.shape)
+        alpha_bar_prev = self._extract('alphas_cumprod_prev', t, x.shape)
         sigma = (
             eta
             * th.sqrt((1 - alpha_bar_prev) / (1 - alpha_bar))
@@ -815,6 +1002,8 @@ class GaussianDiffusion:
         )
         # Equation 12.
         noise = th.randn_like(x)
+        if K_params is not None:
+            noise = correlate_noise(K_params, noise)  # [B x D x 1 x L]
         mean_pred = (
             out["pred_xstart"] * th.sqrt(alpha_bar_prev)
             + th.sqrt(1 - alpha_bar_prev - sigma ** 2) * eps
@@ -830,6 +1019,8 @@ class GaussianDiffusion:
         model,
         x,
         t,
+        K_params,
+        len_param=None,
         clip_denoised=True,
         denoised_fn=None,
         cond_fn=None,
@@ -847,7 +1038,7 @@ class GaussianDiffusion:
                 model,
                 x,
                 t,
-                K_params,
+                len_param,
                 clip_denoised=clip_denoised,
                 denoised_fn=denoised_fn,
                 model_kwargs=model_kwargs,
@@ -864,8 +1055,8 @@ class GaussianDiffusion:
         # in case we used x_start or x_prev prediction.
         eps = self._predict_eps_from_xstart(x, t, out["pred_xstart"])
 
-        alpha_bar = _extract_into_tensor(self.alphas_cumprod, t, x.shape)
-        alpha_bar_prev = _extract_into_tensor(self.alphas_cumprod_prev, t, x.shape)
+        alpha_bar = self._extract('alphas_cumprod', t, x.shape)
+        alpha_bar_prev = self._extract('alphas_cumprod_prev', t, x.shape)
         sigma = (
             eta
             * th.sqrt((1 - alpha_bar_prev) / (1 - alpha_bar))
@@ -873,6 +1064,8 @@ class GaussianDiffusion:
         )
         # Equation 12.
         noise = th.randn_like(x)
+        if K_params is not None:
+            noise = correlate_noise(K_params, noise)  # [B x D x 1 x L]
         mean_pred = (
             out["pred_xstart"] * th.sqrt(alpha_bar_prev)
             + th.sqrt(1 - alpha_bar_prev - sigma ** 2) * eps
@@ -910,10 +1103,10 @@ class GaussianDiffusion:
         # Usually our model outputs epsilon, but we re-derive it
         # in case we used x_start or x_prev prediction.
         eps = (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x.shape) * x
+            self._extract('sqrt_recip_alphas_cumprod', t, x.shape) * x
             - out["pred_xstart"]
-        ) / _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x.shape)
-        alpha_bar_next = _extract_into_tensor(self.alphas_cumprod_next, t, x.shape)
+        ) / self._extract('sqrt_recipm1_alphas_cumprod', t, x.shape)
+        alpha_bar_next = self._extract('alphas_cumprod_next', t, x.shape)
 
         # Equation 12. reversed
         mean_pred = (
@@ -927,6 +1120,8 @@ class GaussianDiffusion:
         self,
         model,
         shape,
+        K_params=None,
+        len_param=None,
         noise=None,
         clip_denoised=True,
         denoised_fn=None,
@@ -956,6 +1151,8 @@ class GaussianDiffusion:
         for sample in self.ddim_sample_loop_progressive(
             model,
             shape,
+            K_params=K_params,
+            len_param=len_param,
             noise=noise,
             clip_denoised=clip_denoised,
             denoised_fn=denoised_fn,
@@ -977,6 +1174,7 @@ class GaussianDiffusion:
         model,
         shape,
         K_params=None,
+        len_param=None,
         noise=None,
         clip_denoised=True,
         denoised_fn=None,
@@ -999,10 +1197,13 @@ class GaussianDiffusion:
         if device is None:
             device = next(model.parameters()).device
         assert isinstance(shape, (tuple, list))
+        model_kwargs = encode_text_once(model, model_kwargs)
         if noise is not None:
             img = noise
         else:
             img = th.randn(*shape, device=device)
+            if K_params is not None : 
+                img = correlate_noise(K_params, img)  # [B x D x 1 x L]
 
         if skip_timesteps and init_image is None:
             init_image = th.zeros_like(img)
@@ -1032,6 +1233,7 @@ class GaussianDiffusion:
                     img,
                     t,
                     K_params,
+                    len_param,
                     clip_denoised=clip_denoised,
                     denoised_fn=denoised_fn,
                     cond_fn=cond_fn,
@@ -1047,6 +1249,7 @@ class GaussianDiffusion:
         x,
         t,
         K_params,
+        len_param=None,
         clip_denoised=True,
         denoised_fn=None,
         cond_fn=None,
@@ -1063,14 +1266,14 @@ class GaussianDiffusion:
         if not int(order) or not 1 <= order <= 4:
             raise ValueError('order is invalid (should be int from 1-4).')
 
-        def get_model_output(x, t, K_params):
+        def get_model_output(x, t):
             with th.set_grad_enabled(cond_fn_with_grad and cond_fn is not None):
                 x = x.detach().requires_grad_() if cond_fn_with_grad else x
                 out_orig = self.p_mean_variance(
                     model,
                     x,
                     t,
-                    K_params,
+                    len_param,
                     clip_denoised=clip_denoised,
                     denoised_fn=denoised_fn,
                     model_kwargs=model_kwargs,
@@ -1089,9 +1292,9 @@ class GaussianDiffusion:
             eps = self._predict_eps_from_xstart(x, t, out["pred_xstart"])
             return eps, out, out_orig
 
-        alpha_bar = _extract_into_tensor(self.alphas_cumprod, t, x.shape)
-        alpha_bar_prev = _extract_into_tensor(self.alphas_cumprod_prev, t, x.shape)
-        eps, out, out_orig = get_model_output(x, t, K_params)
+        alpha_bar = self._extract('alphas_cumprod', t, x.shape)
+        alpha_bar_prev = self._extract('alphas_cumprod_prev', t, x.shape)
+        eps, out, out_orig = get_model_output(x, t)
 
         if order > 1 and old_out is None:
             # Pseudo Improved Euler
@@ -1132,6 +1335,7 @@ class GaussianDiffusion:
         model,
         shape,
         K_params=None,
+        len_param=None,
         noise=None,
         clip_denoised=True,
         denoised_fn=None,
@@ -1155,6 +1359,7 @@ class GaussianDiffusion:
             model,
             shape,
             K_params,
+            len_param,
             noise=noise,
             clip_denoised=clip_denoised,
             denoised_fn=denoised_fn,
@@ -1176,6 +1381,7 @@ class GaussianDiffusion:
         model,
         shape,
         K_params=None,
+        len_param=None,
         noise=None,
         clip_denoised=True,
         denoised_fn=None,
@@ -1198,10 +1404,13 @@ class GaussianDiffusion:
         if device is None:
             device = next(model.parameters()).device
         assert isinstance(shape, (tuple, list))
+        model_kwargs = encode_text_once(model, model_kwargs)
         if noise is not None:
             img = noise
         else:
             img = th.randn(*shape, device=device)
+            if K_params is not None : 
+                img = correlate_noise(K_params, img)  # [B x D x 1 x L]
 
         if skip_timesteps and init_image is None:
             init_image = th.zeros_like(img)
@@ -1210,7 +1419,7 @@ class GaussianDiffusion:
 
         if init_image is not None:
             my_t = th.ones([shape[0]], device=device, dtype=th.long) * indices[0]
-            img = self.q_sample(init_image, my_t, img)
+            img = self.q_sample(init_image, my_t, noise=img)
 
         if progress:
             # Lazy import so that we don't depend on tqdm.
@@ -1232,6 +1441,7 @@ class GaussianDiffusion:
                     img,
                     t,
                     K_params,
+                    len_param,
                     clip_denoised=clip_denoised,
                     denoised_fn=denoised_fn,
                     cond_fn=cond_fn,
@@ -1244,6 +1454,173 @@ class GaussianDiffusion:
                 old_out = out
                 img = out["sample"]
 
+    def dpm_solver_sample(
+        self,
+        model,
+        x,
+        t,
+        K_params,
+        len_param=None,
+        clip_denoised=True,
+        denoised_fn=None,
+        model_kwargs=None,
+        old_out=None,
+    ):
+        """
+        Sample x_{t-1} from the model using multistep DPM-Solver++(2M).
+
+        The solver works on the model's x_0 prediction directly, so it suits
+        our START_X models. The first step and the last two steps are first
+        order (i.e. DDIM with eta = 0): the log-SNR jumps there are too large
+        for the multistep correction to be stable with few steps.
+
+        Same usage as p_sample(), plus `old_out`, the output of the previous step.
+        """
+        out = self.p_mean_variance(
+            model,
+            x,
+            t,
+            len_param,
+            clip_denoised=clip_denoised,
+            denoised_fn=denoised_fn,
+            model_kwargs=model_kwargs,
+        )
+        alpha_bar = self._extract('alphas_cumprod', t, x.shape)
+        alpha_bar_prev = self._extract('alphas_cumprod_prev', t, x.shape)
+        # lambda = log(alpha / sigma), the half log-SNR
+        lamb = 0.5 * (th.log(alpha_bar) - th.log(1 - alpha_bar))
+        sigma_ratio = th.sqrt((1 - alpha_bar_prev) / (1 - alpha_bar))
+        exp_neg_h = sigma_ratio * th.sqrt(alpha_bar / alpha_bar_prev)  # e^{-h}, 0 on the last step
+
+        denoised = out["pred_xstart"]
+        if old_out is not None and (t > 1).all():
+            lamb_prev = 0.5 * (th.log(alpha_bar_prev) - th.log(1 - alpha_bar_prev))
+            r = (lamb - old_out["lambda"]) / (lamb_prev - lamb)
+            denoised = (1 + 1 / (2 * r)) * denoised - (1 / (2 * r)) * old_out["pred_xstart"]
+        sample = sigma_ratio * x + th.sqrt(alpha_bar_prev) * (1 - exp_neg_h) * denoised
+        return {"sample": sample, "pred_xstart": out["pred_xstart"], "lambda": lamb}
+
+    def dpm_solver_sample_loop(
+        self,
+        model,
+        shape,
+        K_params=None,
+        len_param=None,
+        noise=None,
+        clip_denoised=True,
+        denoised_fn=None,
+        cond_fn=None,
+        model_kwargs=None,
+        device=None,
+        progress=False,
+        skip_timesteps=0,
+        init_image=None,
+        randomize_class=False,
+        cond_fn_with_grad=False,
+        dump_steps=None,
+        const_noise=False,
+    ):
+        """
+        Generate samples from the model using DPM-Solver++(2M).
+
+        Same usage as p_sample_loop(). Use a respaced diffusion
+        (see create_gaussian_diffusion()) to sample in a few steps. The solver
+        adds no noise after the initial draw, so const_noise has no effect.
+        """
+        if cond_fn is not None:
+            raise ValueError('dpm_solver_sample_loop does not support cond_fn, use p_sample_loop for guidance functions')
+
+        final = None
+        if dump_steps is not None:
+            dump = []
+        for i, sample in enumerate(self.dpm_solver_sample_loop_progressive(
+            model,
+            shape,
+            K_params=K_params,
+            len_param=len_param,
+            noise=noise,
+            clip_denoised=clip_denoised,
+            denoised_fn=denoised_fn,
+            model_kwargs=model_kwargs,
+            device=device,
+            progress=progress,
+            skip_timesteps=skip_timesteps,
+            init_image=init_image,
+        )):
+            if dump_steps is not None and i in dump_steps:
+                dump.append(sample["sample"])
+            final = sample
+        if dump_steps is not None:
+            return dump
+        return final["sample"]
+
+    def dpm_solver_sample_loop_progressive(
+        self,
+        model,
+        shape,
+        K_params=None,
+        len_param=None,
+        noise=None,
+        clip_denoised=True,
+        denoised_fn=None,
+        model_kwargs=None,
+        device=None,
+        progress=False,
+        skip_timesteps=0,
+        init_image=None,
+    ):
+        """
+        Use DPM-Solver++(2M) to sample from the model and yield intermediate
+        samples from each timestep.
+
+        Same usage as p_sample_loop_progressive().
+        """
+        if device is None:
+            device = next(model.parameters()).device
+        assert isinstance(shape, (tuple, list))
+        model_kwargs = encode_text_once(model, model_kwargs)
+        if noise is not None:
+            img = noise
+        else:
+            img = th.randn(*shape, device=device)
+            if K_params is not None : 
+                img = correlate_noise(K_params, img)  # [B x D x 1 x L]
+
+        if skip_timesteps and init_image is None:
+            init_image = th.zeros_like(img)
+
+        indices = list(range(self.num_timesteps - skip_timesteps))[::-1]
+
+        if init_image is not None:
+            my_t = th.ones([shape[0]], device=device, dtype=th.long) * indices[0]
+            img = self.q_sample(init_image, my_t, noise=img)
+
+        if progress:
+            # Lazy import so that we don't depend on tqdm.
+            from tqdm.auto import tqdm
+
+            indices = tqdm(indices)
+
+        old_out = None
+
+        for i in indices:
+            t = th.tensor([i] * shape[0], device=device)
+            with th.no_grad():
+                out = self.dpm_solver_sample(
+                    model,
+                    img,
+                    t,
+                    K_params,
+                    len_param,
+                    clip_denoised=clip_denoised,
+                    denoised_fn=denoised_fn,
+                    model_kwargs=model_kwargs,
+                    old_out=old_out,
+                )
+                yield out
+                old_out = out
+                img = out["sample"]
+
     def _vb_terms_bpd(
         self, model, x_start, x_t, t, K_params, clip_denoised=True, model_kwargs=None
     ):
@@ -1307,17 +1684,6 @@ class GaussianDiffusion:
             model_kwargs = {}
         if noise is None:
             noise = th.randn_like(x_start)
-        if K_params is not None : 
-            noise_expand = noise.squeeze(2).unsqueeze(-1)
-            K_chols = K_params
-            K_chols_torch_tile = K_chols
-            #debug adjust only root position 
-            # K_chols_torch_tile[:,:-6,:,:] = 1e-5
-            # K_chols_torch_tile[:,-3:,:,:] = 1e-5 
-            #debug end            
-            corr_noise = K_chols_torch_tile @ noise_expand.to(x_start.device) # [B x D x L x 1]
-            corr_noise = corr_noise.squeeze(dim=3) # [B x D x L]
-            corr_noise = corr_noise.unsqueeze(2)
 
         x_t = self.q_sample(x_start, t, noise=noise)
 
@@ -1662,6 +2028,65 @@ class GaussianDiffusion:
         }
 
 
+def encode_text_once(model, model_kwargs):
+    """
+    Encode the text condition a single time for a whole sampling loop.
+
+    The text does not change between timesteps, so the embedding is passed
+    to every step through model_kwargs['y']['enc_text'] instead of running
+    the text encoder once (or twice, with classifier-free guidance) per step.
+
+    :return: a shallow copy of model_kwargs with 'enc_text' added, or
+             model_kwargs unchanged if the model is not text conditioned.
+    """
+    if model_kwargs is None or not isinstance(model_kwargs.get('y'), dict):
+        return model_kwargs
+    y = model_kwargs['y']
+    if 'text' not in y or 'enc_text' in y or 'text' not in getattr(model, 'cond_mode', ''):
+        return model_kwargs
+    with th.no_grad():
+        enc_text = model.encode_text(y['text'])
+    return dict(model_kwargs, y=dict(y, enc_text=enc_text))
+
+
+def tile_batch(y, batch_size, repeats):
+    """
+    Repeat the per-sample entries of a condition dict `repeats` times.
+
+    Tensors and lists whose leading size is batch_size are tiled; anything
+    else (e.g. a scalar guidance scale) is shared as is.
+    """
+    tiled = {}
+    for key, val in y.items():
+        if th.is_tensor(val) and val.dim() > 0 and val.shape[0] == batch_size:
+            tiled[key] = val.repeat(repeats, *([1] * (val.dim() - 1)))
+        elif isinstance(val, (list, tuple)) and len(val) == batch_size:
+            tiled[key] = list(val) * repeats
+        else:
+            tiled[key] = val
+    return tiled
+
+
+def select_batch(y, batch_size, rows, num_frames=None):
+    """
+    Take the `rows` of the per-sample entries of a condition dict.
+
+    Entries are selected the way tile_batch() tiles them. When num_frames is
+    given, the [B x 1 x 1 x L] padding mask is cropped to it.
+    """
+    selected = {}
+    for key, val in y.items():
+        if th.is_tensor(val) and val.dim() > 0 and val.shape[0] == batch_size:
+            selected[key] = val[rows.to(val.device)]
+        elif isinstance(val, (list, tuple)) and len(val) == batch_size:
+            selected[key] = [val[i] for i in rows.tolist()]
+        else:
+            selected[key] = val
+    if num_frames is not None and 'mask' in selected:
+        selected['mask'] = selected['mask'][..., :num_frames]
+    return selected
+
+
 def _extract_into_tensor(arr, timesteps, broadcast_shape):
     """
     Extract values from a 1-D numpy array for a batch of indices.
@@ -0,0 +1,356 @@
+"""
+Helpers for the Gaussian-process kernels used to correlate diffusion noise
+along the time axis.
+"""
+
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+import torch as th
+
+# length-scale classes predicted by the LPM and the near-white template length-scale
+LENGTH_SCALES = [0.033, 0.14044444, 0.24788889, 0.35533333, 0.46277778, 0.67766667, 1.]
+TEMPLATE_LENGTH_SCALE = 0.0001
+
+
+class KernelOperator:
+    """
+    A structured stand-in for a dense [B x D x L x L] stack of kernel factors.
+
+    Only a handful of distinct factors are ever used (one per length-scale
+    class plus the template), so we keep those once in `factors` and store a
+    [B x D] map from (sample, channel) to factor id. Memory then grows with the
+    number of length-scale classes rather than with batch x channels.
+
+    :param factors: an [F x L x L] tensor of distinct kernel factors.
+    :param index: a [B x D] integer tensor of factor ids.
+    :param spectra: optional list of F circulant spectra (see circulant_spectra()).
+                    Groups whose spectrum is not None are sampled with an FFT
+                    instead of a dense matmul.
+    :param crops: optional dict of crop() results shared by operators over the
+                  same factors, so every length is decomposed only once.
+    """
+
+    def __init__(self, factors, index, spectra=None, crops=None):
+        assert factors.dim() == 3 and index.dim() == 2
+        assert spectra is None or len(spectra) == factors.shape[0]
+        self.factors = factors
+        self.index = index.long()
+        self.spectra = spectra
+        self._groups = {}
+        self._crops = {} if crops is None else crops
+
+    @classmethod
+    def from_classes(cls, K_param, fill, cls_idx, channels, num_channels, spectra=None, crops=None):
+        """
+        Build an operator from per-class factors and predicted class ids.
+
+        :param K_param: a [C x L x L] tensor, one factor per length-scale class.
+        :param fill: an [L x L] factor used for every channel outside `channels`.
+        :param cls_idx: a [B x len(channels)] tensor of class ids.
+        :param channels: the channels (list, array or slice) carrying a predicted kernel.
+        :param num_channels: the total number of channels D.
+        :param spectra: optional C+1 circulant spectra for K_param followed by fill.
+        :param crops: optional crop cache shared by every operator built from this K_param and fill.
+        """
+        factors = th.cat([K_param, fill[None].to(K_param)], dim=0)
+        index = th.full((cls_idx.shape[0], num_channels), K_param.shape[0],
+                        dtype=th.long, device=cls_idx.device)
+        index[:, channels] = cls_idx.long()
+        return cls(factors, index, spectra, crops)
+
+    @classmethod
+    def from_dense(cls, K_params):
+        """
+        Wrap a dense [B x D x L x L] (or [1 x D x L x L]) tensor of factors,
+        keeping every distinct factor once.
+        """
+        B, D, L, _ = K_params.shape
+        factors, index = th.unique(K_params.reshape(B * D, L, L), dim=0, return_inverse=True)
+        return cls(factors, index.reshape(B, D))
+
+    @property
+    def shape(self):
+        L = self.factors.shape[-1]
+        return (*self.index.shape, L, L)
+
+    @property
+    def device(self):
+        return self.factors.device
+
+    def __len__(self):
+        return self.index.shape[0]
+
+    def __getitem__(self, item):
+        index = self.index[item]
+        if index.dim() == 1:
+            index = index[None]
+        return KernelOperator(self.factors, index, self.spectra, self._crops)
+
+    def to(self, device):
+        if self.factors.device == th.device(device) and self.index.device == th.device(device):
+            return self
+        spectra = self.spectra
+        if spectra is not None:
+            spectra = [s if s is None else s.to(device) for s in spectra]
+        return KernelOperator(self.factors.to(device), self.index.to(device), spectra)
+
+    def expand(self, batch_size):
+        """
+        Broadcast a single-row operator to `batch_size` rows without copying factors.
+        """
+        if self.index.shape[0] == batch_size:
+            return self
+        assert self.index.shape[0] == 1, 'Only a single-row operator can be expanded.'
+        return KernelOperator(self.factors, self.index.expand(batch_size, -1), self.spectra, self._crops)
+
+    def repeat_interleave(self, repeats):
+        """
+        Repeat every row `repeats` times (row-major), sharing the factors.
+        """
+        return KernelOperator(self.factors, self.index.repeat_interleave(repeats, dim=0), self.spectra,
+                              self._crops)
+
+    def crop(self, num_frames):
+        """
+        Restrict the kernels to their first `num_frames` frames.
+
+        The marginal of K on a frame prefix is the top-left block of K, so
+        noise drawn with the cropped factors matches the first num_frames
+        frames of a full-length draw. Crops are cached per length.
+        """
+        L = self.factors.shape[-1]
+        if num_frames == L:
+            return self
+        assert 0 < num_frames < L
+        if num_frames not in self._crops:
+            prefix = self.factors[:, :num_frames].double()
+            U, V = th.linalg.eigh(prefix @ prefix.transpose(1, 2))
+            factors = (V * U.clamp(min=0).sqrt()[:, None]).to(self.factors.dtype)  # V @ diag(sqrt(U))
+            spectra = circulant_spectra(factors) if self.spectra is not None else None
+            self._crops[num_frames] = (factors, spectra)
+        factors, spectra = self._crops[num_frames]
+        return KernelOperator(factors, self.index, spectra)
+
+    def dense(self):
+        """
+        Materialize the equivalent dense [B x D x L x L] tensor (for debugging only).
+        """
+        return self.factors[self.index]
+
+    def _grouping(self, batch_size, device):
+        # Sort (sample, channel) rows by factor id once per (batch size, device)
+        # and keep the expanded / moved operator with it, so that repeated
+        # apply() calls on this operator (one per denoising step) are a gather,
+        # F matmuls and a scatter without host syncs.
+        key = (batch_size, str(device))
+        if key not in self._groups:
+            op = self.expand(batch_size).to(device)
+            flat_idx = op.index.reshape(-1)
+            order = th.argsort(flat_idx, stable=True)
+            counts = th.bincount(flat_idx, minlength=op.factors.shape[0]).tolist()
+            self._groups[key] = (op, order, counts)
+        return self._groups[key]
+
+    def apply(self, noise):
+        """
+        Compute K @ noise for every (sample, channel).
+
+        :param noise: a [B x D x 1 x L] (or [B x D x L]) tensor.
+        :return: a tensor of the same shape as noise.
+        """
+        B, D, L = noise.shape[0], noise.shape[1], noise.shape[-1]
+        op, order, counts = self._grouping(B, noise.device)
+        flat = noise.reshape(B * D, L)
+        groups = flat[order].split(counts)
+        factors = op.factors.to(flat.dtype)
+        out = []
+        for f, g in enumerate(groups):
+            if not len(g):
+                continue
+            if op.spectra is not None and op.spectra[f] is not None:
+                out.append(circulant_correlate(op.spectra[f], g))
+            else:
+                out.append(g @ factors[f].T)
+        out = th.cat(out, dim=0)
+        corr = th.empty_like(flat)
+        corr[order] = out
+        return corr.reshape(noise.shape)
+
+
+def circulant_spectrum(factor, tol=1e-5):
+    """
+    Square-root spectrum of the circulant embedding of K = factor @ factor.T.
+
+    On an evenly spaced frame grid a stationary kernel gives a symmetric
+    Toeplitz K. Embedding its first row in a circulant matrix of size
+    M = 2L - 2 lets us draw N(0, K) samples with two FFTs in O(L log L).
+
+    :param factor: an [L x L] kernel factor.
+    :param tol: relative tolerance for the Toeplitz and PSD checks.
+    :return: a [M // 2 + 1] tensor of sqrt(eigenvalues) for rfft, or None when
+             K is not Toeplitz or its embedding is not PSD (callers then fall
+             back to the dense factor).
+    """
+    factor = factor.double()
+    K = factor @ factor.T
+    L = K.shape[0]
+    if L < 3:
+        return None
+    c = K[0]
+    lag = (th.arange(L, device=K.device)[:, None] - th.arange(L, device=K.device)[None]).abs()
+    if (K - c[lag]).abs().max() > tol * c[0].abs():
+        return None
+    embedding = th.cat([c, c[1:-1].flip(0)])
+    eigvals = th.fft.rfft(embedding).real
+    if eigvals.min() < -tol * eigvals.max():
+        return None
+    return eigvals.clamp(min=0).sqrt().float()
+
+
+def circulant_spectra(factors, tol=1e-5):
+    """
+    circulant_spectrum() for every factor in an [F x L x L] stack.
+    """
+    return [circulant_spectrum(f, tol) for f in factors]
+
+
+def circulant_correlate(spectrum, noise):
+    """
+    Correlate white noise with the circulant embedding given by `spectrum`.
+
+    :param spectrum: a [M // 2 + 1] tensor from circulant_spectrum().
+    :param noise: an [N x L] tensor of white noise. It is padded with M - L
+                  fresh standard normals before the transform.
+    :return: an [N x L] tensor with covariance K.
+    """
+    N, L = noise.shape
+    M = 2 * L - 2
+    pad = th.randn(N, M - L, device=noise.device, dtype=noise.dtype)
+    full = th.cat([noise, pad], dim=1)
+    out = th.fft.irfft(spectrum.to(noise) * th.fft.rfft(full, dim=1), n=M, dim=1)
+    return out[:, :L]
+
+
+class KernelFactorCache:
+    """
+    Lazily computed SE kernel factors V @ diag(sqrt(U)), keyed by
+    (hyp_len, num_frames, fps, gain).
+
+    Factors live in a small LRU in memory and, when `cache_dir` is given, in a
+    content-addressed directory of .npy files so that any continuous
+    length-scale costs one decomposition the first time and a load afterwards.
+
+    :param cache_dir: optional directory for the on-disk tier.
+    :param max_items: number of factors kept in memory.
+    :param gain: default kernel gain.
+    :param jitter: diagonal term added to K before the decomposition.
+    :param method: 'eigh' (same factors as train/pre_calK.py) or 'cholesky'.
+    """
+
+    def __init__(self, cache_dir=None, max_items=32, gain=0.1, jitter=1e-6, method='eigh'):
+        assert method in ['eigh', 'cholesky']
+        self.cache_dir = cache_dir
+        self.max_items = max_items
+        self.gain = gain
+        self.jitter = jitter
+        self.method = method
+        self._memory = OrderedDict()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, hyp_len, num_frames, fps, gain=None):
+        gain = self.gain if gain is None else gain
+        desc = {'kernel': 'se', 'hyp_len': float(hyp_len), 'num_frames': int(num_frames), 'fps': float(fps),
+                'gain': float(gain), 'jitter': float(self.jitter), 'method': self.method}
+        return hashlib.sha1(json.dumps(desc, sort_keys=True).encode()).hexdigest()
+
+    def compute(self, hyp_len, num_frames, fps, gain=None):
+        """
+        Decompose the kernel without touching either cache tier.
+        """
+        gain = self.gain if gain is None else gain
+        t = np.linspace(start=0.0, stop=(num_frames / fps), num=num_frames)
+        K = gain * np.exp(-((t[:, None] - t[None]) / hyp_len) ** 2)
+        K = K + self.jitter * np.eye(num_frames, num_frames)
+        if self.method == 'cholesky':
+            return np.linalg.cholesky(K)
+        U, V = np.linalg.eigh(K, UPLO='L')
+        return V @ np.diag(np.sqrt(U))  # [L x L]
+
+    def get(self, hyp_len, num_frames=196, fps=20, gain=None):
+        """
+        :return: an [L x L] float64 numpy factor F with F @ F.T = K.
+        """
+        key = self.key(hyp_len, num_frames, fps, gain)
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return self._memory[key]
+        path = os.path.join(self.cache_dir, key + '.npy') if self.cache_dir else None
+        if path is not None and os.path.exists(path):
+            factor = np.load(path)
+        else:
+            factor = self.compute(hyp_len, num_frames, fps, gain)
+            if path is not None:
+                # write then rename so concurrent readers never see a partial file
+                tmp_path = f'{path}.{os.getpid()}.tmp'
+                with open(tmp_path, 'wb') as f:
+                    np.save(f, factor)
+                os.replace(tmp_path, path)
+        self._memory[key] = factor
+        if len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+        return factor
+
+    def stack(self, hyp_lens, num_frames=196, fps=20, gain=None, device=None):
+        """
+        :return: a [len(hyp_lens) x L x L] float tensor of factors.
+        """
+        factors = np.stack([self.get(h, num_frames, fps, gain) for h in hyp_lens])
+        return th.Tensor(factors).to(device)
+
+    def template(self, num_frames=196, fps=20, gain=None, device=None):
+        """
+        :return: the [L x L] near-white factor used for channels without a predicted kernel.
+        """
+        return self.stack([TEMPLATE_LENGTH_SCALE], num_frames, fps, gain, device)[0]
+
+
+def correlate_noise(K_params, noise):
+    """
+    Apply kernel factors to a [B x D x 1 x L] white-noise tensor.
+
+    :param K_params: a KernelOperator, or a dense [B x D x L x L] (or
+                     [1 x D x L x L]) tensor of factors.
+    :param noise: the white noise to correlate.
+    :return: correlated noise with the same shape as noise.
+    """
+    if isinstance(K_params, KernelOperator):
+        return K_params.apply(noise)
+    noise_expand = noise.squeeze(2).unsqueeze(-1)
+    K_chols = K_params.to(noise.device)
+    if noise.shape[0] != K_chols.shape[0]:
+        K_chols = th.tile(input=K_chols, dims=(noise.shape[0], 1, 1, 1))  # [B x D x L x L]
+    corr_noise = K_chols @ noise_expand  # [B x D x L x 1]
+    corr_noise = corr_noise.squeeze(dim=3)  # [B x D x L]
+    return corr_noise.unsqueeze(2)
+
+
+def get_corr_channels(corr_mode, num_channels):
+    """
+    Channels of the HumanML3D vector that receive a predicted kernel under `corr_mode`.
+    """
+    if corr_mode in ['R_trs', 'all_trs']:
+        return [1, 2]
+    elif corr_mode in ['R_trsrot', 'all_trsrot']:
+        return [0, 1, 2, 3, 193, 194, 195]
+    elif corr_mode == 'LP':
+        return list(range(4, 67))
+    elif corr_mode == 'LBody':
+        return list(range(4, 22))
+    elif corr_mode == 'all':
+        return list(range(num_channels))
+    raise ValueError(f'unknown corr_mode: {corr_mode}')
@@ -0,0 +1,188 @@
+"""
+Versioned, memory-mappable storage for GP kernel factors.
+
+The legacy pickle (see train/pre_calK.py) keeps `template` as a dense
+[D x L x L] float64 array whose rows are all the same matrix. A kernel store
+keeps every distinct factor once and a channel-to-factor index instead:
+
+    MAGIC | uint32 header size | JSON header | padding | factors | template_index
+
+The header records the format version, dtype, shapes and byte offsets, so
+the arrays can be memory-mapped directly.
+"""
+
+import argparse
+import json
+import os
+import pickle as pkl
+import struct
+
+import numpy as np
+import torch
+
+MAGIC = b'GPKSTORE'
+VERSION = 1
+ALIGN = 64
+
+
+def _align(offset):
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+
+def save_kernel_store(path, K_param, template, len_param, dtype='float32', **meta):
+    """
+    Write a kernel store.
+
+    :param K_param: a [C x L x L] array, one factor per length-scale class.
+    :param template: an [L x L] factor or a [D x L x L] per-channel stack.
+    :param len_param: the C length-scales matching K_param.
+    :param dtype: dtype of the stored factors.
+    :param meta: extra JSON-serializable fields (e.g. num_frames, fps, gain).
+    """
+    K_param = np.asarray(K_param, dtype=dtype)
+    template = np.asarray(template, dtype=dtype)
+    if template.ndim == 2:
+        template = template[None]
+    C = K_param.shape[0]
+
+    # deduplicate the template rows; class factors keep ids 0..C-1
+    unique, template_index = [], np.zeros(template.shape[0], dtype=np.int64)
+    for d, row in enumerate(template):
+        for u, other in enumerate(unique):
+            if np.array_equal(row, other):
+                template_index[d] = C + u
+                break
+        else:
+            template_index[d] = C + len(unique)
+            unique.append(row)
+    factors = np.concatenate([K_param, np.stack(unique)], axis=0)
+
+    header = {
+        'version': VERSION,
+        'dtype': np.dtype(dtype).name,
+        'len_param': [float(l) for l in np.asarray(len_param).reshape(-1)],
+        'num_classes': C,
+        'factors': {'shape': list(factors.shape), 'offset': 0},
+        'template_index': {'shape': list(template_index.shape), 'offset': 0},
+        'meta': meta,
+    }
+    # offsets depend on the header size, so settle them with a fixed point
+    while True:
+        data_start = _align(len(MAGIC) + 4 + len(json.dumps(header).encode()))
+        index_start = _align(data_start + factors.nbytes)
+        if header['factors']['offset'] == data_start and header['template_index']['offset'] == index_start:
+            break
+        header['factors']['offset'] = data_start
+        header['template_index']['offset'] = index_start
+    raw_header = json.dumps(header).encode()
+
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<I', len(raw_header)))
+        f.write(raw_header)
+        f.write(b'\0' * (data_start - f.tell()))
+        f.write(factors.tobytes())
+        f.write(b'\0' * (index_start - f.tell()))
+        f.write(template_index.tobytes())
+    os.replace(tmp_path, path)
+
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a kernel store')
+        size, = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(size).decode())
+    if header['version'] > VERSION:
+        raise ValueError(f'{path} has kernel store version {header["version"]}, '
+                         f'this code reads up to {VERSION}')
+    return header
+
+
+def load_kernel_store(path):
+    """
+    Memory-map a kernel store.
+
+    The returned tensors share memory with the file mapping (copy-on-write),
+    so nothing is read until it is used.
+
+    :return: a dict with 'K_param' [C x L x L], 'template' [L x L],
+             'template_index' [D], 'factors' [F x L x L], 'len_param' and 'header'.
+    :raises ValueError: if the channels use different template factors, which
+                        the single [L x L] 'template' cannot represent.
+    """
+    header = read_header(path)
+    dtype = np.dtype(header['dtype'])
+    factors = np.memmap(path, dtype=dtype, mode='c', offset=header['factors']['offset'],
+                        shape=tuple(header['factors']['shape']))
+    template_index = np.memmap(path, dtype=np.int64, mode='c', offset=header['template_index']['offset'],
+                               shape=tuple(header['template_index']['shape']))
+    factors = torch.from_numpy(factors)
+    template_index = torch.from_numpy(template_index)
+    if not bool((template_index == template_index[0]).all()):
+        raise ValueError(f'{path} stores {len(template_index.unique())} different template factors, '
+                         f'the consumers expect one [L x L] template')
+    C = header['num_classes']
+    return {
+        'factors': factors,
+        'K_param': factors[:C],
+        'template': factors[int(template_index[0])],
+        'template_index': template_index,
+        'len_param': np.array(header['len_param']),
+        'header': header,
+    }
+
+
+def convert_pickle(src, dst, dtype='float32'):
+    """
+    Convert a legacy pickle from train/pre_calK.py into a kernel store.
+    """
+    with open(src, 'rb') as f:
+        param_lenK = pkl.load(f)
+    L = param_lenK['K_param'].shape[-1]
+    save_kernel_store(dst, param_lenK['K_param'], param_lenK['template'], param_lenK['len_param'],
+                      dtype=dtype, num_frames=L, source=os.path.basename(src))
+
+
+def load_kernel_bag(path):
+    """
+    Load kernel factors from either a kernel store or a legacy pickle.
+
+    :return: a dict with float32 tensors 'K_param' [C x L x L] and
+             'template' [L x L] plus 'len_param'.
+    """
+    with open(path, 'rb') as f:
+        is_store = f.read(len(MAGIC)) == MAGIC
+    if is_store:
+        store = load_kernel_store(path)
+        if store['factors'].dtype != torch.float32:
+            store['K_param'], store['template'] = store['K_param'].float(), store['template'].float()
+        return store
+    with open(path, 'rb') as f:
+        param_lenK = pkl.load(f)
+    K_param = torch.Tensor(param_lenK['K_param'])
+    template = torch.Tensor(param_lenK['template']).reshape(-1, *K_param.shape[-2:])
+    if not bool((template == template[0]).all()):
+        raise ValueError(f'{path} stores different template factors per channel, '
+                         f'the consumers expect one [L x L] template')
+    template = template[0]
+    return {'K_param': K_param, 'template': template, 'len_param': np.asarray(param_lenK['len_param'])}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert a GP kernel pickle into a memory-mapped kernel store.')
+    parser.add_argument('src', type=str, help='Path to the pickle written by train/pre_calK.py.')
+    parser.add_argument('dst', type=str, nargs='?', default='',
+                        help='Output path. Defaults to the source path with a .kstore suffix.')
+    parser.add_argument('--dtype', default='float32', choices=['float32', 'float64'], type=str)
+    args = parser.parse_args()
+    dst = args.dst or os.path.splitext(args.src)[0] + '.kstore'
+    convert_pickle(args.src, dst, args.dtype)
+    header = read_header(dst)
+    print(f'Wrote {dst}: {header["factors"]["shape"][0]} unique factors, '
+          f'{os.path.getsize(args.src) / 2 ** 20:.1f} MB -> {os.path.getsize(dst) / 2 ** 20:.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
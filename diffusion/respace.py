@@ -84,6 +84,8 @@ class SpacedDiffusion(GaussianDiffusion):
                 self.timestep_map.append(i)
         kwargs["betas"] = np.array(new_betas)
         super().__init__(**kwargs)
+        # device copies of timestep_map, shared by every _WrappedModel
+        self._timestep_map_buffers = {}
 
     def p_mean_variance(
         self, model, *args, **kwargs
@@ -105,7 +107,8 @@ class SpacedDiffusion(GaussianDiffusion):
         if isinstance(model, _WrappedModel):
             return model
         return _WrappedModel(
-            model, self.timestep_map, self.rescale_timesteps, self.original_num_steps
+            model, self.timestep_map, self.rescale_timesteps, self.original_num_steps,
+            map_buffers=self._timestep_map_buffers,
         )
 
     def _scale_timesteps(self, t):
@@ -166,11 +169,18 @@ class SpacedDiffusion(GaussianDiffusion):
 
 
 class _WrappedModel:
-    def __init__(self, model, timestep_map, rescale_timesteps, original_num_steps):
+    def __init__(self, model, timestep_map, rescale_timesteps, original_num_steps, map_buffers=None):
         self.model = model
         self.timestep_map = timestep_map
         self.rescale_timesteps = rescale_timesteps
         self.original_num_steps = original_num_steps
+        self.map_buffers = {} if map_buffers is None else map_buffers
+
+    def _map_tensor(self, ts):
+        key = (ts.device, ts.dtype)
+        if key not in self.map_buffers:
+            self.map_buffers[key] = th.tensor(self.timestep_map, device=ts.device, dtype=ts.dtype)
+        return self.map_buffers[key]
 
     # def __call__(self, x, ts, **kwargs):
     #     map_tensor = th.tensor(self.timestep_map, device=ts.device, dtype=ts.dtype)
@@ -180,8 +190,7 @@ class _WrappedModel:
     #     return self.model(x, new_ts, **kwargs)
     
     def __call__(self, x, ts, len_param, **kwargs):
-        map_tensor = th.tensor(self.timestep_map, device=ts.device, dtype=ts.dtype)
-        new_ts = map_tensor[ts]
+        new_ts = self._map_tensor(ts)[ts]
         if self.rescale_timesteps:
             new_ts = new_ts.float() * (1000.0 / self.original_num_steps)
         return self.model(x, new_ts, len_param, **kwargs)
\ No newline at end of file
@@ -7,12 +7,16 @@ from data_loaders.humanml.networks.evaluator_wrapper import EvaluatorMDMWrapper
 from collections import OrderedDict
 from data_loaders.humanml.scripts.motion_process import *
 from data_loaders.humanml.utils.utils import *
-from utils.model_util import create_model_and_diffusion, load_model_wo_clip
+from utils.model_util import create_model_and_diffusion, load_model_wo_clip, get_sample_fn
 
 from diffusion import logger
 from utils import dist_util
 from data_loaders.get_data import get_dataset_loader
+from data_loaders.humanml.motion_loaders.generation_cache import GenerationCache
+from eval.gt_cache import GTEmbeddings, co_embedding_batches, get_gt_embeddings
+from utils.misc import file_digest
 from model.cfg_sampler import ClassifierFreeSampleModel
+from model.text_store import text_store_digest
 
 torch.multiprocessing.set_sharing_strategy('file_system')
 
@@ -29,17 +33,8 @@ def evaluate_matching_score(eval_wrapper, motion_loaders, file):
         top_k_count = 0
         # print(motion_loader_name)
         with torch.no_grad():
-            for idx, batch in enumerate(motion_loader):
-                word_embeddings, pos_one_hots, _, sent_lens, motions, m_lens, _ = batch
-                text_embeddings, motion_embeddings = eval_wrapper.get_co_embeddings(
-                    word_embs=word_embeddings,
-                    pos_ohot=pos_one_hots,
-                    cap_lens=sent_lens,
-                    motions=motions,
-                    m_lens=m_lens
-                )
-                dist_mat = euclidean_distance_matrix(text_embeddings.cpu().numpy(),
-                                                     motion_embeddings.cpu().numpy())
+            for idx, (text_embeddings, motion_embeddings) in enumerate(co_embedding_batches(eval_wrapper, motion_loader)):
+                dist_mat = euclidean_distance_matrix(text_embeddings, motion_embeddings)
                 matching_score_sum += dist_mat.trace()
 
                 argsmax = np.argsort(dist_mat, axis=1)
@@ -48,7 +43,7 @@ def evaluate_matching_score(eval_wrapper, motion_loaders, file):
 
                 all_size += text_embeddings.shape[0]
 
-                all_motion_embeddings.append(motion_embeddings.cpu().numpy())
+                all_motion_embeddings.append(motion_embeddings)
 
             all_motion_embeddings = np.concatenate(all_motion_embeddings, axis=0)
             matching_score = matching_score_sum / all_size
@@ -73,16 +68,19 @@ def evaluate_fid(eval_wrapper, groundtruth_loader, activation_dict, file):
     eval_dict = OrderedDict({})
     gt_motion_embeddings = []
     print('========== Evaluating FID ==========')
-    with torch.no_grad():
-        for idx, batch in enumerate(groundtruth_loader):
-            _, _, _, sent_lens, motions, m_lens, _ = batch
-            motion_embeddings = eval_wrapper.get_motion_embeddings(
-                motions=motions,
-                m_lens=m_lens
-            )
-            gt_motion_embeddings.append(motion_embeddings.cpu().numpy())
-    gt_motion_embeddings = np.concatenate(gt_motion_embeddings, axis=0)
-    gt_mu, gt_cov = calculate_activation_statistics(gt_motion_embeddings)
+    if isinstance(groundtruth_loader, GTEmbeddings):
+        gt_mu, gt_cov = groundtruth_loader.mu, groundtruth_loader.cov
+    else:
+        with torch.no_grad():
+            for idx, batch in enumerate(groundtruth_loader):
+                _, _, _, sent_lens, motions, m_lens, _ = batch
+                motion_embeddings = eval_wrapper.get_motion_embeddings(
+                    motions=motions,
+                    m_lens=m_lens
+                )
+                gt_motion_embeddings.append(motion_embeddings.cpu().numpy())
+        gt_motion_embeddings = np.concatenate(gt_motion_embeddings, axis=0)
+        gt_mu, gt_cov = calculate_activation_statistics(gt_motion_embeddings)
 
     # print(gt_mu)
     for model_name, motion_embeddings in activation_dict.items():
@@ -135,6 +133,8 @@ def get_metric_statistics(values, replication_times):
     return mean, conf_interval
 
 
+# gt_loader is the ground truth loader, or a function of the replication returning
+# its GTEmbeddings (see get_gt_embeddings())
 def evaluation(eval_wrapper, gt_loader, eval_motion_loaders, log_file, replication_times, diversity_times, mm_num_times, run_mm=False):
     with open(log_file, 'w') as f:
         all_metrics = OrderedDict({'Matching Score': OrderedDict({}),
@@ -145,9 +145,10 @@ def evaluation(eval_wrapper, gt_loader, eval_motion_loaders, log_file, replicati
         for replication in range(replication_times):
             motion_loaders = {}
             mm_motion_loaders = {}
-            motion_loaders['ground truth'] = gt_loader
+            gt_motion_loader = gt_loader(replication) if callable(gt_loader) else gt_loader
+            motion_loaders['ground truth'] = gt_motion_loader
             for motion_loader_name, motion_loader_getter in eval_motion_loaders.items():
-                motion_loader, mm_motion_loader = motion_loader_getter()
+                motion_loader, mm_motion_loader = motion_loader_getter(replication)
                 motion_loaders[motion_loader_name] = motion_loader
                 mm_motion_loaders[motion_loader_name] = mm_motion_loader
 
@@ -159,7 +160,7 @@ def evaluation(eval_wrapper, gt_loader, eval_motion_loaders, log_file, replicati
 
             print(f'Time: {datetime.now()}')
             print(f'Time: {datetime.now()}', file=f, flush=True)
-            fid_score_dict = evaluate_fid(eval_wrapper, gt_loader, acti_dict, f)
+            fid_score_dict = evaluate_fid(eval_wrapper, gt_motion_loader, acti_dict, f)
 
             print(f'Time: {datetime.now()}')
             print(f'Time: {datetime.now()}', file=f, flush=True)
@@ -226,6 +227,24 @@ def evaluation(eval_wrapper, gt_loader, eval_motion_loaders, log_file, replicati
         return mean_dict
 
 
+def generation_cache_config(args, split, num_samples_limit, mm_num_samples, mm_num_repeats):
+    """
+    Everything the generated motions depend on, see GenerationCache. Files
+    enter by content digest, so a checkpoint, length-index annotation or
+    text store rewritten in place still starts a new cache entry.
+    """
+    return dict(checkpoint=file_digest(args.model_path), arch=args.arch, split=split,
+                len_idx=file_digest(args.len_idx_path) if args.len_idx_path else '',
+                text_store=text_store_digest(args.text_store) if args.text_store else '',
+                scale=args.guidance_param, seed=args.seed, sampler=args.sampler,
+                sampling_steps=args.sampling_steps, ddim_eta=args.ddim_eta,
+                # the compiled loop draws another noise stream than the eager one
+                compiled_step=args.compiled_step,
+                length_buckets=args.length_buckets, padding_mask=args.padding_mask, batch_size=args.batch_size,
+                num_samples_limit=num_samples_limit, mm_num_samples=mm_num_samples,
+                mm_num_repeats=mm_num_repeats)
+
+
 if __name__ == '__main__':
     args = evaluation_parser()
     fixseed(args.seed)
@@ -238,6 +257,8 @@ if __name__ == '__main__':
     ckpt = int(''.join(filter(str.isdigit, args.model_path.split('/')[-1])))
     ckpt = str(ckpt // 1000)+'K' if ckpt % 1000==0 else ckpt
     log_file += f'_{args.eval_mode}'
+    if args.sampler != 'ddpm' or args.sampling_steps:
+        log_file += f'_{args.sampler}{args.sampling_steps or args.diffusion_steps}'
     log_file += f'_all_{ckpt}.log'
 
     print(f'Will save to log file [{log_file}]')
@@ -278,6 +299,8 @@ if __name__ == '__main__':
     split = 'test'
     gt_loader = get_dataset_loader(name=args.dataset, batch_size=args.batch_size, num_frames=None, split=split, hml_mode='gt')
     gen_loader = get_dataset_loader(name=args.dataset, batch_size=args.batch_size, num_frames=None, split=split, hml_mode='eval')
+    if args.len_idx_path:
+        gen_loader.dataset.t2m_dataset.load_length_idx(args.len_idx_path)
     num_actions = gen_loader.dataset.num_actions
 
     logger.log("Creating model and diffusion...")
@@ -292,16 +315,34 @@ if __name__ == '__main__':
     model.to(dist_util.dev())
     model.eval()  # disable random masking
 
+    gen_cache = None
+    if args.gen_workers > 1 and not args.gen_cache_dir:
+        raise ValueError('--gen_workers needs --gen_cache_dir, the workers hand their samples over through it')
+    if args.gen_workers > 1 and args.compiled_step:
+        raise ValueError('--gen_workers cannot be combined with --compiled_step, '
+                         'the compiled sampling step cannot be pickled to the workers')
+    if args.gen_cache_dir:
+        gen_cache = GenerationCache(args.gen_cache_dir, **generation_cache_config(
+            args, split, num_samples_limit, mm_num_samples, mm_num_repeats))
+        logger.log(f"Caching generated motions in [{gen_cache.path}]")
+
     eval_motion_loaders = {
         ################
         ## HumanML3D Dataset##
         ################
-        'vald': lambda: get_mdm_loader(
+        'vald': lambda replication: get_mdm_loader(
             model, diffusion, args.batch_size,
             gen_loader, mm_num_samples, mm_num_repeats, 
-            gt_loader.dataset.opt.max_motion_length, num_samples_limit, args.guidance_param
+            gt_loader.dataset.opt.max_motion_length, num_samples_limit, args.guidance_param,
+            sample_fn=get_sample_fn(diffusion, args), cache=gen_cache, replication=replication,
+            world_size=args.gen_workers,
         )
     }
 
-    eval_wrapper = EvaluatorMDMWrapper(args.dataset, dist_util.dev())
-    evaluation(eval_wrapper, gt_loader, eval_motion_loaders, log_file, replication_times, diversity_times, mm_num_times, run_mm=run_mm)
+    eval_wrapper = EvaluatorMDMWrapper(args.dataset, dist_util.dev(), gt_loader.dataset.w_vectorizer)
+    # the loaders hand token ids to the evaluator, which looks up GloVe vectors on its device
+    gt_loader.dataset.t2m_dataset.return_token_ids = True
+    gen_loader.dataset.t2m_dataset.return_token_ids = True
+    gt_embeddings = gt_loader if args.no_gt_cache else (
+        lambda replication: get_gt_embeddings(eval_wrapper, gt_loader, split, replication))
+    evaluation(eval_wrapper, gt_embeddings, eval_motion_loaders, log_file, replication_times, diversity_times, mm_num_times, run_mm=run_mm)
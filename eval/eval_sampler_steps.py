@@ -0,0 +1,144 @@
+"""
+Sweep few-step samplers on HumanML3D and tabulate quality against cost.
+
+Every (sampler, steps) pair runs the t2m evaluation of eval_humanml.py
+(without multimodality) and the results are written as a markdown table of
+steps vs FID / R-precision / diversity / sampling time.
+
+    python -m eval.eval_sampler_steps --model_path ./save/humanml_trans_enc_512/model000475000.pt \
+        --sweep ddpm:1000,ddim:100,ddim:50,ddim:20,dpm_solver:20,dpm_solver:10
+"""
+
+import copy
+import os
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+
+from data_loaders.get_data import get_dataset_loader
+from data_loaders.humanml.motion_loaders.model_motion_loaders import get_mdm_loader
+from data_loaders.humanml.networks.evaluator_wrapper import EvaluatorMDMWrapper
+from diffusion import logger
+from eval.eval_humanml import evaluation
+from eval.gt_cache import get_gt_embeddings
+from model.cfg_sampler import ClassifierFreeSampleModel
+from utils import dist_util
+from utils.fixseed import fixseed
+from utils.model_util import create_model_and_diffusion, create_gaussian_diffusion, get_sample_fn, load_model_wo_clip
+from utils.parser_util import (add_base_options, add_evaluation_options, add_sampler_options,
+                               parse_and_load_from_model)
+
+
+def sweep_args():
+    parser = ArgumentParser()
+    # args specified by the user: (all other will be loaded from the model)
+    add_base_options(parser)
+    add_evaluation_options(parser)
+    add_sampler_options(parser)
+    group = parser.add_argument_group('sweep')
+    group.add_argument("--sweep", default='ddpm:1000,ddim:50,ddim:20,dpm_solver:20,dpm_solver:10', type=str,
+                       help="Comma separated sampler:steps pairs to evaluate.")
+    group.add_argument("--replication_times", default=3, type=int,
+                       help="Evaluation replications per configuration.")
+    return parse_and_load_from_model(parser)
+
+
+def timed(sample_fn, timer):
+    def wrapper(*args, **kwargs):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        sample = sample_fn(*args, **kwargs)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        timer['seconds'] += time.perf_counter() - start
+        timer['batches'] += 1
+        return sample
+    return wrapper
+
+
+def write_table(path, rows):
+    with open(path, 'w') as f:
+        f.write('| sampler | steps | FID | R-precision (top 1/2/3) | Matching | Diversity | sec / batch |\n')
+        f.write('|---|---|---|---|---|---|---|\n')
+        for row in rows:
+            r_prec = '/'.join(f'{r:.3f}' for r in row['R_precision'])
+            f.write(f"| {row['sampler']} | {row['steps']} | {row['FID']:.3f} | {r_prec} | "
+                    f"{row['Matching Score']:.3f} | {row['Diversity']:.3f} | {row['seconds']:.2f} |\n")
+
+
+if __name__ == '__main__':
+    args = sweep_args()
+    fixseed(args.seed)
+    args.batch_size = 32 # This must be 32! Don't change it! otherwise it will cause a bug in R precision calc!
+    niter = os.path.basename(args.model_path).replace('model', '').replace('.pt', '')
+    out_dir = os.path.dirname(args.model_path)
+    table_path = os.path.join(out_dir, f'sampler_steps_{niter}_gscale{args.guidance_param}.md')
+    configs = [(c.split(':')[0], int(c.split(':')[1])) for c in args.sweep.split(',')]
+
+    num_samples_limit = 1000
+    diversity_times = 300
+
+    dist_util.setup_dist(args.device)
+    logger.configure()
+
+    logger.log("creating data loader...")
+    gt_loader = get_dataset_loader(name=args.dataset, batch_size=args.batch_size, num_frames=None, split='test', hml_mode='gt')
+    gen_loader = get_dataset_loader(name=args.dataset, batch_size=args.batch_size, num_frames=None, split='test', hml_mode='eval')
+    if args.len_idx_path:
+        gen_loader.dataset.t2m_dataset.load_length_idx(args.len_idx_path)
+
+    logger.log("Creating model...")
+    model, _ = create_model_and_diffusion(args, gen_loader)
+    logger.log(f"Loading checkpoints from [{args.model_path}]...")
+    state_dict = torch.load(args.model_path, map_location='cpu')
+    load_model_wo_clip(model, state_dict)
+    if args.guidance_param != 1:
+        model = ClassifierFreeSampleModel(model)   # wrapping model with the classifier-free sampler
+    model.to(dist_util.dev())
+    model.eval()  # disable random masking
+
+    eval_wrapper = EvaluatorMDMWrapper(args.dataset, dist_util.dev(), gt_loader.dataset.w_vectorizer)
+    # the loaders hand token ids to the evaluator, which looks up GloVe vectors on its device
+    gt_loader.dataset.t2m_dataset.return_token_ids = True
+    gen_loader.dataset.t2m_dataset.return_token_ids = True
+    gt_embeddings = gt_loader if args.no_gt_cache else (
+        lambda replication: get_gt_embeddings(eval_wrapper, gt_loader, 'test', replication))
+
+    rows = []
+    for sampler, steps in configs:
+        config_args = copy.deepcopy(args)
+        config_args.sampler, config_args.sampling_steps = sampler, steps
+        diffusion = create_gaussian_diffusion(config_args)
+        timer = {'seconds': 0., 'batches': 0}
+        sample_fn = timed(get_sample_fn(diffusion, config_args), timer)
+        name = f'{sampler}{steps}'
+        log_file = os.path.join(out_dir, f'eval_humanml_{niter}_gscale{args.guidance_param}_{name}.log')
+        print(f'Evaluating [{name}], will save to log file [{log_file}]')
+
+        eval_motion_loaders = {
+            name: lambda replication: get_mdm_loader(
+                model, diffusion, args.batch_size,
+                gen_loader, 0, 0,
+                gt_loader.dataset.opt.max_motion_length, num_samples_limit, args.guidance_param,
+                sample_fn=sample_fn,
+            )
+        }
+        mean_dict = evaluation(eval_wrapper, gt_embeddings, eval_motion_loaders, log_file,
+                               args.replication_times, diversity_times, 0, run_mm=False)
+        rows.append({
+            'sampler': sampler,
+            'steps': steps,
+            'FID': mean_dict[f'FID_{name}'],
+            'R_precision': np.asarray(mean_dict[f'R_precision_{name}']),
+            'Matching Score': mean_dict[f'Matching Score_{name}'],
+            'Diversity': mean_dict[f'Diversity_{name}'],
+            'seconds': timer['seconds'] / max(timer['batches'], 1),
+        })
+        write_table(table_path, rows)  # keep partial results if a later config fails
+
+    print(f'Wrote [{table_path}]')
+    with open(table_path) as f:
+        print(f.read())
@@ -0,0 +1,142 @@
+"""
+On-disk cache of the ground-truth evaluator embeddings of the t2m evaluation.
+
+Every replication of eval_humanml.evaluation() ran the whole test split
+through the T2M evaluator twice (matching score / R-precision, then the FID
+statistics) although neither the motions nor the evaluator change. The
+cache, in <data_root>/eval_cache/, holds
+- gt_<key>_fid.npz: the activation statistics of one FID pass, shared by
+  all replications;
+- gt_<key>_rep<r>.npz: the text and motion co-embeddings of the matching
+  pass of replication r, in the order of the gt loader's batches.
+The key hashes the evaluator checkpoint, the split, its clips, the
+normalization and the batch size, so any of them changing starts a new
+cache entry.
+
+Each pass is its own draw of the gt loader (shuffle, crops, captions): the
+ground truth rows differ between replications and the ground truth FID is
+measured between two draws, as without the cache. A first run encodes the
+ground truth replications + 1 times instead of twice per replication, and
+later runs not at all.
+"""
+
+import hashlib
+import os
+from os.path import join as pjoin
+
+import numpy as np
+import torch
+
+from data_loaders.humanml.utils.metrics import calculate_activation_statistics
+from utils.misc import file_digest
+
+
+def gt_cache_key(checkpoint_path, gt_loader, split):
+    dataset = gt_loader.dataset
+    t2m_dataset = dataset.t2m_dataset
+    digest = hashlib.sha1(file_digest(checkpoint_path).encode())
+    digest.update(f'{dataset.opt.dataset_name}/{split}/{gt_loader.batch_size}\n'.encode())
+    digest.update('\n'.join(t2m_dataset.name_list).encode())
+    digest.update(np.asarray(t2m_dataset.length_arr, dtype=np.int64).tobytes())
+    for array in (dataset.mean, dataset.std):
+        digest.update(np.asarray(array, dtype=np.float64).tobytes())
+    return digest.hexdigest()[:16]
+
+
+def co_embedding_batches(eval_wrapper, motion_loader):
+    """
+    Yield the (text, motion) co-embeddings of every batch of `motion_loader`
+    as numpy arrays, or the cached batches of a GTEmbeddings.
+    """
+    if isinstance(motion_loader, GTEmbeddings):
+        yield from motion_loader.batches()
+        return
+    for batch in motion_loader:
+        word_embeddings, pos_one_hots, _, sent_lens, motions, m_lens, _ = batch
+        text_embeddings, motion_embeddings = eval_wrapper.get_co_embeddings(
+            word_embs=word_embeddings,
+            pos_ohot=pos_one_hots,
+            cap_lens=sent_lens,
+            motions=motions,
+            m_lens=m_lens
+        )
+        yield text_embeddings.cpu().numpy(), motion_embeddings.cpu().numpy()
+
+
+class GTEmbeddings:
+    """
+    Ground truth co-embeddings, row aligned ([N x D] text and motion, as
+    returned by get_co_embeddings()), in batches of `batch_size` rows, and
+    the FID statistics of the motion embeddings of another draw of the gt
+    loader. Passed to evaluation() in place of the gt loader.
+    """
+
+    def __init__(self, text_embeddings, motion_embeddings, batch_size, mu, cov):
+        self.text_embeddings = text_embeddings
+        self.motion_embeddings = motion_embeddings
+        self.batch_size = batch_size
+        self.mu, self.cov = mu, cov
+
+    @classmethod
+    def compute(cls, eval_wrapper, gt_loader, mu, cov):
+        with torch.no_grad():
+            text_embeddings, motion_embeddings = zip(*co_embedding_batches(eval_wrapper, gt_loader))
+        return cls(np.concatenate(text_embeddings), np.concatenate(motion_embeddings), gt_loader.batch_size, mu, cov)
+
+    def batches(self):
+        for start in range(0, len(self.text_embeddings), self.batch_size):
+            yield (self.text_embeddings[start:start + self.batch_size],
+                   self.motion_embeddings[start:start + self.batch_size])
+
+    def save(self, path):
+        _save_npz(path, text_embeddings=self.text_embeddings, motion_embeddings=self.motion_embeddings,
+                  batch_size=self.batch_size)
+
+    @classmethod
+    def load(cls, path, mu, cov):
+        data = np.load(path)
+        return cls(data['text_embeddings'], data['motion_embeddings'], int(data['batch_size']), mu, cov)
+
+
+def _save_npz(path, **arrays):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)  # a killed run never leaves a truncated entry
+
+
+def gt_fid_statistics(eval_wrapper, gt_loader):
+    """
+    The FID pass of evaluate_fid(): mean and covariance of the motion embeddings of one draw.
+    """
+    with torch.no_grad():
+        motion_embeddings = [eval_wrapper.get_motion_embeddings(motions=motions, m_lens=m_lens).cpu().numpy()
+                             for _, _, _, _, motions, m_lens, _ in gt_loader]
+    return calculate_activation_statistics(np.concatenate(motion_embeddings))
+
+
+def get_gt_embeddings(eval_wrapper, gt_loader, split, replication, cache_dir=None):
+    """
+    Load the cached ground truth embeddings of `gt_loader` for a replication,
+    or run the evaluator over it and cache the result. The FID statistics
+    are computed once and shared by all replications.
+
+    :param cache_dir: defaults to <data_root>/eval_cache.
+    """
+    cache_dir = cache_dir or pjoin(gt_loader.dataset.opt.data_root, 'eval_cache')
+    key = gt_cache_key(eval_wrapper.checkpoint_path, gt_loader, split)
+    path = pjoin(cache_dir, f'gt_{key}_rep{replication:02d}.npz')
+    fid_path = pjoin(cache_dir, f'gt_{key}_fid.npz')
+    if os.path.exists(fid_path):
+        fid_stats = np.load(fid_path)
+        mu, cov = fid_stats['mu'], fid_stats['cov']
+    else:
+        mu, cov = gt_fid_statistics(eval_wrapper, gt_loader)
+        _save_npz(fid_path, mu=mu, cov=cov)
+    if os.path.exists(path):
+        print(f'Loading ground truth embeddings from [{path}]')
+        return GTEmbeddings.load(path, mu, cov)
+    gt_embeddings = GTEmbeddings.compute(eval_wrapper, gt_loader, mu, cov)
+    gt_embeddings.save(path)
+    print(f'Saved ground truth embeddings to [{path}]')
+    return gt_embeddings
@@ -0,0 +1,132 @@
+"""
+Per-channel length-scale class ids from the frozen length prediction model,
+and an on-disk cache for them.
+"""
+
+import os
+import pickle as pkl
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from lpm.model import LengthPredctionUnet
+
+LPM_PATH = './save/final_lpm.pt'
+
+
+def load_length_module(device, model_pth=LPM_PATH):
+    """
+    Build the LengthPredctionUnet used for HumanML3D and load its frozen weights.
+    """
+    length_module = LengthPredctionUnet(
+        name                 = 'unet',
+        dims                 = 1,
+        n_in_channels        = 1,
+        n_base_channels      = 128,
+        n_emb_dim            = 128,
+        n_cond_dim           = 1,
+        n_time_dim           = 0,
+        n_enc_blocks         = 7, # number of encoder blocks
+        n_groups             = 16, # group norm paramter
+        n_heads              = 4, # number of heads in QKV attention
+        actv                 = nn.SiLU(),
+        kernel_size          = 3, # kernel size (3)
+        padding              = 1, # padding size (1)
+        use_attention        = False,
+        skip_connection      = True, # additional skip connection
+        chnnel_multiples     = [1,2,2,2,4,4,8],
+        updown_rates         = [1,1,2,1,2,1,2],
+        use_scale_shift_norm = True,
+        device               = device,
+    ) # input:[B x C x L] => output:[B x C x L]
+    length_module.load_state_dict(torch.load(model_pth, map_location='cpu')['model_state_dict'])
+    length_module.to(device)
+    length_module.eval()
+    return length_module
+
+
+def predict_length_idx(length_module, motion, lengths, channels):
+    """
+    Predict a length-scale class for every (sample, channel).
+
+    Batches shorter than the LPM's training length (length-bucketed loaders)
+    are zero-padded to it, as the dataset pads clips to max_motion_length.
+
+    :param motion: a [B x D x 1 x L] normalized motion batch.
+    :param lengths: a [B] tensor of true motion lengths.
+    :param channels: the channels to annotate.
+    :return: a [B x len(channels)] long tensor of class ids.
+    """
+    input_motion = motion[:, channels]
+    if input_motion.shape[-1] < length_module.length:
+        input_motion = F.pad(input_motion, (0, length_module.length - input_motion.shape[-1]))
+    B, D, _, L = input_motion.shape
+    input_motion = input_motion.reshape(B * D, 1, L)
+    true_length = lengths.to(motion.device).repeat_interleave(D).float()
+    with torch.no_grad():
+        output = length_module(input_motion, c=true_length)
+    return output.argmax(dim=1).reshape(B, D)
+
+
+class LengthIndexCache:
+    """
+    Length-scale class ids keyed by (clip key, crop offset, crop length), the
+    clip key being the stable 'key' of the dataset entry (name#start#end for
+    sub-clips).
+
+    The LPM only sees the cropped ground-truth motion, so its prediction is a
+    pure function of that key. Ids are stored as uint8 for the channels of one
+    corr_mode, and a cache built for other channels is rejected.
+
+    :param path: pickle file backing the cache; loaded if it exists.
+    :param channels: the channels whose ids are cached.
+    """
+
+    def __init__(self, path, channels):
+        self.path = path
+        self.channels = list(channels)
+        self.ids = {}
+        self.dirty = False
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                data = pkl.load(f)
+            if data['channels'] != self.channels:
+                raise ValueError(f'{path} caches channels {data["channels"]}, expected {self.channels}')
+            self.ids = data['ids']
+
+    def __len__(self):
+        return len(self.ids)
+
+    @staticmethod
+    def key(name, offset, length):
+        return f'{name}:{int(offset)}:{int(length)}'
+
+    def lookup(self, crop_keys):
+        """
+        :param crop_keys: a list of (clip key, offset, length) tuples.
+        :return: a [B x len(channels)] uint8 array (zeros for misses) and a [B] bool hit mask.
+        """
+        ids = np.zeros((len(crop_keys), len(self.channels)), dtype=np.uint8)
+        hit = np.zeros(len(crop_keys), dtype=bool)
+        for i, crop_key in enumerate(crop_keys):
+            cached = self.ids.get(self.key(*crop_key))
+            if cached is not None:
+                ids[i], hit[i] = cached, True
+        return ids, hit
+
+    def update(self, crop_keys, ids):
+        ids = np.asarray(ids, dtype=np.uint8)
+        for crop_key, row in zip(crop_keys, ids):
+            self.ids[self.key(*crop_key)] = row
+        self.dirty = self.dirty or len(crop_keys) > 0
+
+    def save(self):
+        if not self.dirty:
+            return
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pkl.dump({'channels': self.channels, 'ids': self.ids}, f)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
@@ -7,9 +7,11 @@ from copy import deepcopy
 # https://arxiv.org/abs/2207.12598
 class ClassifierFreeSampleModel(nn.Module):
 
-    def __init__(self, model):
+    def __init__(self, model, batched=True):
         super().__init__()
         self.model = model  # model is the actual model to run
+        # run the conditional and unconditional halves as one 2B batch instead of two passes
+        self.batched = batched
 
         assert self.model.cond_mask_prob > 0, 'Cannot run a guided diffusion on a model that has not been trained with no conditions'
 
@@ -20,6 +22,7 @@ class ClassifierFreeSampleModel(nn.Module):
         self.nfeats = self.model.nfeats
         self.data_rep = self.model.data_rep
         self.cond_mode = self.model.cond_mode
+        self.encode_text = self.model.encode_text
 
     # def forward(self, x, timesteps, y=None):
     #     cond_mode = self.model.cond_mode
@@ -34,9 +37,31 @@ class ClassifierFreeSampleModel(nn.Module):
     def forward(self, x, timesteps, len_param=None, y=None):
         cond_mode = self.model.cond_mode
         assert cond_mode in ['text', 'action']
+        if self.batched:
+            return self.forward_batched(x, timesteps, len_param, y)
         y_uncond = deepcopy(y)
         y_uncond['uncond'] = True
         out = self.model(x, timesteps, len_param, y)
         out_uncond = self.model(x, timesteps,len_param, y_uncond)
         return out_uncond + (y['scale'].view(-1, 1, 1, 1) * (out - out_uncond))
 
+    def forward_batched(self, x, timesteps, len_param=None, y=None):
+        bs = x.shape[0]
+        y_both = {}
+        for key, val in y.items():
+            if torch.is_tensor(val) and val.dim() > 0 and val.shape[0] == bs:
+                y_both[key] = torch.cat([val, val])
+            elif isinstance(val, (list, tuple)) and len(val) == bs:
+                y_both[key] = list(val) + list(val)
+            else:
+                y_both[key] = val
+        if 'text' in self.cond_mode and 'enc_text' not in y:
+            # encode once instead of encoding the duplicated captions
+            y_both['enc_text'] = self.model.encode_text(y['text']).repeat(2, 1)
+        # per-row condition mask: rows [bs:] are the unconditional half
+        y_both['uncond'] = torch.arange(2 * bs, device=x.device) >= bs
+        if len_param is not None and len_param.shape[0] == bs:
+            len_param = torch.cat([len_param, len_param])
+        out_both = self.model(torch.cat([x, x]), torch.cat([timesteps, timesteps]), len_param, y_both)
+        out, out_uncond = out_both[:bs], out_both[bs:]
+        return out_uncond + (y['scale'].view(-1, 1, 1, 1) * (out - out_uncond))
@@ -1,9 +1,12 @@
+import copy
+
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import clip
 from model.rotation2xyz import Rotation2xyz
+from model.text_store import ClipTextStore, clip_tokenize
 
         
 class MDM(nn.Module):
@@ -43,10 +46,15 @@ class MDM(nn.Module):
         self.normalize_output = kargs.get('normalize_encoder_output', False)
 
         self.cond_mode = kargs.get('cond_mode', 'no_cond')
+        # ignore padded frames (y['mask'] == False) in the encoder's self-attention
+        self.padding_mask = kargs.get('padding_mask', False)
         self.cond_mask_prob = kargs.get('cond_mask_prob', 0.)
         self.arch = arch
         self.gru_emb_dim = self.latent_dim if self.arch == 'gru' else 0
-        self.input_process = InputProcess(self.data_rep, self.input_feats+self.gru_emb_dim, self.latent_dim)
+        # trans_enc_sdpa keeps tokens batch-first ([bs, seqlen, d]) end to end
+        self.batch_first = self.arch == 'trans_enc_sdpa'
+        self.input_process = InputProcess(self.data_rep, self.input_feats+self.gru_emb_dim, self.latent_dim,
+                                          batch_first=self.batch_first)
 
         self.sequence_pos_encoder = PositionalEncoding(self.latent_dim, self.dropout)
         self.emb_trans_dec = emb_trans_dec
@@ -61,6 +69,14 @@ class MDM(nn.Module):
 
             self.seqTransEncoder = nn.TransformerEncoder(seqTransEncoderLayer,
                                                          num_layers=self.num_layers)
+        elif self.arch == 'trans_enc_sdpa':
+            print("TRANS_ENC (SDPA) init")
+            seqTransEncoderLayer = SDPAEncoderLayer(d_model=self.latent_dim,
+                                                    nhead=self.num_heads,
+                                                    dim_feedforward=self.ff_size,
+                                                    dropout=self.dropout,
+                                                    activation=self.activation)
+            self.seqTransEncoder = SDPAEncoder(seqTransEncoderLayer, num_layers=self.num_layers)
         elif self.arch == 'trans_dec':
             print("TRANS_DEC init")
             seqTransDecoderLayer = nn.TransformerDecoderLayer(d_model=self.latent_dim,
@@ -74,7 +90,7 @@ class MDM(nn.Module):
             print("GRU init")
             self.gru = nn.GRU(self.latent_dim, self.latent_dim, num_layers=self.num_layers, batch_first=True)
         else:
-            raise ValueError('Please choose correct architecture [trans_enc, trans_dec, gru]')
+            raise ValueError('Please choose correct architecture [trans_enc, trans_enc_sdpa, trans_dec, gru]')
 
         self.embed_timestep = TimestepEmbedder(self.latent_dim, self.sequence_pos_encoder)
 
@@ -84,7 +100,14 @@ class MDM(nn.Module):
                 print('EMBED TEXT')
                 print('Loading CLIP...')
                 self.clip_version = clip_version
-                self.clip_model = self.load_and_freeze_clip(clip_version)
+                self.text_store = None
+                if kargs.get('text_store', ''):
+                    # precomputed caption embeddings; CLIP is then only loaded for unseen prompts
+                    self.text_store = ClipTextStore(kargs['text_store'])
+                    self.text_store.check(clip_version, self.max_text_len)
+                    self.clip_model = None
+                else:
+                    self.clip_model = self.load_and_freeze_clip(clip_version)
             if 'action' in self.cond_mode:
                 self.embed_action = EmbedAction(self.num_actions, self.latent_dim)
                 print('EMBED ACTION')
@@ -95,7 +118,7 @@ class MDM(nn.Module):
             )
         
         self.output_process = OutputProcess(self.data_rep, self.input_feats, self.latent_dim, self.njoints,
-                                            self.nfeats)
+                                            self.nfeats, batch_first=self.batch_first)
 
         self.rot2xyz = Rotation2xyz(device='cpu', dataset=self.dataset)
 
@@ -117,6 +140,10 @@ class MDM(nn.Module):
 
     def mask_cond(self, cond, force_mask=False):
         bs, d = cond.shape
+        if torch.is_tensor(force_mask):
+            # [bs] bool per-row mask, e.g. the unconditional half of a batched CFG pass
+            cond = cond * (1. - force_mask.view(bs, 1).to(cond.dtype))
+            force_mask = False
         if force_mask:
             return torch.zeros_like(cond)
         elif self.training and self.cond_mask_prob > 0.:
@@ -125,21 +152,27 @@ class MDM(nn.Module):
         else:
             return cond
 
+    @property
+    def max_text_len(self):
+        return 20 if self.dataset in ['humanml', 'kit'] else None  # Specific hardcoding for humanml dataset
+
     def encode_text(self, raw_text):
         # raw_text - list (batch_size length) of strings with input text prompts
+        if self.text_store is None:
+            return self.encode_text_clip(raw_text)
         device = next(self.parameters()).device
-        max_text_len = 20 if self.dataset in ['humanml', 'kit'] else None  # Specific hardcoding for humanml dataset
-        if max_text_len is not None:
-            default_context_length = 77
-            context_length = max_text_len + 2 # start_token + 20 + end_token
-            assert context_length < default_context_length
-            texts = clip.tokenize(raw_text, context_length=context_length, truncate=True).to(device) # [bs, context_length] # if n_tokens > context_length -> will truncate
-            # print('texts', texts.shape)
-            zero_pad = torch.zeros([texts.shape[0], default_context_length-context_length], dtype=texts.dtype, device=texts.device)
-            texts = torch.cat([texts, zero_pad], dim=1)
-            # print('texts after pad', texts.shape, texts)
-        else:
-            texts = clip.tokenize(raw_text, truncate=True).to(device) # [bs, context_length] # if n_tokens > 77 -> will truncate
+        enc_text, hit = self.text_store.lookup(raw_text)
+        enc_text = enc_text.to(device)
+        if not hit.all():
+            miss = np.flatnonzero(~hit)
+            enc_text[miss] = self.encode_text_clip([raw_text[i] for i in miss])
+        return enc_text
+
+    def encode_text_clip(self, raw_text):
+        device = next(self.parameters()).device
+        if self.clip_model is None:
+            self.clip_model = self.load_and_freeze_clip(self.clip_version).to(device)
+        texts = clip_tokenize(raw_text, self.max_text_len).to(device) # [bs, 77]
         return self.clip_model.encode_text(texts).float()
 
     def forward(self, x, timesteps, len_param=None, y=None):
@@ -155,7 +188,8 @@ class MDM(nn.Module):
             len_emb = self.len_embedding(len_param)
         force_mask = y.get('uncond', False)
         if 'text' in self.cond_mode:
-            enc_text = self.encode_text(y['text'])
+            # precomputed embeddings (see diffusion.gaussian_diffusion.encode_text_once) skip CLIP
+            enc_text = y['enc_text'] if 'enc_text' in y else self.encode_text(y['text'])
             emb += self.embed_text(self.mask_cond(enc_text, force_mask=force_mask))
         if 'action' in self.cond_mode:
             action_emb = self.embed_action(y['action'])
@@ -175,21 +209,37 @@ class MDM(nn.Module):
                 if len_emb is not None : 
                     xseq = torch.cat((emb, len_emb, x), axis=0)
                     xseq = self.sequence_pos_encoder(xseq)  # [seqlen+2, bs, d]
-                    output = self.seqTransEncoder(xseq)[2:]  # , src_key_padding_mask=~maskseq)  # [seqlen, bs, d]
+                    output = self.seqTransEncoder(xseq, src_key_padding_mask=self.key_padding_mask(y, bs, nframes, 2))[2:]  # [seqlen, bs, d]
                 else : 
                     xseq = torch.cat((emb, x), axis=0)
                     xseq = self.sequence_pos_encoder(xseq)  # [seqlen+2, bs, d]
-                    output = self.seqTransEncoder(xseq)[1:]  # , src_key_padding_mask=~maskseq)  # [seqlen, bs, d]
+                    output = self.seqTransEncoder(xseq, src_key_padding_mask=self.key_padding_mask(y, bs, nframes, 1))[1:]  # [seqlen, bs, d]
             else :         
                 if len_emb is not None :     
                     emb += len_emb 
                     xseq = torch.cat((emb, x), axis=0)  # [seqlen+1, bs, d]
                     xseq = self.sequence_pos_encoder(xseq)  # [seqlen+1, bs, d]
-                    output = self.seqTransEncoder(xseq)[1:]  # , src_key_padding_mask=~maskseq)  # [seqlen, bs, d]
+                    output = self.seqTransEncoder(xseq, src_key_padding_mask=self.key_padding_mask(y, bs, nframes, 1))[1:]  # [seqlen, bs, d]
                 else : 
                     xseq = torch.cat((emb, x), axis=0)  # [seqlen+1, bs, d]
                     xseq = self.sequence_pos_encoder(xseq)  # [seqlen+1, bs, d]
-                    output = self.seqTransEncoder(xseq)[1:]  # , src_key_padding_mask=~maskseq)  # [seqlen, bs, d]
+                    output = self.seqTransEncoder(xseq, src_key_padding_mask=self.key_padding_mask(y, bs, nframes, 1))[1:]  # [seqlen, bs, d]
+
+        elif self.arch == 'trans_enc_sdpa':
+            emb = emb.permute(1, 0, 2)  # [bs, 1, d]
+            if len_emb is not None:
+                # [bs, 1, d]; a single len_param row is broadcast over the batch, as in trans_enc
+                len_emb = len_emb.reshape(-1, 1, self.latent_dim).expand(bs, -1, -1)
+            if len_emb is not None and self.len_token:
+                prefix = [emb, len_emb]
+            elif len_emb is not None:
+                prefix = [emb + len_emb]
+            else:
+                prefix = [emb]
+            xseq = torch.cat(prefix + [x], axis=1)  # [bs, seqlen+1, d]
+            xseq = self.sequence_pos_encoder(xseq, batch_first=True)  # [bs, seqlen+1, d]
+            output = self.seqTransEncoder(xseq, src_key_padding_mask=self.key_padding_mask(y, bs, nframes, len(prefix)))
+            output = output[:, len(prefix):]  # [bs, seqlen, d]
 
         elif self.arch == 'trans_dec':
             if self.emb_trans_dec:
@@ -209,15 +259,31 @@ class MDM(nn.Module):
         output = self.output_process(output)  # [bs, njoints, nfeats, nframes]
         return output
 
+    def key_padding_mask(self, y, bs, nframes, num_prefix):
+        """
+        src_key_padding_mask for [prefix tokens, frames]: True on frames past
+        each sample's length (a mask shorter than nframes counts as padded).
+        None when padding_mask is off or y carries no mask.
+        """
+        if not self.padding_mask or 'mask' not in y:
+            return None
+        valid = y['mask'].reshape(bs, -1)[:, :nframes].bool()  # [bs, nframes]
+        mask = torch.ones(bs, num_prefix + nframes, dtype=torch.bool, device=valid.device)
+        mask[:, :num_prefix] = False  # condition tokens are always attended
+        mask[:, num_prefix:num_prefix + valid.shape[1]] = ~valid
+        return mask
+
 
     def _apply(self, fn):
         super()._apply(fn)
-        self.rot2xyz.smpl_model._apply(fn)
+        self.rot2xyz._apply(fn)  # no-op until SMPL is loaded
+        return self
 
 
     def train(self, *args, **kwargs):
         super().train(*args, **kwargs)
-        self.rot2xyz.smpl_model.train(*args, **kwargs)
+        self.rot2xyz.train(*args, **kwargs)
+        return self
 
 
 class PositionalEncoding(nn.Module):
@@ -235,9 +301,12 @@ class PositionalEncoding(nn.Module):
 
         self.register_buffer('pe', pe)
 
-    def forward(self, x):
+    def forward(self, x, batch_first=False):
         # not used in the final model
-        x = x + self.pe[:x.shape[0], :]
+        if batch_first:
+            x = x + self.pe[:x.shape[1], :].transpose(0, 1)
+        else:
+            x = x + self.pe[:x.shape[0], :]
         return self.dropout(x)
 
 
@@ -259,17 +328,25 @@ class TimestepEmbedder(nn.Module):
 
 
 class InputProcess(nn.Module):
-    def __init__(self, data_rep, input_feats, latent_dim):
+    def __init__(self, data_rep, input_feats, latent_dim, batch_first=False):
         super().__init__()
         self.data_rep = data_rep
         self.input_feats = input_feats
         self.latent_dim = latent_dim
+        self.batch_first = batch_first
         self.poseEmbedding = nn.Linear(self.input_feats, self.latent_dim)
         if self.data_rep == 'rot_vel':
             self.velEmbedding = nn.Linear(self.input_feats, self.latent_dim)
 
     def forward(self, x):
         bs, njoints, nfeats, nframes = x.shape
+        if self.batch_first:
+            x = x.reshape(bs, njoints*nfeats, nframes).transpose(1, 2)  # [bs, seqlen, 150]
+            if self.data_rep == 'rot_vel':
+                first_pose = self.poseEmbedding(x[:, [0]])  # [bs, 1, d]
+                vel = self.velEmbedding(x[:, 1:])  # [bs, seqlen-1, d]
+                return torch.cat((first_pose, vel), axis=1)  # [bs, seqlen, d]
+            return self.poseEmbedding(x)  # [bs, seqlen, d]
         x = x.permute((3, 0, 1, 2)).reshape(nframes, bs, njoints*nfeats)
 
         if self.data_rep in ['rot6d', 'xyz', 'hml_vec']:
@@ -286,18 +363,26 @@ class InputProcess(nn.Module):
 
 
 class OutputProcess(nn.Module):
-    def __init__(self, data_rep, input_feats, latent_dim, njoints, nfeats):
+    def __init__(self, data_rep, input_feats, latent_dim, njoints, nfeats, batch_first=False):
         super().__init__()
         self.data_rep = data_rep
         self.input_feats = input_feats
         self.latent_dim = latent_dim
         self.njoints = njoints
         self.nfeats = nfeats
+        self.batch_first = batch_first
         self.poseFinal = nn.Linear(self.latent_dim, self.input_feats)
         if self.data_rep == 'rot_vel':
             self.velFinal = nn.Linear(self.latent_dim, self.input_feats)
 
     def forward(self, output):
+        if self.batch_first:
+            bs, nframes, d = output.shape
+            if self.data_rep == 'rot_vel':
+                output = torch.cat((self.poseFinal(output[:, [0]]), self.velFinal(output[:, 1:])), axis=1)
+            else:
+                output = self.poseFinal(output)  # [bs, seqlen, 150]
+            return output.reshape(bs, nframes, self.njoints, self.nfeats).permute(0, 2, 3, 1)  # [bs, njoints, nfeats, nframes]
         nframes, bs, d = output.shape
         if self.data_rep in ['rot6d', 'xyz', 'hml_vec']:
             output = self.poseFinal(output)  # [seqlen, bs, 150]
@@ -322,4 +407,69 @@ class EmbedAction(nn.Module):
     def forward(self, input):
         idx = input[:, 0].to(torch.long)  # an index array must be long
         output = self.action_embedding[idx]
-        return output
\ No newline at end of file
+        return output
+
+
+class SDPASelfAttention(nn.Module):
+    """
+    Batch-first multi-head self-attention on F.scaled_dot_product_attention.
+
+    Parameters are named and shaped like nn.MultiheadAttention's
+    (in_proj_weight, in_proj_bias, out_proj), so its weights load as is.
+    """
+    def __init__(self, d_model, nhead, dropout=0.):
+        super().__init__()
+        self.nhead = nhead
+        self.dropout = dropout
+        self.in_proj_weight = nn.Parameter(torch.empty(3 * d_model, d_model))
+        self.in_proj_bias = nn.Parameter(torch.empty(3 * d_model))
+        self.out_proj = nn.Linear(d_model, d_model)
+        nn.init.xavier_uniform_(self.in_proj_weight)
+        nn.init.zeros_(self.in_proj_bias)
+        nn.init.zeros_(self.out_proj.bias)
+
+    def forward(self, x, attn_mask=None):
+        bs, seqlen, d = x.shape
+        qkv = F.linear(x, self.in_proj_weight, self.in_proj_bias)
+        q, k, v = qkv.view(bs, seqlen, 3, self.nhead, d // self.nhead).permute(2, 0, 3, 1, 4)  # 3 x [bs, h, seqlen, d/h]
+        out = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask,
+                                             dropout_p=self.dropout if self.training else 0.)
+        return self.out_proj(out.transpose(1, 2).reshape(bs, seqlen, d))
+
+
+class SDPAEncoderLayer(nn.Module):
+    """
+    A batch-first, post-norm stand-in for nn.TransformerEncoderLayer with the
+    same parameter names, so trans_enc checkpoints load into trans_enc_sdpa.
+    """
+    def __init__(self, d_model, nhead, dim_feedforward=2048, dropout=0.1, activation="gelu"):
+        super().__init__()
+        self.self_attn = SDPASelfAttention(d_model, nhead, dropout=dropout)
+        self.linear1 = nn.Linear(d_model, dim_feedforward)
+        self.dropout = nn.Dropout(dropout)
+        self.linear2 = nn.Linear(dim_feedforward, d_model)
+        self.norm1 = nn.LayerNorm(d_model)
+        self.norm2 = nn.LayerNorm(d_model)
+        self.dropout1 = nn.Dropout(dropout)
+        self.dropout2 = nn.Dropout(dropout)
+        self.activation = getattr(F, activation)
+
+    def forward(self, x, attn_mask=None):
+        x = self.norm1(x + self.dropout1(self.self_attn(x, attn_mask)))
+        return self.norm2(x + self.dropout2(self.linear2(self.dropout(self.activation(self.linear1(x))))))
+
+
+class SDPAEncoder(nn.Module):
+    """
+    A stack of SDPAEncoderLayer clones, laid out like nn.TransformerEncoder.
+    """
+    def __init__(self, encoder_layer, num_layers):
+        super().__init__()
+        self.layers = nn.ModuleList([copy.deepcopy(encoder_layer) for _ in range(num_layers)])
+
+    def forward(self, x, src_key_padding_mask=None):
+        # SDPA takes a boolean mask of the keys to attend to, broadcast over heads and queries
+        attn_mask = None if src_key_padding_mask is None else ~src_key_padding_mask[:, None, None, :]
+        for layer in self.layers:
+            x = layer(x, attn_mask)
+        return x
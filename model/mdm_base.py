@@ -190,12 +190,14 @@ class MDM(nn.Module):
 
     def _apply(self, fn):
         super()._apply(fn)
-        self.rot2xyz.smpl_model._apply(fn)
+        self.rot2xyz._apply(fn)  # no-op until SMPL is loaded
+        return self
 
 
     def train(self, *args, **kwargs):
         super().train(*args, **kwargs)
-        self.rot2xyz.smpl_model.train(*args, **kwargs)
+        self.rot2xyz.train(*args, **kwargs)
+        return self
 
 
 class PositionalEncoding(nn.Module):
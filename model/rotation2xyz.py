@@ -12,16 +12,59 @@ class Rotation2xyz:
     def __init__(self, device, dataset='amass'):
         self.device = device
         self.dataset = dataset
-        self.smpl_model = SMPL().eval().to(device)
+        self.training = False
+        # SMPL is only needed for non-xyz pose representations, so it is
+        # loaded on first use (on the device of the first input)
+        self._smpl_model = None
+        self._betas = {}
+
+    @property
+    def smpl_model(self):
+        if self._smpl_model is None:
+            self._smpl_model = SMPL().train(self.training).to(self.device)
+        return self._smpl_model
+
+    def _apply(self, fn):
+        # called from MDM._apply(); nothing to move before SMPL is loaded
+        if self._smpl_model is not None:
+            self._smpl_model._apply(fn)
+
+    def train(self, mode=True):
+        self.training = mode
+        if self._smpl_model is not None:
+            self._smpl_model.train(mode)
+        return self
+
+    def eval(self):
+        return self.train(False)
+
+    def zero_betas(self, batch_size, beta, dtype, device):
+        """
+        A [batch_size x num_betas] shape vector, zero except betas[:, 1] = beta.
+        Cached per shape; callers must not modify it.
+        """
+        key = (batch_size, float(beta), dtype, str(device))
+        if key not in self._betas:
+            betas = torch.zeros([batch_size, self.smpl_model.num_betas], dtype=dtype, device=device)
+            betas[:, 1] = beta
+            self._betas[key] = betas
+        return self._betas[key]
 
     def __call__(self, x, mask, pose_rep, translation, glob,
                  jointstype, vertstrans, betas=None, beta=0,
-                 glob_rot=None, get_rotations_back=False, **kwargs):
+                 glob_rot=None, get_rotations_back=False, dense=None, **kwargs):
+        """
+        :param dense: run SMPL on every frame and zero the padded ones
+                      afterwards instead of gathering the masked frames.
+                      This avoids the host syncs of boolean indexing. Defaults to
+                      True on GPU, and always used without a mask; on CPU there are no syncs
+                      to save and skipping padded frames is cheaper.
+        """
         if pose_rep == "xyz":
             return x
 
-        if mask is None:
-            mask = torch.ones((x.shape[0], x.shape[-1]), dtype=bool, device=x.device)
+        if self._smpl_model is None:
+            self.device = x.device
 
         if not glob and glob_rot is None:
             raise TypeError("You must specify global rotation if glob is False")
@@ -37,45 +80,51 @@ class Rotation2xyz:
 
         x_rotations = x_rotations.permute(0, 3, 1, 2)
         nsamples, time, njoints, feats = x_rotations.shape
-        print('x_rotations',x_rotations.shape)
-        print('x_rotations[maks]',x_rotations[mask].shape)
+        if dense is None:
+            dense = x.device.type != 'cpu'
+        # without a mask every frame is kept, which is the dense path
+        dense = dense or mask is None
+        if dense:
+            x_rotations = x_rotations.reshape(nsamples * time, njoints, feats)
+        else:
+            x_rotations = x_rotations[mask]
 
         # Compute rotations (convert only masked sequences output)
         if pose_rep == "rotvec":
-            rotations = geometry.axis_angle_to_matrix(x_rotations[mask])
+            rotations = geometry.axis_angle_to_matrix(x_rotations)
         elif pose_rep == "rotmat":
-            rotations = x_rotations[mask].view(-1, njoints, 3, 3)
+            rotations = x_rotations.view(-1, njoints, 3, 3)
         elif pose_rep == "rotquat":
-            rotations = geometry.quaternion_to_matrix(x_rotations[mask])
+            rotations = geometry.quaternion_to_matrix(x_rotations)
         elif pose_rep == "rot6d":
-            rotations = geometry.rotation_6d_to_matrix(x_rotations[mask])
+            rotations = geometry.rotation_6d_to_matrix(x_rotations)
         else:
             raise NotImplementedError("No geometry for this one.")
 
         if not glob:
             global_orient = torch.tensor(glob_rot, device=x.device)
             global_orient = geometry.axis_angle_to_matrix(global_orient).view(1, 1, 3, 3)
-            global_orient = global_orient.repeat(len(rotations), 1, 1, 1)
+            global_orient = global_orient.expand(len(rotations), 1, 3, 3)
         else:
             global_orient = rotations[:, 0]
             rotations = rotations[:, 1:]
 
         if betas is None:
-            betas = torch.zeros([rotations.shape[0], self.smpl_model.num_betas],
-                                dtype=rotations.dtype, device=rotations.device)
-            betas[:, 1] = beta
-            # import ipdb; ipdb.set_trace()
-        print(rotations.shape)
-        print(global_orient.shape)
-        print(betas.shape)
+            betas = self.zero_betas(rotations.shape[0], beta, rotations.dtype, rotations.device)
         out = self.smpl_model(body_pose=rotations, global_orient=global_orient, betas=betas)
 
         # get the desirable joints
         joints = out[jointstype]
 
-        x_xyz = torch.empty(nsamples, time, joints.shape[1], 3, device=x.device, dtype=x.dtype)
-        x_xyz[~mask] = 0
-        x_xyz[mask] = joints
+        if dense:
+            x_xyz = joints.view(nsamples, time, joints.shape[1], 3).to(x.dtype)
+            if mask is not None:
+                # where() rather than a product: padded frames may hold invalid rotations (NaN joints)
+                x_xyz = torch.where(mask.reshape(nsamples, time, 1, 1), x_xyz,
+                                    torch.zeros((), dtype=x.dtype, device=x.device))
+        else:
+            x_xyz = torch.zeros(nsamples, time, joints.shape[1], 3, device=x.device, dtype=x.dtype)
+            x_xyz[mask] = joints
 
         x_xyz = x_xyz.permute(0, 2, 3, 1).contiguous()
 
@@ -92,6 +141,10 @@ class Rotation2xyz:
             x_xyz = x_xyz + x_translations[:, None, :, :]
 
         if get_rotations_back:
+            if dense and mask is not None:
+                # only the valid frames, as in the masked path
+                valid = mask.reshape(-1)
+                rotations, global_orient = rotations[valid], global_orient[valid]
             return x_xyz, rotations, global_orient
         else:
             return x_xyz
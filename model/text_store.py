@@ -0,0 +1,151 @@
+"""
+Persistent CLIP text embeddings for a fixed caption corpus.
+
+A store is a directory holding
+    embeddings.npy  - an [N x clip_dim] float16 matrix, memory-mapped on load
+    index.json      - caption hash -> row
+    meta.json       - clip version and context length the rows were made with
+
+Build one for HumanML3D with
+    python -m model.text_store --dataset humanml --out ./dataset/HumanML3D/clip_text
+and pass it to training / sampling with --text_store.
+"""
+
+import codecs as cs
+import hashlib
+import json
+import os
+from argparse import ArgumentParser
+from os.path import join as pjoin
+
+import numpy as np
+import torch
+import clip
+
+from utils.misc import file_digest
+
+
+def clip_tokenize(raw_text, max_text_len=None):
+    """
+    Tokenize captions the way MDM does: HumanML3D/KIT captions are cut to
+    max_text_len tokens and zero padded back to CLIP's 77-token context.
+    """
+    if max_text_len is not None:
+        default_context_length = 77
+        context_length = max_text_len + 2 # start_token + 20 + end_token
+        assert context_length < default_context_length
+        texts = clip.tokenize(raw_text, context_length=context_length, truncate=True) # [bs, context_length] # if n_tokens > context_length -> will truncate
+        zero_pad = torch.zeros([texts.shape[0], default_context_length-context_length], dtype=texts.dtype, device=texts.device)
+        texts = torch.cat([texts, zero_pad], dim=1)
+    else:
+        texts = clip.tokenize(raw_text, truncate=True) # [bs, context_length] # if n_tokens > 77 -> will truncate
+    return texts
+
+
+def caption_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+
+def text_store_digest(path):
+    """
+    :return: a digest of the store's files, to key caches of what was generated with it.
+    """
+    digest = hashlib.sha1()
+    for file_name in ('meta.json', 'index.json', 'embeddings.npy'):
+        digest.update(file_digest(pjoin(path, file_name)).encode())
+    return digest.hexdigest()
+
+
+class ClipTextStore:
+    """
+    Read-only lookup of precomputed CLIP text embeddings.
+
+    :param path: the store directory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(pjoin(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        with open(pjoin(path, 'index.json')) as f:
+            self.index = json.load(f)
+        self.embeddings = np.load(pjoin(path, 'embeddings.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.index)
+
+    def check(self, clip_version, max_text_len):
+        if self.meta['clip_version'] != clip_version or self.meta['max_text_len'] != max_text_len:
+            raise ValueError(f'{self.path} was built with {self.meta}, '
+                             f'the model uses clip_version={clip_version}, max_text_len={max_text_len}')
+
+    def lookup(self, texts):
+        """
+        :param texts: a list of captions.
+        :return: a [B x clip_dim] float tensor (zeros for unseen captions) and a [B] bool hit mask.
+        """
+        rows = [self.index.get(caption_hash(t), -1) for t in texts]
+        hit = np.array(rows) >= 0
+        enc_text = np.zeros((len(texts), self.embeddings.shape[1]), dtype=np.float32)
+        if hit.any():
+            enc_text[hit] = self.embeddings[np.array(rows)[hit]]
+        return torch.from_numpy(enc_text), hit
+
+
+def build_text_store(out, captions, clip_version='ViT-B/32', max_text_len=20, device='cpu', batch_size=256):
+    """
+    Embed every distinct caption once and write a store to `out`.
+    """
+    captions = sorted(set(captions))
+    clip_model, _ = clip.load(clip_version, device=device, jit=False)
+    clip_model.eval()
+    embeddings = []
+    with torch.no_grad():
+        for start in range(0, len(captions), batch_size):
+            texts = clip_tokenize(captions[start:start + batch_size], max_text_len).to(device)
+            embeddings.append(clip_model.encode_text(texts).half().cpu().numpy())
+    embeddings = np.concatenate(embeddings, axis=0)
+
+    os.makedirs(out, exist_ok=True)
+    np.save(pjoin(out, 'embeddings.npy'), embeddings)
+    with open(pjoin(out, 'index.json'), 'w') as f:
+        json.dump({caption_hash(t): row for row, t in enumerate(captions)}, f)
+    with open(pjoin(out, 'meta.json'), 'w') as f:
+        json.dump({'clip_version': clip_version, 'max_text_len': max_text_len,
+                   'num_captions': len(captions), 'clip_dim': int(embeddings.shape[1])}, f)
+
+
+def read_captions(data_root, text_dir, splits):
+    captions = []
+    for split in splits:
+        with cs.open(pjoin(data_root, f'{split}.txt'), 'r') as f:
+            names = [line.strip() for line in f.readlines()]
+        for name in names:
+            text_path = pjoin(text_dir, name + '.txt')
+            if not os.path.exists(text_path):
+                continue
+            with cs.open(text_path) as f:
+                captions += [line.strip().split('#')[0] for line in f.readlines()]
+    return captions
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--dataset", default='humanml', choices=['humanml', 'kit'], type=str)
+    parser.add_argument("--splits", default='train,val,test', type=str, help="Comma separated splits to embed.")
+    parser.add_argument("--out", default='', type=str,
+                        help="Output directory. If empty, writes clip_text next to the dataset texts.")
+    parser.add_argument("--batch_size", default=256, type=int)
+    parser.add_argument("--device", default=0, type=int, help="Device id to use, -1 for cpu.")
+    args = parser.parse_args()
+
+    data_root = './dataset/HumanML3D' if args.dataset == 'humanml' else './dataset/KIT-ML'
+    device = 'cpu' if args.device < 0 or not torch.cuda.is_available() else f'cuda:{args.device}'
+    captions = read_captions(data_root, pjoin(data_root, 'texts'), args.splits.split(','))
+    out = args.out or pjoin(data_root, 'clip_text')
+    build_text_store(out, captions, device=device, batch_size=args.batch_size)
+    print(f'Embedded {len(set(captions))} captions into [{os.path.abspath(out)}]')
+
+
+if __name__ == '__main__':
+    main()
@@ -8,16 +8,19 @@ import os
 import numpy as np
 import torch
 from utils.parser_util import generate_args
-from utils.model_util import create_model_and_diffusion, load_model_wo_clip
+from utils.model_util import create_model_and_diffusion, load_model_wo_clip, get_sample_fn
 from utils import dist_util
 from model.cfg_sampler import ClassifierFreeSampleModel
 from data_loaders.get_data import get_dataset_loader
-from data_loaders.humanml.scripts.motion_process import recover_from_ric
+from data_loaders.humanml.scripts.motion_process import RICDecoder
 import data_loaders.humanml.utils.paramUtil as paramUtil
 from data_loaders.humanml.utils.plot_script import plot_3d_motion
 import shutil
 from data_loaders.tensors import collate
 import pickle as pkl
+from diffusion.gp_kernel import (KernelFactorCache, KernelOperator, LENGTH_SCALES, circulant_spectra,
+                                 get_corr_channels)
+from diffusion.kernel_store import load_kernel_bag
 
 def main():
     args = generate_args()
@@ -30,12 +33,17 @@ def main():
     n_frames = min(max_frames, int(args.motion_length*fps))
     is_using_data = not any([args.input_text, args.text_prompt, args.action_file, args.action_name])
     
-    with open(args.param_lenK_path, 'rb') as f : 
-        param_lenK = pkl.load(f)    
-        num_len = len(param_lenK['K_param'])
-        K_param = torch.Tensor(param_lenK['K_param']).to(args.device)
-        K_template = param_lenK['template']
-        K_template = torch.Tensor(K_template).repeat(10,1,1,1)
+    lens_array = np.array(LENGTH_SCALES)
+    if args.length_scales != '':
+        lens_array = np.array([float(l) for l in args.length_scales.split(',')])
+    if args.kernel_cache_dir or args.length_scales != '':
+        kernel_cache = KernelFactorCache(args.kernel_cache_dir or None)
+        K_param = kernel_cache.stack(lens_array, max_frames, fps, device=args.device)
+        K_template = kernel_cache.template(max_frames, fps, device=args.device)
+    else:
+        param_lenK = load_kernel_bag(args.param_lenK_path)
+        K_param = param_lenK['K_param'].to(args.device)
+        K_template = param_lenK['template'].to(args.device)
 
     dist_util.setup_dist(args.device)
     
@@ -110,49 +118,30 @@ def main():
     #          0.24788889, 0.35533333, 
     #          0.46277778, 0.67766667, 
     #          1.        ])
-    lens_array =  np.array([0.033     , 0.14044444, 
-                            0.24788889, 0.35533333, 
-                            0.46277778, 0.67766667, 
-                            1.        ,])
-                            # 0.08, 0.19, 0.30])
+    # lens_array =  np.array([0.033     , 0.14044444, 
+    #                         0.24788889, 0.35533333, 
+    #                         0.46277778, 0.67766667, 
+    #                         1.        ,])
+    #                         # 0.08, 0.19, 0.30])
     # lens_array = np.array([0.033,
     #                        0.247888889,
     #                        0.462777778,
     #                        1.0])
     
-    lens_str = ['003','014','024','035','046', '067', '100']#, '008', '019', '030']
+    lens_str = ['%03d' % int(l * 100) for l in lens_array]  # ['003','014','024','035','046', '067', '100']
     # lens_str = ['003','024','046','100']
-    eval_K_params = torch.zeros((len(lens_array),263,196,196)).to(args.device) 
     eval_len_param = torch.ones((len(lens_array),263)).to(args.device) * 0.03
-    for i in range(len(lens_array)):
-        eval_K_params = K_template
-        if args.corr_mode == 'all_trs': 
-            eval_K_params[i,1:3] = torch.Tensor(K_param[i]).repeat(2,1,1)
-            eval_len_param[i,1:3] = torch.Tensor([lens_array[i]]).to(args.device).repeat(2)
-        elif args.corr_mode == 'all_trsrot':
-            slices = [[0, 4], [193, 196]]
-            eval_K_params[i,np.concatenate([np.arange(*k) for k in slices])] = torch.Tensor(K_param[i]).repeat(7,1,1)
-            eval_len_param[i,np.concatenate([np.arange(*k) for k in slices])] = torch.Tensor([lens_array[i]]).to(args.device).repeat(7)
-        elif args.corr_mode == 'R_trs':
-            eval_K_params[i,1:3] = torch.Tensor(K_param[i]).repeat(2,1,1)
-            eval_len_param[i,1:3] = torch.Tensor([lens_array[i]]).to(args.device).repeat(2)
-        elif args.corr_mode == 'R_trsrot':
-            slices = [[0, 4], [193, 196]]
-            eval_K_params[i,np.concatenate([np.arange(*k) for k in slices])] = torch.Tensor(K_param[i]).repeat(7,1,1)
-            eval_len_param[i,np.concatenate([np.arange(*k) for k in slices])] = torch.Tensor([lens_array[i]]).to(args.device).repeat(7)
-        # eval_len_param[i] = torch.Tensor([lens_array[i]]).to(args.device).repeat(263)
-        elif args.corr_mode == 'R_trsrot':
-            slices = [[4, 67]]
-            eval_K_params[i,np.concatenate([np.arange(*k) for k in slices])] = torch.Tensor(K_param[i]).repeat(7,1,1)
-            eval_len_param[i,np.concatenate([np.arange(*k) for k in slices])] = torch.Tensor([lens_array[i]]).to(args.device).repeat(7)
-        elif args.corr_mode == 'all':
-            
-        # else :
-            assert('wrong corr_mode')
+    # row i carries length-scale class i on the corr_mode channels and the template elsewhere
+    channels = get_corr_channels(args.corr_mode, 263) if args.corr_mode not in ['', 'all'] else []
+    cls_idx = torch.arange(len(lens_array), device=args.device)[:, None].repeat(1, len(channels))
+    spectra = circulant_spectra(torch.cat([K_param, K_template[None]])) if args.noise_sampler == 'fft' else None
+    eval_K_params = KernelOperator.from_classes(K_param, K_template, cls_idx, channels, 263, spectra=spectra)
+    eval_len_param[:, channels] = torch.Tensor(lens_array)[:, None].to(args.device)
     model.eval()
     save_motion = []
     save_len_param = []
 
+    out_paths = []
     for i in range(len(lens_array)):
         out_path = ''
         if out_path == '':
@@ -166,40 +155,45 @@ def main():
         # if os.path.exists(out_path):
         #     shutil.rmtree(out_path)
         os.makedirs(out_path, exist_ok=True)
+        out_paths.append(out_path)
+
+    rep = args.num_repetitions
+    if args.guidance_param != 1:
+        model_kwargs['y']['scale'] = torch.ones(1, device=dist_util.dev()) * args.guidance_param
+    num_samples = args.num_samples
+    sample_fn = get_sample_fn(diffusion, args)
 
-        rep = args.num_repetitions
+    # all length-scales of a repetition are sampled together as one batch
+    sweep_samples = []
+    for j in range(rep):
+        sweep_samples.append(diffusion.length_sweep_sample_loop(
+            model,
+            (num_samples, model.njoints, model.nfeats, 196),  # BUG FIX
+            eval_K_params,
+            eval_len_param,
+            sample_fn=sample_fn,
+            clip_denoised=False,
+            model_kwargs=model_kwargs,
+            skip_timesteps=0,  # 0 is the default value - i.e. don't skip any step
+            init_image=None,
+            progress=True,
+            dump_steps=None,
+            noise=None,
+            const_noise=False,
+        ))
+
+    decoder = RICDecoder(data.dataset.t2m_dataset.mean, data.dataset.t2m_dataset.std)
+    for i in range(len(lens_array)):
+        out_path = out_paths[i]
 
         for j in range(rep):
             all_motions = []
             all_lengths = []
             all_text = []
-            
-            if args.guidance_param != 1:
-                model_kwargs['y']['scale'] = torch.ones(1, device=dist_util.dev()) * args.guidance_param
 
-            num_samples = args.num_samples
-                
-            sample_fn = diffusion.p_sample_loop
-            sample = sample_fn(
-                model,
-                (num_samples, model.njoints, model.nfeats, 196),  # BUG FIX
-                eval_K_params[i].unsqueeze(0),
-                eval_len_param[i].unsqueeze(0),
-                clip_denoised=False,
-                model_kwargs=model_kwargs,
-                skip_timesteps=0,  # 0 is the default value - i.e. don't skip any step
-                init_image=None,
-                progress=True,
-                dump_steps=None,
-                noise=None,
-                const_noise=False,
-            )        
-            
-                    
-            n_joints = 22 if sample.shape[1] == 263 else 21
-            sample = data.dataset.t2m_dataset.inv_transform(sample.cpu().permute(0, 2, 3, 1)).float()
-            sample = recover_from_ric(sample, n_joints)
-            sample = sample.view(-1, *sample.shape[2:]).permute(0, 2, 3, 1)
+            sample = sweep_samples[j][i]
+
+            sample = decoder(sample)
 
             rot2xyz_pose_rep = 'xyz' if  model.data_rep in ['xyz', 'hml_vec'] else model.data_rep
             rot2xyz_mask = None if rot2xyz_pose_rep == 'xyz' else model_kwargs['y']['mask'].reshape(1, 196).bool()
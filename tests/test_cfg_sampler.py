@@ -0,0 +1,46 @@
+import pytest
+import torch
+
+from model.cfg_sampler import ClassifierFreeSampleModel
+from model.mdm import MDM
+
+NJOINTS, NFRAMES = 263, 16
+
+
+def fake_encode_text_clip(self, raw_text):
+    # a fixed embedding per caption length, in place of CLIP
+    return torch.stack([torch.randn(self.clip_dim, generator=torch.Generator().manual_seed(len(text)))
+                        for text in raw_text])
+
+
+@pytest.fixture
+def model(monkeypatch):
+    monkeypatch.setattr(MDM, 'load_and_freeze_clip', lambda self, clip_version: None)
+    monkeypatch.setattr(MDM, 'encode_text_clip', fake_encode_text_clip)
+    torch.manual_seed(0)
+    model = MDM(modeltype='', njoints=NJOINTS, nfeats=1, num_actions=1, translation=True, pose_rep='rot6d',
+                glob=True, glob_rot=True, latent_dim=64, ff_size=128, num_layers=2, num_heads=4,
+                data_rep='hml_vec', dataset='humanml', arch='trans_enc', clip_version='ViT-B/32',
+                cond_mode='text', cond_mask_prob=0.1)
+    model.eval()
+    return model
+
+
+@pytest.mark.parametrize('precomputed_text', [False, True])
+def test_batched_cfg_matches_two_passes(model, precomputed_text):
+    bs = 3
+    torch.manual_seed(1)
+    x = torch.randn(bs, NJOINTS, 1, NFRAMES)
+    timesteps = torch.tensor([5, 40, 999])
+    len_param = torch.randn(bs, NJOINTS)
+    y = {'text': ['a man walks', 'a person jumps twice', 'someone sits down'],
+         'mask': torch.ones(bs, 1, 1, NFRAMES, dtype=torch.bool),
+         'lengths': torch.tensor([16, 12, 9]),
+         'scale': torch.tensor([1.5, 2.5, 4.0])}  # per-sample guidance
+    if precomputed_text:
+        y['enc_text'] = model.encode_text(y['text'])
+
+    with torch.no_grad():
+        batched = ClassifierFreeSampleModel(model, batched=True)(x, timesteps, len_param, y=dict(y))
+        two_passes = ClassifierFreeSampleModel(model, batched=False)(x, timesteps, len_param, y=dict(y))
+    assert torch.allclose(batched, two_passes, atol=1e-5)
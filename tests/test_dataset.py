@@ -0,0 +1,66 @@
+import pickle
+import random
+from argparse import Namespace
+from os.path import join as pjoin
+
+import numpy as np
+
+from data_loaders.humanml.data.dataset import Text2MotionDatasetV2
+from data_loaders.humanml.data.packed import CLIPS_FILE, is_current, save_clips, source_digest
+from data_loaders.humanml.utils.word_vectorizer import WordVectorizer
+
+WORDS = ['unk', 'sos', 'eos', 'a', 'man', 'walks', 'runs']
+
+
+def make_split(root):
+    glove_dir, motion_dir, text_dir = (pjoin(root, d) for d in ('glove', 'motions', 'texts'))
+    for d in (glove_dir, motion_dir, text_dir):
+        (root / d).mkdir()
+    np.save(pjoin(glove_dir, 'our_vab_data.npy'), np.random.rand(len(WORDS), 300))
+    with open(pjoin(glove_dir, 'our_vab_words.pkl'), 'wb') as f:
+        pickle.dump(WORDS, f)
+    with open(pjoin(glove_dir, 'our_vab_idx.pkl'), 'wb') as f:
+        pickle.dump({w: i for i, w in enumerate(WORDS)}, f)
+    np.save(pjoin(motion_dir, '000001.npy'), np.random.rand(160, 4))
+    with open(pjoin(text_dir, '000001.txt'), 'w') as f:
+        f.write('a man walks#a/DET man/NOUN walk/VERB#0.0#0.0\n')
+        # two sub-clips, each gets a random name
+        f.write('a man runs#a/DET man/NOUN run/VERB#1.0#4.0\n')
+        f.write('a man walks#a/DET man/NOUN walk/VERB#2.0#6.0\n')
+    with open(pjoin(root, 'test.txt'), 'w') as f:
+        f.write('000001\n')
+    opt = Namespace(dataset_name='t2m', max_motion_length=196, unit_length=4, max_text_len=20,
+                    motion_dir=motion_dir, text_dir=text_dir)
+    return opt, pjoin(root, 'test.txt'), WordVectorizer(glove_dir, 'our_vab')
+
+
+def crop_keys(opt, split_file, w_vectorizer):
+    dataset = Text2MotionDatasetV2(opt, np.zeros(4), np.ones(4), split_file, w_vectorizer)
+    dataset.return_crop_key = True
+    random.seed(0)
+    np.random.seed(0)
+    return sorted(dataset[i][-1]['crop_key'] for i in range(len(dataset)))
+
+
+def test_crop_key_is_stable_across_constructions(tmp_path):
+    opt, split_file, w_vectorizer = make_split(tmp_path)
+    random.seed(1)
+    first = crop_keys(opt, split_file, w_vectorizer)
+    random.seed(2)
+    second = crop_keys(opt, split_file, w_vectorizer)
+    assert first == second
+    assert [key for key, _, _ in first] == ['000001', '000001#20#80', '000001#40#120']
+
+
+def test_packed_split_goes_stale_with_its_sources(tmp_path):
+    opt, split_file, w_vectorizer = make_split(tmp_path)
+    dataset = Text2MotionDatasetV2(opt, np.zeros(4), np.ones(4), split_file, w_vectorizer)
+    keys = [dataset.data_dict[name]['key'] for name in dataset.name_list]
+    index_path = pjoin(tmp_path, 'packed', CLIPS_FILE)
+    save_clips(pjoin(tmp_path, 'packed'), dataset.name_list, keys, dataset.data_dict, opt.motion_dir,
+               source_digest(split_file, opt.motion_dir, opt.text_dir))
+    assert is_current(index_path, source_digest(split_file, opt.motion_dir, opt.text_dir))
+
+    with open(pjoin(opt.text_dir, '000001.txt'), 'a') as f:
+        f.write('a man runs#a/DET man/NOUN run/VERB#0.0#0.0\n')
+    assert not is_current(index_path, source_digest(split_file, opt.motion_dir, opt.text_dir))
@@ -0,0 +1,36 @@
+from types import SimpleNamespace
+
+import pytest
+import torch as th
+import torch.nn as nn
+
+from utils.model_util import create_gaussian_diffusion
+
+
+class DummyModel(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.scale = nn.Parameter(th.tensor(0.5))
+
+    def forward(self, x, timesteps, len_param=None, y=None):
+        return self.scale * x
+
+
+@pytest.fixture
+def diffusion():
+    return create_gaussian_diffusion(SimpleNamespace(diffusion_steps=50, sampling_steps=5, noise_schedule='cosine',
+                                                     sigma_small=True, lambda_vel=0, lambda_rcxyz=0, lambda_fc=0))
+
+
+def test_dpm_solver_dump_steps_and_const_noise(diffusion):
+    model, noise = DummyModel(), th.randn(2, 4, 1, 8)
+    final = diffusion.dpm_solver_sample_loop(model, noise.shape, noise=noise, model_kwargs={'y': {}})
+    dump = diffusion.dpm_solver_sample_loop(model, noise.shape, noise=noise, model_kwargs={'y': {}}, dump_steps=[1, 4])
+    assert len(dump) == 2 and th.equal(dump[-1], final)
+    const = diffusion.dpm_solver_sample_loop(model, noise.shape, noise=noise, model_kwargs={'y': {}}, const_noise=True)
+    assert th.equal(const, final)
+
+
+def test_dpm_solver_rejects_cond_fn(diffusion):
+    with pytest.raises(ValueError, match='cond_fn'):
+        diffusion.dpm_solver_sample_loop(DummyModel(), (2, 4, 1, 8), cond_fn=lambda x, t, **kwargs: x)
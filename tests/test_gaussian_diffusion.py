@@ -0,0 +1,15 @@
+from types import SimpleNamespace
+
+import torch as th
+
+from utils.model_util import create_gaussian_diffusion
+
+
+def test_predict_xstart_from_xprev_inverts_the_posterior_mean():
+    diffusion = create_gaussian_diffusion(SimpleNamespace(diffusion_steps=50, noise_schedule='cosine', sigma_small=True,
+                                                          lambda_vel=0, lambda_rcxyz=0, lambda_fc=0))
+    th.manual_seed(0)
+    x_start, x_t = th.randn(3, 4, 1, 8), th.randn(3, 4, 1, 8)
+    t = th.tensor([0, 20, 49])
+    xprev, _, _ = diffusion.q_posterior_mean_variance(x_start, x_t, t)
+    assert th.allclose(diffusion._predict_xstart_from_xprev(x_t, t, xprev), x_start, atol=1e-4)
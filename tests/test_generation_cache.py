@@ -0,0 +1,60 @@
+import json
+from argparse import Namespace
+from os.path import join as pjoin
+
+import numpy as np
+import pytest
+
+from data_loaders.humanml.motion_loaders.generation_cache import GenerationCache
+from eval.eval_humanml import generation_cache_config
+
+
+def write_text_store(path, rows):
+    path.mkdir()
+    np.save(pjoin(path, 'embeddings.npy'), np.full((rows, 4), 0.5, dtype=np.float16))
+    with open(pjoin(path, 'index.json'), 'w') as f:
+        json.dump({str(row): row for row in range(rows)}, f)
+    with open(pjoin(path, 'meta.json'), 'w') as f:
+        json.dump({'clip_version': 'ViT-B/32', 'max_text_len': 20}, f)
+
+
+@pytest.fixture
+def eval_args(tmp_path):
+    (tmp_path / 'model.pt').write_bytes(b'weights')
+    np.savez(tmp_path / 'len_idx.npz', keys=np.array(['000001']), ids=np.zeros((1, 4), dtype=np.uint8))
+    np.savez(tmp_path / 'other_len_idx.npz', keys=np.array(['000001']), ids=np.ones((1, 4), dtype=np.uint8))
+    write_text_store(tmp_path / 'text_store', rows=2)
+    write_text_store(tmp_path / 'other_text_store', rows=3)
+    return Namespace(model_path=str(tmp_path / 'model.pt'), arch='trans_enc',
+                     len_idx_path=str(tmp_path / 'len_idx.npz'), text_store=str(tmp_path / 'text_store'),
+                     guidance_param=2.5, seed=10, sampler='ddpm', sampling_steps=0, ddim_eta=0.0, compiled_step='',
+                     length_buckets=0, padding_mask=False, batch_size=32)
+
+
+def make_cache(root, args):
+    return GenerationCache(str(root), **generation_cache_config(args, 'test', 1000, 0, 0))
+
+
+@pytest.mark.parametrize('field, value', [
+    ('len_idx_path', 'other_len_idx.npz'),
+    ('len_idx_path', None),
+    ('arch', 'trans_dec'),
+    ('compiled_step', 'compile'),
+    ('compiled_step', 'cuda_graph'),
+    ('text_store', 'other_text_store'),
+    ('text_store', None),
+])
+def test_generation_inputs_invalidate_the_cache(tmp_path, eval_args, field, value):
+    cache = make_cache(tmp_path / 'cache', eval_args)
+    cache.save(0, 0, {'motion': np.zeros((1, 8, 4)), 'length': np.array([8]),
+                      'caption': ['a man walks'], 'tokens': ['sos/OTHER_eos/OTHER']})
+    assert make_cache(tmp_path / 'cache', eval_args).load(0, 0) is not None
+
+    changed = Namespace(**vars(eval_args))
+    if field in ('arch', 'compiled_step'):
+        setattr(changed, field, value)
+    else:
+        setattr(changed, field, str(tmp_path / value) if value else '')
+    other = make_cache(tmp_path / 'cache', changed)
+    assert other.path != cache.path
+    assert other.shards == {} and other.load(0, 0) is None
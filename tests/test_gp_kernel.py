@@ -0,0 +1,54 @@
+from types import SimpleNamespace
+
+import torch as th
+
+from diffusion.gp_kernel import KernelOperator, circulant_spectra
+from utils.model_util import create_gaussian_diffusion
+
+
+def make_operator(B=1, D=6, L=12, F=3):
+    th.manual_seed(0)
+    factors = th.randn(F, L, L)
+    index = th.randint(F, (B, D))
+    return KernelOperator(factors, index)
+
+
+def test_apply_matches_dense():
+    op = make_operator(B=4)
+    noise = th.randn(4, 6, 1, 12)
+    expected = (op.dense() @ noise.squeeze(2)[..., None]).squeeze(-1)
+    assert th.allclose(op.apply(noise).squeeze(2), expected, atol=1e-5)
+
+
+def test_grouping_is_cached_for_a_broadcast_operator():
+    op = make_operator(B=1)
+    noise = th.randn(5, 6, 1, 12)
+    first = op.apply(noise)
+    grouping = op._groups[(5, 'cpu')]
+    second = op.apply(noise)
+    assert len(op._groups) == 1 and op._groups[(5, 'cpu')] is grouping
+    assert th.equal(first, second)
+    expected = (op.expand(5).dense() @ noise.squeeze(2)[..., None]).squeeze(-1)
+    assert th.allclose(first.squeeze(2), expected, atol=1e-5)
+
+
+def test_step_noise_does_not_depend_on_the_noise_sampler():
+    # p_sample adds white noise; the kernels only shape the initial noise, so
+    # an FFT operator (which draws padding normals) must not shift the stream
+    t = th.linspace(0, 16 / 20, 16, dtype=th.float64)
+    K = 0.1 * th.exp(-((t[:, None] - t[None]) / 0.14) ** 2) + 1e-6 * th.eye(16, dtype=th.float64)
+    factor = th.linalg.cholesky(K).float()
+    op = KernelOperator(factor[None], th.zeros(2, 4, dtype=th.long), circulant_spectra(factor[None]))
+    assert op.spectra[0] is not None
+    diffusion = create_gaussian_diffusion(SimpleNamespace(diffusion_steps=10, noise_schedule='cosine', sigma_small=True,
+                                                          lambda_vel=0, lambda_rcxyz=0, lambda_fc=0))
+    model = lambda x, t, len_param, y=None: 0.5 * x
+    x, t = th.randn(2, 4, 1, 16), th.tensor([5, 5])
+    samples = []
+    for K_params in (None, op):
+        th.manual_seed(0)
+        sample = x
+        for _ in range(2):  # a draw inside one step would shift the next step's noise
+            sample = diffusion.p_sample(model, sample, t, K_params, None, model_kwargs={'y': {}})['sample']
+        samples.append(sample)
+    assert th.equal(*samples)
@@ -0,0 +1,54 @@
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+
+from data_loaders.humanml.utils.metrics import calculate_activation_statistics
+from eval.gt_cache import get_gt_embeddings
+
+
+class FakeGTLoader:
+    """
+    Random motions in every pass, like the shuffling, cropping gt loader.
+    """
+
+    def __init__(self, data_root, num_batches=3, batch_size=8):
+        t2m_dataset = SimpleNamespace(name_list=['000001', '000002'], length_arr=np.array([40, 60]))
+        self.dataset = SimpleNamespace(opt=SimpleNamespace(data_root=data_root, dataset_name='t2m'),
+                                       t2m_dataset=t2m_dataset, mean=np.zeros(4), std=np.ones(4))
+        self.num_batches, self.batch_size = num_batches, batch_size
+
+    def __iter__(self):
+        for _ in range(self.num_batches):
+            motions = torch.randn(self.batch_size, 10, 4)
+            yield None, None, None, None, motions, torch.full((self.batch_size,), 10), None
+
+
+class FakeEvaluator:
+    def __init__(self, checkpoint_path):
+        self.checkpoint_path = checkpoint_path
+
+    def get_motion_embeddings(self, motions, m_lens):
+        return motions.mean(dim=1)
+
+    def get_co_embeddings(self, word_embs, pos_ohot, cap_lens, motions, m_lens):
+        return motions[:, 0], self.get_motion_embeddings(motions, m_lens)
+
+
+def test_gt_embeddings_are_drawn_per_replication(tmp_path):
+    (tmp_path / 'evaluator.tar').write_bytes(b'weights')
+    eval_wrapper = FakeEvaluator(str(tmp_path / 'evaluator.tar'))
+    gt_loader = FakeGTLoader(str(tmp_path))
+    torch.manual_seed(0)
+    first = [get_gt_embeddings(eval_wrapper, gt_loader, 'test', replication) for replication in range(2)]
+    # one shared FID pass and a matching pass per replication
+    assert len(list((tmp_path / 'eval_cache').iterdir())) == 3
+    assert not np.allclose(first[0].motion_embeddings, first[1].motion_embeddings)
+    assert np.array_equal(first[0].mu, first[1].mu)
+    # the FID statistics come from another draw than the co-embeddings
+    mu, _ = calculate_activation_statistics(first[0].motion_embeddings)
+    assert not np.allclose(first[0].mu, mu)
+
+    reloaded = get_gt_embeddings(eval_wrapper, gt_loader, 'test', 1)
+    assert np.array_equal(reloaded.motion_embeddings, first[1].motion_embeddings)
+    assert np.array_equal(reloaded.mu, first[1].mu) and np.array_equal(reloaded.cov, first[1].cov)
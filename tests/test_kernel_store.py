@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+import torch
+
+from diffusion.kernel_store import load_kernel_bag, save_kernel_store
+
+NFRAMES = 6
+
+
+def test_shared_template_is_loaded_once(tmp_path):
+    K_param = np.stack([np.eye(NFRAMES) * (c + 1) for c in range(3)])
+    template = np.repeat(np.tril(np.ones((NFRAMES, NFRAMES)))[None], 4, axis=0)
+    save_kernel_store(str(tmp_path / 'kernels.pkl'), K_param, template, [0.1, 0.5, 1.])
+    store = load_kernel_bag(str(tmp_path / 'kernels.pkl'))
+    assert torch.equal(store['template'], torch.from_numpy(template[0]).float())
+    assert store['template_index'].tolist() == [3] * 4
+
+
+def test_per_channel_templates_are_rejected(tmp_path):
+    K_param = np.stack([np.eye(NFRAMES) * (c + 1) for c in range(3)])
+    template = np.stack([np.eye(NFRAMES), np.tril(np.ones((NFRAMES, NFRAMES)))])
+    save_kernel_store(str(tmp_path / 'kernels.pkl'), K_param, template, [0.1, 0.5, 1.])
+    with pytest.raises(ValueError, match='template'):
+        load_kernel_bag(str(tmp_path / 'kernels.pkl'))
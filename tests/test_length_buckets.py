@@ -0,0 +1,45 @@
+from types import SimpleNamespace
+
+import torch as th
+
+from diffusion.gp_kernel import KernelOperator
+from model.mdm import MDM
+from utils.model_util import create_gaussian_diffusion
+
+NJOINTS, NFRAMES = 8, 24
+
+
+def dense_factors(batch_size):
+    # a few distinct factors, shared by the (sample, channel) rows like predicted kernels
+    th.manual_seed(0)
+    distinct = th.randn(3, NFRAMES, NFRAMES) / NFRAMES ** 0.5
+    return distinct[th.randint(3, (batch_size, NJOINTS))]
+
+
+def test_cropped_dense_factors_keep_the_prefix_covariance():
+    K = dense_factors(2)
+    cropped = KernelOperator.from_dense(K).crop(10).dense()
+    prefix = K[..., :10, :]
+    assert th.allclose(cropped @ cropped.transpose(-1, -2), prefix @ prefix.transpose(-1, -2), atol=1e-5)
+
+
+def test_bucketed_sampling_matches_masked_full_length_sampling():
+    th.manual_seed(0)
+    model = MDM(modeltype='', njoints=NJOINTS, nfeats=1, num_actions=1, translation=True, pose_rep='rot6d',
+                glob=True, glob_rot=True, latent_dim=32, ff_size=64, num_layers=2, num_heads=4,
+                data_rep='hml_vec', dataset='humanml', arch='trans_enc', padding_mask=True)
+    model.eval()
+    diffusion = create_gaussian_diffusion(SimpleNamespace(diffusion_steps=10, noise_schedule='cosine', sigma_small=True,
+                                                          lambda_vel=0, lambda_rcxyz=0, lambda_fc=0))
+    lengths = th.tensor([24, 7, 15, 9])
+    mask = (th.arange(NFRAMES)[None] < lengths[:, None]).view(len(lengths), 1, 1, NFRAMES)
+    shape = (len(lengths), NJOINTS, 1, NFRAMES)
+    noise = th.randn(shape)
+    K = dense_factors(len(lengths))
+
+    full = diffusion.ddim_sample_loop(model, shape, K, noise=noise,
+                                      model_kwargs={'y': {'mask': mask, 'lengths': lengths}})
+    bucketed = diffusion.length_bucket_sample_loop(model, shape, K, None, [8, 16], noise=noise,
+                                                   sample_fn=diffusion.ddim_sample_loop,
+                                                   model_kwargs={'y': {'mask': mask, 'lengths': lengths}})
+    assert th.allclose(bucketed * mask, full * mask, atol=1e-5)
@@ -0,0 +1,29 @@
+import pytest
+import torch
+
+from model.mdm import MDM
+
+NJOINTS, NFRAMES = 8, 16
+
+
+def make_model(arch):
+    model = MDM(modeltype='', njoints=NJOINTS, nfeats=1, num_actions=1, translation=True, pose_rep='rot6d',
+                glob=True, glob_rot=True, latent_dim=32, ff_size=64, num_layers=2, num_heads=4,
+                data_rep='hml_vec', dataset='humanml', arch=arch)
+    model.eval()
+    return model
+
+
+@pytest.mark.parametrize('len_param_rows', [1, 3])
+def test_sdpa_encoder_matches_trans_enc(len_param_rows):
+    torch.manual_seed(0)
+    trans_enc = make_model('trans_enc')
+    sdpa = make_model('trans_enc_sdpa')
+    sdpa.load_state_dict(trans_enc.state_dict())
+    x = torch.randn(3, NJOINTS, 1, NFRAMES)
+    timesteps = torch.tensor([1, 50, 900])
+    len_param = torch.rand(len_param_rows, NJOINTS)  # a single row is broadcast over the batch
+    with torch.no_grad():
+        expected = trans_enc(x, timesteps, len_param, y={})
+        out = sdpa(x, timesteps, len_param, y={})
+    assert torch.allclose(out, expected, atol=1e-5)
@@ -0,0 +1,31 @@
+import pytest
+import torch
+
+from model.rotation2xyz import Rotation2xyz
+
+NJOINTS = 24
+
+
+class FakeSMPL:
+    """
+    Joints from the rotations alone, in place of the SMPL body model.
+    """
+
+    num_betas = 10
+
+    def __call__(self, body_pose, global_orient, betas):
+        rotations = torch.cat([global_orient[:, None], body_pose], dim=1)  # [N x 24 x 3 x 3]
+        return {'smpl': rotations.sum(dim=-1)}
+
+
+@pytest.mark.parametrize('dense', [None, True, False])
+def test_all_frames_are_converted_without_a_mask(dense):
+    rot2xyz = Rotation2xyz(device='cpu', dataset='humanml')
+    rot2xyz._smpl_model = FakeSMPL()
+    torch.manual_seed(0)
+    x = torch.randn(2, NJOINTS + 1, 6, 10)  # rot6d joints and a translation row
+    kwargs = dict(pose_rep='rot6d', translation=True, glob=True, jointstype='smpl', vertstrans=False)
+    out = rot2xyz(x, None, dense=dense, **kwargs)
+    expected = rot2xyz(x, torch.ones(2, 10, dtype=torch.bool), dense=False, **kwargs)
+    assert out.shape == (2, NJOINTS, 3, 10)
+    assert torch.allclose(out, expected)
@@ -0,0 +1,96 @@
+import glob
+from os.path import join as pjoin
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from data_loaders.humanml.motion_loaders.comp_v6_model_dataset import CompMDMGeneratedDataset
+from data_loaders.humanml.motion_loaders.generation_cache import GenerationCache
+from data_loaders.humanml.motion_loaders.sharded_generation import generate_sharded
+from diffusion.kernel_store import save_kernel_store
+from utils import dist_util
+from utils.model_util import create_gaussian_diffusion
+
+NJOINTS, NFRAMES, BATCH_SIZE, NUM_BATCHES = 4, 12, 2, 5
+
+
+class DummyModel(nn.Module):
+    """
+    A per-frame linear denoiser with MDM's call signature.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.proj = nn.Linear(NJOINTS, NJOINTS)
+
+    def forward(self, x, timesteps, len_param=None, y=None):
+        return self.proj(x.permute(0, 2, 3, 1)).permute(0, 3, 1, 2)
+
+
+class DummyVectorizer:
+    def encode(self, tokens):
+        return np.zeros(len(tokens), dtype=np.int64), np.zeros(len(tokens), dtype=np.int64)
+
+
+class DummyDataset:
+    w_vectorizer = DummyVectorizer()
+    t2m_dataset = SimpleNamespace(return_token_ids=True)
+
+    def __len__(self):
+        return NUM_BATCHES * BATCH_SIZE
+
+
+class DummyLoader:
+    """
+    The (motion, model_kwargs) batches of an eval loader, with offline length-scale ids.
+    """
+
+    batch_size = BATCH_SIZE
+
+    def __init__(self):
+        self.dataset = DummyDataset()
+        generator = torch.Generator().manual_seed(0)
+        self.batches = [(torch.zeros(BATCH_SIZE, NJOINTS, 1, NFRAMES),
+                         {'lengths': torch.randint(4, NFRAMES + 1, (BATCH_SIZE,), generator=generator),
+                          'length_idx': torch.randint(3, (BATCH_SIZE, NJOINTS), generator=generator),
+                          'text': [f'caption {i} {j}' for j in range(BATCH_SIZE)],
+                          'tokens': ['sos/OTHER_a/DET_eos/OTHER'] * BATCH_SIZE})
+                        for i in range(NUM_BATCHES)]
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        for motion, y in self.batches:
+            yield motion, {'y': dict(y)}
+
+
+def test_sharded_generation_matches_one_process(tmp_path, monkeypatch):
+    # the generated dataset reads its kernels from the working directory
+    monkeypatch.chdir(tmp_path)
+    factors = torch.linalg.cholesky(torch.eye(NFRAMES) + 0.5 * torch.ones(NFRAMES, NFRAMES))
+    save_kernel_store('HumanML3D_K_param_data196_fps20_dim263_len10.pkl', factors.repeat(3, 1, 1).numpy(),
+                      torch.eye(NFRAMES).numpy(), [0.1, 0.5, 1.])
+    dist_util.setup_dist(-1)
+    torch.manual_seed(0)
+    model = DummyModel()
+    diffusion = create_gaussian_diffusion(SimpleNamespace(diffusion_steps=5, noise_schedule='cosine', sigma_small=True,
+                                                          lambda_vel=0, lambda_rcxyz=0, lambda_fc=0))
+    loader = DummyLoader()
+    generation_args = (model, diffusion, loader, 2, 2, NFRAMES, None, 1.)
+
+    single = GenerationCache(str(tmp_path / 'single'), seed=10)
+    CompMDMGeneratedDataset(*generation_args, cache=single)
+    generate_sharded(2, GenerationCache(str(tmp_path / 'sharded'), seed=10), *generation_args)
+
+    sharded = GenerationCache(str(tmp_path / 'sharded'), seed=10)
+    assert glob.glob(pjoin(sharded.path, 'manifest.rank*.json')) == []
+    assert sorted(sharded.shards) == sorted(single.shards) and len(single.shards) == NUM_BATCHES
+    for i in range(NUM_BATCHES):
+        expected, shard = single.load(0, i), sharded.load(0, i)
+        assert shard.keys() == expected.keys()
+        for key in expected:
+            np.testing.assert_array_equal(shard[key], expected[key])
+    assert any('mm_motion' in single.load(0, i) for i in range(NUM_BATCHES))
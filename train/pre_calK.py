@@ -9,6 +9,7 @@ import torch
 import numpy as np 
 import pickle as pkl
 from scipy.spatial import distance
+from diffusion.kernel_store import save_kernel_store
 
 def k_se(x1, x2, gain=1.0, hyp_len=1.0):
 
@@ -50,6 +51,9 @@ def main():
     data = {'template': template_decom_K, 'K_param' : decom_K, 'len_param' : lens_array}
     with open(save_path, 'wb') as f : 
         pkl.dump(data, f)
+    # memory-mappable copy that keeps the shared template once
+    save_kernel_store(save_path.replace('.pkl', '.kstore'), decom_K, template_decom_K, lens_array,
+                      num_frames=num_data, fps=fps, gain=0.1)
 
 if __name__ == "__main__":
     main()
@@ -30,6 +30,10 @@ from cmib.model.skeleton import (Skeleton, sk_joints_to_remove, sk_offsets, sk_p
 from data_loaders.tensors import collate
 import pickle as pkl
 from lpm.model import LengthPredctionUnet
+from lpm.length_index import LengthIndexCache, load_length_module, predict_length_idx
+from diffusion.gp_kernel import (KernelFactorCache, KernelOperator, LENGTH_SCALES, circulant_spectra,
+                                 get_corr_channels)
+from diffusion.kernel_store import load_kernel_bag
 
 # For ImageNet experiments, this was a good default value.
 # We found that the lg_loss_scale quickly climbed to
@@ -89,13 +93,21 @@ class TrainLoop:
         if torch.cuda.is_available() and dist_util.dev() != 'cpu':
             self.device = torch.device(dist_util.dev())        
         
-        if args.corr_noise:
-            with open(args.param_lenK_path, 'rb') as f: 
-                self.param_lenK = pkl.load(f)
+        if args.corr_noise and args.kernel_cache_dir:
+            kernel_cache = KernelFactorCache(args.kernel_cache_dir)
+            self.num_len = len(LENGTH_SCALES)
+            self.K_param = kernel_cache.stack(LENGTH_SCALES, 196, 20, device=self.device)
+            self.template = kernel_cache.template(196, 20, device=self.device)
+        elif args.corr_noise:
+            self.param_lenK = load_kernel_bag(args.param_lenK_path)
             self.num_len = len(self.param_lenK['K_param'])
-            self.K_param = torch.Tensor(self.param_lenK['K_param']).to(self.device)
-            template = self.param_lenK['template']
-            self.template = torch.Tensor(template).repeat(self.batch_size, 1,1,1).to(self.device)
+            self.K_param = self.param_lenK['K_param'].to(self.device)
+            self.template = self.param_lenK['template'].to(self.device)
+        if args.corr_noise:
+            self.K_crops = {}
+            self.K_spectra = None
+            if args.noise_sampler == 'fft':
+                self.K_spectra = circulant_spectra(torch.cat([self.K_param, self.template[None]]))
         else : 
             self.param_lenK = None
 
@@ -122,7 +134,18 @@ class TrainLoop:
             # }
         self.use_ddp = False
         self.ddp_model = self.model
-        self.length_module = self._load_length_module()
+        if args.corr_noise and args.len_idx_path:
+            # offline annotations replace the LPM, see data_loaders/humanml/scripts/annotate_length.py
+            self.data.dataset.t2m_dataset.load_length_idx(args.len_idx_path)
+            self.length_module = None
+            self.cls_value = torch.Tensor(LENGTH_SCALES).to(self.device)
+        else:
+            self.length_module = self._load_length_module()
+        self.len_idx_cache = None
+        if args.corr_noise and args.len_idx_cache and not args.len_idx_path:
+            # the dataset hands (name, crop offset, crop length) to the collate so crops can be looked up
+            self.len_idx_cache = LengthIndexCache(args.len_idx_cache, get_corr_channels(args.corr_mode, 263))
+            self.data.dataset.t2m_dataset.return_crop_key = True
         
     def _load_and_sync_parameters(self):
         resume_checkpoint = find_resume_checkpoint() or self.resume_checkpoint
@@ -150,32 +173,7 @@ class TrainLoop:
             self.opt.load_state_dict(state_dict)
 
     def _load_length_module(self):
-        
-        model_pth = './save/final_lpm.pt'
-        length_module = LengthPredctionUnet(
-            name                 = 'unet',
-            dims                 = 1,
-            n_in_channels        = 1,
-            n_base_channels      = 128,
-            n_emb_dim            = 128,
-            n_cond_dim           = 1,
-            n_time_dim           = 0,
-            n_enc_blocks         = 7, # number of encoder blocks
-            n_groups             = 16, # group norm paramter
-            n_heads              = 4, # number of heads in QKV attention
-            actv                 = nn.SiLU(),
-            kernel_size          = 3, # kernel size (3)
-            padding              = 1, # padding size (1)
-            use_attention        = False,
-            skip_connection      = True, # additional skip connection
-            chnnel_multiples     = [1,2,2,2,4,4,8],
-            updown_rates         = [1,1,2,1,2,1,2],
-            use_scale_shift_norm = True,
-            device               = self.device,
-        ) # input:[B x C x L] => output:[B x C x L]
-        length_module.load_state_dict(torch.load(model_pth)['model_state_dict'])
-        length_module.to(self.device)
-        length_module.eval()
+        length_module = load_length_module(self.device)
         self.cls_value = torch.Tensor(
             [0.033     , 0.14044444, 
              0.24788889, 0.35533333, 
@@ -201,20 +199,33 @@ class TrainLoop:
 
         return pred, pred_idx
 
-    def _cal_corr_mat(self, data_shape, pred_idx, K_param_bag, true_length, target_idx_array=[1,2]) : 
-        # target idx_array : idx of joints which only used root xz
-        pred_K_params = self.template.clone()
-        if self.args.corr_mode == 'R_trsrot' : 
-            pred_K_params[:, [0, 1, 2, 3, 193, 194, 195]] = K_param_bag[pred_idx].reshape(self.batch_size,-1,196,196)
-        elif self.args.corr_mode == 'R_trs' : 
-            pred_K_params[:,target_idx_array] = K_param_bag[pred_idx].reshape(self.batch_size,-1,196,196)
-        elif self.args.corr_mode == 'all' :
-            pred_K_params = K_param_bag[pred_idx].reshape(self.batch_size,-1,196,196)
-        elif self.args.corr_mode == 'LP' :
-            pred_K_params[:,4:67] = K_param_bag[pred_idx].reshape(self.batch_size,-1,196,196)
-        elif self.args.corr_mode == 'LBody' :
-            pred_K_params[:,4:22] = K_param_bag[pred_idx].reshape(self.batch_size,-1,196,196)
-        return pred_K_params
+    def _length_indices(self, motion, cond, channels):
+        """
+        Length-scale class ids [B x len(channels)] for a training batch, taken
+        from offline annotations or the length index cache when possible and
+        from the LPM otherwise.
+        """
+        if 'length_idx' in cond['y']:
+            return cond['y']['length_idx'][:, channels].long()
+        if self.len_idx_cache is None:
+            return predict_length_idx(self.length_module, motion, cond['y']['lengths'], channels)
+        crop_keys = cond['y']['crop_key']
+        ids, hit = self.len_idx_cache.lookup(crop_keys)
+        if not hit.all():
+            miss = np.flatnonzero(~hit)
+            miss_ids = predict_length_idx(self.length_module, motion[miss], cond['y']['lengths'][miss], channels)
+            ids[miss] = miss_ids.cpu().numpy()
+            self.len_idx_cache.update([crop_keys[i] for i in miss], ids[miss])
+        return torch.from_numpy(ids).long().to(self.device)
+
+    def _cal_corr_mat(self, data_shape, pred_idx, K_param_bag, true_length) : 
+        # only the channels selected by corr_mode get a predicted kernel, the rest share the template
+        B, D = data_shape[:2]
+        channels = get_corr_channels(self.args.corr_mode, D)
+        K_params = KernelOperator.from_classes(K_param_bag, self.template, pred_idx.reshape(B, -1), channels, D,
+                                               spectra=self.K_spectra, crops=self.K_crops)
+        # length-bucketed batches are shorter than the kernels
+        return K_params.crop(data_shape[-1])
         
     def run_loop(self):
         if self.args.wandb:
@@ -231,56 +242,12 @@ class TrainLoop:
                 if self.args.corr_noise :        
                     # B D 1 L 
                     B, D, _, L = motion.shape
-                    if self.args.corr_mode == 'R_trsrot' : 
-                        input_motion = motion[:,[0, 1, 2, 3, 193, 194, 195],:,:]
-                        B_, D_, _, L_ = input_motion.shape
-                        input_motion = input_motion.reshape(B_*D_, 1, L_)
-                        true_length = cond['y']['lengths'].repeat_interleave(D_)
-                        pred_lens, pred_idx = self._predict_length(input_motion, true_length)
-                        pred_lens = pred_lens.reshape(B_, D_)
-                        org_lens = (torch.ones([B,D])*0.033).to(self.device)
-                        org_lens[:,[0, 1, 2, 3, 193, 194, 195]] = pred_lens
-                    elif self.args.corr_mode == 'R_trs' : 
-                        input_motion = motion[:,1:3,:,:]
-                        B_, D_, _, L_ = input_motion.shape
-                        input_motion = input_motion.reshape(B_*D_, 1, L_)
-                        true_length = cond['y']['lengths'].repeat_interleave(D_)
-                        pred_lens, pred_idx = self._predict_length(input_motion, true_length)
-                        pred_lens = pred_lens.reshape(B_, D_)
-                        org_lens = (torch.ones([B,D])*0.033).to(self.device)
-                        org_lens[:,1:3] = pred_lens
-                    elif self.args.corr_mode == 'all' : 
-                        input_motion = motion[:,:,:,:]
-                        B_, D_, _, L_ = input_motion.shape
-                        input_motion = input_motion.reshape(B_*D_, 1, L_)
-                        true_length = cond['y']['lengths'].repeat_interleave(D_)
-                        pred_lens, pred_idx = self._predict_length(input_motion, true_length)
-                        pred_lens = pred_lens.reshape(B_, D_)
-                        # org_lens = np.ones([B,D])*0.033
-                        org_lens = pred_lens
-                    elif self.args.corr_mode == 'LP':
-                        input_motion = motion[:,4:67,:,:]
-                        B_, D_, _, L_ = input_motion.shape
-                        input_motion = input_motion.reshape(B_*D_, 1, L_)
-                        true_length = cond['y']['lengths'].repeat_interleave(D_)
-                        pred_lens, pred_idx = self._predict_length(input_motion, true_length)
-                        pred_lens = pred_lens.reshape(B_, D_)
-                        org_lens = (torch.ones([B,D])*0.033).to(self.device)
-                        org_lens[:,4:67] = pred_lens
-                    elif self.args.corr_mode == 'LBody':
-                        input_motion = motion[:,4:22,:,:]
-                        B_, D_, _, L_ = input_motion.shape
-                        input_motion = input_motion.reshape(B_*D_, 1, L_)
-                        true_length = cond['y']['lengths'].repeat_interleave(D_)
-                        pred_lens, pred_idx = self._predict_length(input_motion, true_length)
-                        pred_lens = pred_lens.reshape(B_, D_)
-                        org_lens = (torch.ones([B,D])*0.033).to(self.device)
-                        org_lens[:,4:22] = pred_lens
-
-                    # org_lens = pred_lens
+                    channels = get_corr_channels(self.args.corr_mode, D)
+                    pred_idx = self._length_indices(motion, cond, channels)
+                    org_lens = (torch.ones([B,D])*0.033).to(self.device)
+                    org_lens[:, channels] = self.cls_value[pred_idx]
                     self.pred_lens = org_lens
-                    self.pred_idx = pred_idx.reshape(B_, D_)
-                    # motion = motion.reshape(B, D, 1, L)
+                    self.pred_idx = pred_idx
                     self.pred_K_param = self._cal_corr_mat(motion.shape, pred_idx, self.K_param, cond['y']['lengths'])
                 else :
                     self.pred_lens = None
@@ -332,9 +299,13 @@ class TrainLoop:
         all_text = []
 
         if self.args.corr_noise : 
-            eval_K_params = torch.zeros((2,263,196,196)).to(self.device) 
-            eval_K_params[0,1:3] = self.K_param[0].repeat(2,1,1)
-            eval_K_params[1,1:3] = self.K_param[-1].repeat(2,1,1)
+            eval_cls_idx = torch.tensor([[0, 0], [self.num_len-1, self.num_len-1]], device=self.device)
+            eval_fill = torch.zeros_like(self.template)
+            eval_spectra = None
+            if self.args.noise_sampler == 'fft':
+                eval_spectra = circulant_spectra(torch.cat([self.K_param, eval_fill[None]]))
+            eval_K_params = KernelOperator.from_classes(self.K_param, eval_fill, eval_cls_idx, [1, 2], 263,
+                                                        spectra=eval_spectra)
             eval_len_param = torch.ones((2,263)).to(self.device) * 0.03
             eval_len_param[0,1:3] = torch.Tensor([0.033]).to(self.device).repeat(2)
             eval_len_param[1,1:3] = torch.Tensor([1.0]).to(self.device).repeat(2)
@@ -352,7 +323,7 @@ class TrainLoop:
                 self.model,
                 # (args.batch_size, model.njoints, model.nfeats, n_frames),  # BUG FIX - this one caused a mismatch between training and inference
                 (1, self.model.njoints, self.model.nfeats, 196),  # BUG FIX
-                eval_K_params[i].unsqueeze(0) if eval_K_params is not None else None,
+                eval_K_params[i] if eval_K_params is not None else None,
                 eval_len_param[i].unsqueeze(0) if eval_len_param is not None else None,
                 clip_denoised=False,
                 model_kwargs=model_kwargs,
@@ -481,6 +452,9 @@ class TrainLoop:
         ) as f:
             torch.save(self.opt.state_dict(), f)
 
+        if self.len_idx_cache is not None:
+            self.len_idx_cache.save()
+
 
 def parse_resume_step_from_filename(filename):
     """
@@ -1,3 +1,5 @@
+import hashlib
+
 import torch
 
 
@@ -19,6 +21,14 @@ def to_torch(ndarray):
     return ndarray
 
 
+def file_digest(path, chunk_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
 def cleanexit():
     import sys
     import os
@@ -1,5 +1,8 @@
+import functools
+
 from model.mdm import MDM
 from diffusion import gaussian_diffusion as gd
+from diffusion.compiled_sampler import CompiledSampleLoop
 from diffusion.respace import SpacedDiffusion, space_timesteps
 from utils.parser_util import get_cond_mode
 
@@ -74,7 +77,8 @@ def get_model_args(args, data):
             'latent_dim': args.latent_dim, 'ff_size': 1024, 'num_layers': args.layers, 'num_heads': 4,
             'dropout': 0.1, 'activation': "gelu", 'data_rep': data_rep, 'cond_mode': cond_mode,
             'cond_mask_prob': args.cond_mask_prob, 'action_emb': action_emb, 'arch': args.arch,
-            'emb_trans_dec': args.emb_trans_dec, 'clip_version': clip_version, 'dataset': args.dataset}
+            'emb_trans_dec': args.emb_trans_dec, 'clip_version': clip_version, 'dataset': args.dataset,
+            'text_store': getattr(args, 'text_store', ''), 'padding_mask': getattr(args, 'padding_mask', False)}
 
 
 def create_gaussian_diffusion(args):
@@ -84,6 +88,8 @@ def create_gaussian_diffusion(args):
     steps = args.diffusion_steps
     scale_beta = 1.  # no scaling
     timestep_respacing = ''  # can be used for ddim sampling, we don't use it.
+    if 0 < getattr(args, 'sampling_steps', 0) < steps:
+        timestep_respacing = str(args.sampling_steps)  # few-step sampling, see --sampler
     learn_sigma = False
     rescale_timesteps = False
 
@@ -114,4 +120,27 @@ def create_gaussian_diffusion(args):
         lambda_rcxyz=args.lambda_rcxyz,
         lambda_fc=args.lambda_fc,
     )
-    
+
+
+def get_sample_fn(diffusion, args):
+    """
+    The sample loop selected by --sampler (p_sample_loop by default),
+    split into length buckets when --length_buckets is set.
+    """
+    sample_fn = get_base_sample_fn(diffusion, args)
+    if getattr(args, 'length_buckets', ''):
+        bucket_edges = [int(e) for e in args.length_buckets.split(',')]
+        return functools.partial(diffusion.length_bucket_sample_loop, bucket_edges=bucket_edges, sample_fn=sample_fn)
+    return sample_fn
+
+
+def get_base_sample_fn(diffusion, args):
+    sampler = getattr(args, 'sampler', 'ddpm')
+    if getattr(args, 'compiled_step', ''):
+        assert sampler == 'ddpm', 'compiled_step only supports the ddpm sampler'
+        return CompiledSampleLoop(diffusion, mode=args.compiled_step)
+    if sampler == 'ddim':
+        return functools.partial(diffusion.ddim_sample_loop, eta=args.ddim_eta)
+    elif sampler == 'dpm_solver':
+        return diffusion.dpm_solver_sample_loop
+    return diffusion.p_sample_loop
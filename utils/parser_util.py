@@ -11,6 +11,7 @@ def parse_and_load_from_model(parser):
     add_model_options(parser)
     add_diffusion_options(parser)
     args = parser.parse_args()
+    cmd_arch = args.arch
     args_to_overwrite = []
     for group_name in ['dataset', 'model', 'diffusion']:
         args_to_overwrite += get_args_per_group_name(parser, args, group_name)
@@ -33,6 +34,10 @@ def parse_and_load_from_model(parser):
         else:
             print('Warning: was not able to load [{}], using default value [{}] instead.'.format(a, args.__dict__[a]))
 
+    # trans_enc weights load into the SDPA encoder as is
+    if cmd_arch == 'trans_enc_sdpa' and args.arch == 'trans_enc':
+        args.arch = cmd_arch
+
     if args.cond_mask_prob == 0:
         args.guidance_param = 1
     return args
@@ -63,6 +68,9 @@ def add_base_options(parser):
     group.add_argument("--batch_size", default=64, type=int, help="Batch size during training.")
     group.add_argument("--reference_bvh_path", default='', type=str,
                        help="Path toreference bvh.")    
+    group.add_argument("--text_store", default='', type=str,
+                       help="Path to precomputed CLIP caption embeddings (see model/text_store.py). "
+                            "If set, CLIP is only loaded for captions missing from the store.")
 
 def add_diffusion_options(parser):
     group = parser.add_argument_group('diffusion')
@@ -75,8 +83,10 @@ def add_diffusion_options(parser):
 def add_model_options(parser):
     group = parser.add_argument_group('model')
     group.add_argument("--arch", default='trans_enc',
-                       choices=['trans_enc', 'trans_dec', 'gru'], type=str,
-                       help="Architecture types as reported in the paper.")
+                       choices=['trans_enc', 'trans_enc_sdpa', 'trans_dec', 'gru'], type=str,
+                       help="Architecture types as reported in the paper. trans_enc_sdpa is trans_enc run "
+                            "batch-first on scaled_dot_product_attention; it loads trans_enc checkpoints, "
+                            "so it can also be passed when sampling / evaluating a trans_enc model.")
     group.add_argument("--emb_trans_dec", default=False, type=bool,
                        help="For trans_dec architecture only, if true, will inject condition as a class token"
                             " (in addition to cross-attention).")
@@ -93,6 +103,9 @@ def add_model_options(parser):
     group.add_argument("--unconstrained", action='store_true',
                        help="Model is trained unconditionally. That is, it is constrained by neither text nor action. "
                             "Currently tested on HumanAct12 only.")
+    group.add_argument("--padding_mask", action='store_true',
+                       help="Mask padded frames out of the trans_enc self-attention. "
+                            "Can be set at sampling time for models whose args.json predates it.")
 
 
 
@@ -107,7 +120,7 @@ def add_data_options(parser):
 def add_training_options(parser):
     group = parser.add_argument_group('training')
     group.add_argument("--param_lenK_path", default= './HumanML3D_K_param_data196_fps20_dim263_len10.pkl', type=str,
-                       help="Path to GP parameter bag.")
+                       help="Path to GP parameter bag (legacy pickle or kernel store, see diffusion/kernel_store.py).")
     group.add_argument("--len_model_path", default= './', type=str,
                        help="Path to GP parameter bag.")
     group.add_argument("--corr_noise", action='store_true', help="Use correlate noise.")
@@ -147,6 +160,22 @@ def add_training_options(parser):
                        help="logging wandb")
     group.add_argument("--corr_mode", default='', type=str,
                     help="Target joint for corr noise")
+    group.add_argument("--noise_sampler", default='dense', choices=['dense', 'fft'], type=str,
+                       help="How correlated noise is drawn. fft uses a circulant embedding of the "
+                            "Toeplitz kernels and falls back to the dense factor when it is not PSD.")
+    group.add_argument("--kernel_cache_dir", default='', type=str,
+                       help="If not empty, kernel factors are computed on the fly and cached in this directory "
+                            "instead of being loaded from param_lenK_path.")
+    group.add_argument("--len_idx_cache", default='', type=str,
+                       help="If not empty, length-scale class ids predicted by the LPM are cached in this file, "
+                            "keyed by clip name and crop offset, and reused instead of rerunning the LPM.")
+    group.add_argument("--len_idx_path", default='', type=str,
+                       help="Path to offline length-scale annotations (length_idx.npz). "
+                            "If set, the LPM is not run during training.")
+    group.add_argument("--length_bucket_width", default=0, type=int,
+                       help="If > 0, batches are drawn from length buckets of this many frames (shuffled within "
+                            "buckets) and padded to the longest motion of the batch instead of 196 frames. "
+                            "Train with --padding_mask so the padding length does not change the model's output.")
     
 def add_sampling_options(parser):
     group = parser.add_argument_group('sampling')
@@ -170,7 +199,7 @@ def add_sampling_options(parser):
 def add_generate_options(parser):
     group = parser.add_argument_group('generate')
     group.add_argument("--param_lenK_path", default= './HumanML3D_K_param_data196_fps20_dim263_len10.pkl', type=str,
-                    help="Path to GP parameter bag.")
+                    help="Path to GP parameter bag (legacy pickle or kernel store, see diffusion/kernel_store.py).")
     group.add_argument("--len_idx", default=0, type=int,
                     help="Choose the index of length parameters.")
     group.add_argument("--motion_length", default=9.8, type=float,
@@ -187,6 +216,33 @@ def add_generate_options(parser):
     group.add_argument("--action_name", default='', type=str,
                        help="An action name to be generated. If empty, will take text prompts from dataset.")
     group.add_argument("--corr_noise", action='store_true', help="Use correlate noise.")
+    group.add_argument("--noise_sampler", default='dense', choices=['dense', 'fft'], type=str,
+                       help="How correlated noise is drawn. fft uses a circulant embedding of the "
+                            "Toeplitz kernels and falls back to the dense factor when it is not PSD.")
+    group.add_argument("--kernel_cache_dir", default='', type=str,
+                       help="If not empty, kernel factors are computed on the fly and cached in this directory "
+                            "instead of being loaded from param_lenK_path.")
+    group.add_argument("--length_scales", default='', type=str,
+                       help="Comma separated GP length-scales to sample with (e.g. 0.05,0.3,0.8). "
+                            "Requires no precomputed bag; factors come from the kernel cache.")
+
+def add_sampler_options(parser):
+    group = parser.add_argument_group('sampler')
+    group.add_argument("--sampler", default='ddpm', choices=['ddpm', 'ddim', 'dpm_solver'], type=str,
+                       help="Reverse process used at sampling time. ddim and dpm_solver are meant to be "
+                            "used with a small --sampling_steps.")
+    group.add_argument("--sampling_steps", default=0, type=int,
+                       help="Number of evenly respaced timesteps to sample with. "
+                            "0 uses all diffusion steps.")
+    group.add_argument("--ddim_eta", default=0.0, type=float,
+                       help="DDIM stochasticity; 0 is deterministic, 1 matches DDPM.")
+    group.add_argument("--compiled_step", default='', choices=['', 'compile', 'cuda_graph'], type=str,
+                       help="Run the ddpm sampler with one captured denoising step replayed for all timesteps: "
+                            "compile uses torch.compile (works on CPU), cuda_graph records a CUDA graph.")
+    group.add_argument("--length_buckets", default='', type=str,
+                       help="Comma separated frame counts, e.g. 64,96,128,160,196. Each batch is split into "
+                            "length buckets sampled at the bucket's frame count instead of the full length. "
+                            "Best combined with --padding_mask.")
 
 def add_edit_options(parser):
     group = parser.add_argument_group('edit')
@@ -216,6 +272,18 @@ def add_evaluation_options(parser):
                             "full (a2m only) - 20 repetitions.")
     group.add_argument("--guidance_param", default=2.5, type=float,
                        help="For classifier-free sampling - specifies the s parameter, as defined in the paper.")
+    group.add_argument("--len_idx_path", default='', type=str,
+                       help="Path to offline length-scale annotations (length_idx.npz). "
+                            "If set, the LPM is not run during evaluation.")
+    group.add_argument("--no_gt_cache", action='store_true',
+                       help="Encode the ground truth twice in every replication instead of reusing the embeddings "
+                            "cached in <data_root>/eval_cache (a shared FID pass and a matching pass per replication).")
+    group.add_argument("--gen_cache_dir", default='', type=str,
+                       help="If set, generated motions are stored there batch by batch, so that an interrupted or "
+                            "repeated evaluation of the same model, scale and seed resumes from them.")
+    group.add_argument("--gen_workers", default=1, type=int,
+                       help="Generate the eval motions in that many processes (one per GPU, round-robin, or "
+                            "splitting the CPU threads). Needs --gen_cache_dir and excludes --compiled_step; gives the same samples as 1 worker.")
     # group.add_argument("--len_param", required=True, type=float,)
 
 def get_cond_mode(args):
@@ -244,6 +312,7 @@ def generate_args():
     add_base_options(parser)
     add_sampling_options(parser)
     add_generate_options(parser)
+    add_sampler_options(parser)
     args = parse_and_load_from_model(parser)
     cond_mode = get_cond_mode(args)
 
@@ -269,4 +338,5 @@ def evaluation_parser():
     # args specified by the user: (all other will be loaded from the model)
     add_base_options(parser)
     add_evaluation_options(parser)
+    add_sampler_options(parser)
     return parse_and_load_from_model(parser)
\ No newline at end of file